@@ -0,0 +1,25 @@
+import hmac
+import os
+
+from fastapi import HTTPException, Request
+
+ADMIN_TOKEN_ENV = "NUDENY_ADMIN_TOKEN"
+
+
+def require_admin(request: Request):
+    """
+    FastAPI dependency guarding the admin endpoints.
+
+    Admin endpoints answer 404 unless NUDENY_ADMIN_TOKEN is set, and 403
+    unless the request carries the same value in `X-Admin-Token`.
+
+    Args:
+        request (Request): Incoming request.
+    """
+    token = os.environ.get(ADMIN_TOKEN_ENV)
+    if not token:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    provided = request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(provided.encode(), token.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
@@ -0,0 +1,146 @@
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+from limits import parse
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+
+import metrics
+
+# Storage shared by the request and image limiters, e.g. redis://host:6379
+# so every worker draws from the same budget. memory:// keeps it per worker.
+RATE_LIMIT_STORAGE_URI = os.environ.get("NUDENY_RATE_LIMIT_STORAGE_URI", "memory://")
+
+# Budget of weighted images per client, where an image costs its endpoint's
+# weight below.
+IMAGE_RATE_LIMIT = os.environ.get("NUDENY_IMAGE_RATE_LIMIT", "60000/minute")
+
+# Relative cost of one image on each endpoint family.
+ENDPOINT_COSTS = os.environ.get("NUDENY_ENDPOINT_COSTS", "classify=1,detect=2,censor=4")
+
+# Weighted images a single worker works on at once before shedding load.
+MAX_IN_FLIGHT_COST = int(os.environ.get("NUDENY_MAX_IN_FLIGHT_COST", "400"))
+
+# Seconds clients are told to wait when the worker is saturated.
+OVERLOAD_RETRY_AFTER = int(os.environ.get("NUDENY_OVERLOAD_RETRY_AFTER", "1"))
+
+
+def parse_costs(value):
+    """
+    Parses an endpoint cost list.
+
+    Args:
+        value (str): Comma separated name=cost pairs, e.g. "classify=1,censor=4".
+
+    Returns:
+        dict: Cost per endpoint name.
+    """
+    costs = {}
+    for item in value.split(","):
+        name, _, cost = item.strip().partition("=")
+        costs[name] = int(cost)
+    return costs
+
+
+class AdmissionControl:
+    """
+    Admits requests by the work they carry instead of counting them.
+
+    Each request is weighted by number of images times endpoint cost. The
+    weight is charged against a per-client rate limit (429 when exhausted)
+    and held against a per-worker in-flight budget while the request runs
+    (503 when the worker is saturated). Both responses carry Retry-After.
+    A request weighing more than the whole in-flight budget waits for an
+    idle worker and then runs alone.
+    """
+
+    def __init__(self, storage_uri=RATE_LIMIT_STORAGE_URI, rate_limit=IMAGE_RATE_LIMIT,
+                 costs=ENDPOINT_COSTS, max_in_flight_cost=MAX_IN_FLIGHT_COST,
+                 retry_after=OVERLOAD_RETRY_AFTER):
+        self.limit = parse(rate_limit)
+        self.limiter = FixedWindowRateLimiter(storage_from_string(storage_uri))
+        self.costs = parse_costs(costs) if isinstance(costs, str) else dict(costs)
+        self.max_in_flight_cost = max_in_flight_cost
+        self.retry_after = retry_after
+        self.in_flight_cost = 0
+        self._lock = threading.Lock()
+
+    def weight(self, endpoint, images):
+        """
+        Args:
+            endpoint (str): Endpoint family, e.g. "censor".
+            images (int): Number of files or sources in the request.
+
+        Returns:
+            int: Weighted cost of the request.
+        """
+        return max(1, images) * self.costs.get(endpoint, 1)
+
+    def _overloaded(self):
+        metrics.ADMISSION_REJECTIONS.labels("overloaded").inc()
+        return HTTPException(
+            status_code=503,
+            detail="Server is busy, retry later.",
+            headers={"Retry-After": str(self.retry_after)})
+
+    def check_capacity(self):
+        """
+        Sheds a request with 503 when the worker is already saturated,
+        before its body is read. The request is weighted by admit once its
+        number of images is known.
+        """
+        with self._lock:
+            if self.in_flight_cost >= self.max_in_flight_cost:
+                raise self._overloaded()
+
+    def _reserve(self, weight):
+        with self._lock:
+            # An oversized request is only admitted on an idle worker.
+            if self.in_flight_cost and self.in_flight_cost + weight > self.max_in_flight_cost:
+                raise self._overloaded()
+            self.in_flight_cost += weight
+            metrics.IN_FLIGHT_COST.set(self.in_flight_cost)
+
+    def _release(self, weight):
+        with self._lock:
+            self.in_flight_cost -= weight
+            metrics.IN_FLIGHT_COST.set(self.in_flight_cost)
+
+    def _charge(self, client, weight):
+        if self.limiter.hit(self.limit, "images", client, cost=weight):
+            return
+        metrics.ADMISSION_REJECTIONS.labels("rate_limited").inc()
+        reset_time, _ = self.limiter.get_window_stats(self.limit, "images", client)
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded: {} weighted images".format(self.limit),
+            headers={"Retry-After": str(max(1, math.ceil(reset_time - time.time())))})
+
+    @contextmanager
+    def admit(self, client, endpoint, images):
+        """
+        Holds a request's weight for the duration of the block.
+
+        Capacity is checked before the rate limit is charged, so requests
+        shed with 503 do not use up the client's budget.
+
+        Args:
+            client (str): Rate limit key, usually the client address.
+            endpoint (str): Endpoint family, e.g. "classify".
+            images (int): Number of files or sources in the request.
+        """
+        weight = self.weight(endpoint, images)
+        self._reserve(weight)
+        try:
+            self._charge(client, weight)
+        except BaseException:
+            self._release(weight)
+            raise
+        try:
+            yield weight
+        finally:
+            self._release(weight)
@@ -0,0 +1,415 @@
+import struct
+import zlib
+
+BLOCK = 512
+
+# Largest GNU long name or pax header accepted, they are held in memory.
+MAX_TAR_META_BYTES = 2 ** 20
+
+# Output produced per decompress call, so a single chunk of a compressed
+# stream cannot expand into an unbounded amount of memory.
+INFLATE_CHUNK = 2 ** 16
+
+TAR_FILE_TYPES = {b"0", b"\0", b"7"}
+ZIP_LOCAL_HEADER = b"PK\x03\x04"
+ZIP_END_HEADERS = {b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06"}
+ZIP_DESCRIPTOR = b"PK\x07\x08"
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+
+class ArchiveError(ValueError):
+    """
+    The archive is malformed or uses a feature that cannot be streamed.
+    """
+
+
+class _Reader:
+    """
+    Base of the streaming readers. Feed the archive as it arrives and
+    collect the members completed so far.
+
+    Attributes:
+        size (int): Uncompressed archive bytes processed.
+        done (bool): Whether the end of the archive was reached.
+    """
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.size = 0
+        self.done = False
+        self._finished = []
+
+    def feed(self, data):
+        """
+        Args:
+            data (bytes): Next bytes of the archive.
+
+        Returns:
+            list: IngestedFile of every member completed by these bytes.
+        """
+        if not self.done:
+            self._feed(data)
+        finished, self._finished = self._finished, []
+        return finished
+
+    def close(self):
+        """
+        Returns:
+            list: Members completed by the end of the stream.
+
+        Raises:
+            ArchiveError: The stream ended in the middle of a member.
+        """
+        self._close()
+        finished, self._finished = self._finished, []
+        return finished
+
+    def _close(self):
+        raise NotImplementedError
+
+    def _feed(self, data):
+        raise NotImplementedError
+
+
+def _nul_terminated(field):
+    return bytes(field).split(b"\0", 1)[0]
+
+
+def _tar_number(field):
+    if field[0] & 0x80:
+        # GNU base-256 encoding of large sizes.
+        return int.from_bytes(bytes([field[0] & 0x7F]) + bytes(field[1:]), "big")
+    field = _nul_terminated(field).strip(b" ")
+    try:
+        return int(field, 8) if field else 0
+    except ValueError:
+        raise ArchiveError("Invalid number in tar header.")
+
+
+def _tar_checksum_ok(header):
+    stored = _tar_number(header[148:156])
+    unsigned = sum(header[:148]) + 8 * 32 + sum(header[156:])
+    return stored == unsigned
+
+
+def is_tar(head):
+    """
+    Args:
+        head (bytes): First bytes of a stream.
+
+    Returns:
+        bool: Whether the stream starts with a tar header.
+    """
+    if len(head) < BLOCK:
+        return False
+    try:
+        return head[257:262] == b"ustar" or _tar_checksum_ok(head[:BLOCK])
+    except ArchiveError:
+        return False
+
+
+def _pax_path(records):
+    """
+    Returns the path of a pax extended header, None when it has none.
+    """
+    path = None
+    pos = 0
+    while pos < len(records):
+        space = records.find(b" ", pos)
+        if space == -1:
+            break
+        try:
+            length = int(records[pos:space])
+        except ValueError:
+            raise ArchiveError("Invalid pax header.")
+        if length <= space - pos:
+            raise ArchiveError("Invalid pax header.")
+        key, _, value = bytes(records[space + 1:pos + length - 1]).partition(b"=")
+        if key == b"path":
+            path = value.decode("utf-8", "replace")
+        pos += length
+    return path
+
+
+class TarReader(_Reader):
+    """
+    Streaming reader of ustar, GNU and pax tar archives. Regular files
+    become members, everything else (directories, links, ...) is skipped.
+    """
+
+    def __init__(self, collector):
+        super().__init__(collector)
+        self._buffer = bytearray()
+        self._member = None
+        self._meta = None
+        self._meta_type = None
+        self._remaining = 0
+        self._padding = 0
+        self._long_name = None
+        self._pax_name = None
+
+    def _feed(self, data):
+        self._buffer += data
+        while not self.done:
+            if self._remaining:
+                if not self._buffer:
+                    return
+                chunk = self._buffer[:self._remaining]
+                del self._buffer[:len(chunk)]
+                self._remaining -= len(chunk)
+                self.size += len(chunk)
+                if self._member is not None:
+                    self.collector.write(self._member, chunk)
+                elif self._meta is not None:
+                    self._meta += chunk
+                if not self._remaining:
+                    self._end_entry()
+            elif self._padding:
+                skipped = min(self._padding, len(self._buffer))
+                if not skipped:
+                    return
+                del self._buffer[:skipped]
+                self._padding -= skipped
+            elif len(self._buffer) >= BLOCK:
+                header = self._buffer[:BLOCK]
+                del self._buffer[:BLOCK]
+                self._start_entry(header)
+            else:
+                return
+
+    def _start_entry(self, header):
+        if not any(header):
+            # End-of-archive marker.
+            self.done = True
+            return
+        if not _tar_checksum_ok(header):
+            raise ArchiveError("Invalid tar header checksum.")
+
+        size = _tar_number(header[124:136])
+        type = bytes(header[156:157])
+        self._remaining = size
+        self._padding = -size % BLOCK
+
+        if type in (b"L", b"x"):
+            if size > MAX_TAR_META_BYTES:
+                raise ArchiveError("Tar extended header too large.")
+            self._meta = bytearray()
+            self._meta_type = type
+        elif type in TAR_FILE_TYPES:
+            name = _nul_terminated(header[0:100])
+            if header[257:262] == b"ustar":
+                prefix = _nul_terminated(header[345:500])
+                if prefix:
+                    name = prefix + b"/" + name
+            name = self._pax_name or self._long_name or name.decode("utf-8", "replace")
+            self._member = self.collector.begin(name)
+        if type not in (b"L", b"x"):
+            self._long_name = None
+            self._pax_name = None
+        if not size:
+            self._end_entry()
+
+    def _end_entry(self):
+        if self._member is not None:
+            self.collector.end(self._member)
+            self._finished.append(self._member)
+            self._member = None
+        elif self._meta is not None:
+            if self._meta_type == b"L":
+                self._long_name = _nul_terminated(self._meta).decode("utf-8", "replace")
+            else:
+                self._pax_name = _pax_path(self._meta)
+            self._meta = None
+
+    def _close(self):
+        if self._remaining or self._member is not None or (self._buffer and not self.done):
+            raise ArchiveError("Tar archive ends in the middle of a member.")
+
+
+class GzipReader(_Reader):
+    """
+    Streaming reader of a gzip compressed archive, e.g. a .tar.gz.
+
+    Args:
+        collector: Receives the members.
+        inner (callable): inner(collector) creates the reader of the
+            decompressed archive.
+    """
+
+    def __init__(self, collector, inner=TarReader):
+        super().__init__(collector)
+        self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._inner = inner(collector)
+
+    def _feed(self, data):
+        try:
+            while not self._inflater.eof and not self._inner.done:
+                output = self._inflater.decompress(data, INFLATE_CHUNK)
+                data = self._inflater.unconsumed_tail
+                if not output and not data:
+                    break
+                self._finished.extend(self._inner.feed(output))
+                self.size = self._inner.size
+        except zlib.error:
+            raise ArchiveError("Invalid gzip stream.")
+        self.done = self._inner.done
+
+    def _close(self):
+        self._finished.extend(self._inner.close())
+
+
+class ZipReader(_Reader):
+    """
+    Streaming reader of zip archives, going through the local file headers
+    without waiting for the central directory at the end.
+
+    Deflated members are always readable. Stored members are readable when
+    their sizes are in the local header, which is the case unless the
+    archive was written to a non-seekable stream.
+    """
+
+    def __init__(self, collector):
+        super().__init__(collector)
+        self._buffer = bytearray()
+        self._member = None
+        self._inflater = None
+        self._remaining = 0
+        self._descriptor = None
+
+    def _feed(self, data):
+        self._buffer += data
+        while not self.done:
+            if self._inflater is not None:
+                if not self._inflate():
+                    return
+            elif self._remaining:
+                if not self._buffer:
+                    return
+                chunk = self._buffer[:self._remaining]
+                del self._buffer[:len(chunk)]
+                self._remaining -= len(chunk)
+                self.size += len(chunk)
+                if self._member is not None:
+                    self.collector.write(self._member, chunk)
+                if not self._remaining:
+                    self._end_member()
+            elif self._descriptor is not None:
+                if not self._skip_descriptor():
+                    return
+            elif len(self._buffer) >= 4:
+                signature = bytes(self._buffer[:4])
+                if signature in ZIP_END_HEADERS:
+                    self.done = True
+                elif signature != ZIP_LOCAL_HEADER:
+                    raise ArchiveError("Invalid zip local file header.")
+                elif not self._start_member():
+                    return
+            else:
+                return
+
+    def _start_member(self):
+        if len(self._buffer) < 30:
+            return False
+        flags, method, compressed_size = struct.unpack("<xxxxxxHHxxxxxxxxI", self._buffer[:22])
+        name_length, extra_length = struct.unpack("<HH", self._buffer[26:30])
+        if len(self._buffer) < 30 + name_length + extra_length:
+            return False
+        name = bytes(self._buffer[30:30 + name_length]).decode("utf-8" if flags & 0x800 else "cp437", "replace")
+        extra = bytes(self._buffer[30 + name_length:30 + name_length + extra_length])
+        del self._buffer[:30 + name_length + extra_length]
+
+        zip64 = False
+        pos = 0
+        while pos + 4 <= len(extra):
+            tag, length = struct.unpack("<HH", extra[pos:pos + 4])
+            if tag == 0x0001:
+                zip64 = True
+                if compressed_size == 0xFFFFFFFF and length >= 16:
+                    compressed_size = struct.unpack("<Q", extra[pos + 12:pos + 20])[0]
+            pos += 4 + length
+
+        has_descriptor = bool(flags & 0x08)
+        self._descriptor = (zip64 and 20 or 12) if has_descriptor else None
+
+        if not name.endswith("/"):
+            self._member = self.collector.begin(name)
+
+        if method == ZIP_DEFLATED and not flags & 0x01:
+            self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            return True
+        if has_descriptor:
+            raise ArchiveError("Cannot stream zip member {} without its sizes.".format(name))
+        if (flags & 0x01 or method != ZIP_STORED) and self._member is not None:
+            # Encrypted or compressed with something else than deflate, the
+            # rejected member still receives its bytes to keep count.
+            self.collector.reject(self._member, "unsupported")
+        self._remaining = compressed_size
+        if not compressed_size:
+            self._end_member()
+        return True
+
+    def _inflate(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        try:
+            while not self._inflater.eof:
+                output = self._inflater.decompress(data, INFLATE_CHUNK)
+                data = self._inflater.unconsumed_tail
+                if output:
+                    self.size += len(output)
+                    if self._member is not None:
+                        self.collector.write(self._member, output)
+                elif not data:
+                    break
+        except zlib.error:
+            raise ArchiveError("Invalid deflate stream.")
+        if not self._inflater.eof:
+            return False
+        self._buffer += self._inflater.unused_data
+        self._inflater = None
+        self._end_member()
+        return True
+
+    def _skip_descriptor(self):
+        if len(self._buffer) < 4:
+            return False
+        length = self._descriptor + (4 if self._buffer[:4] == ZIP_DESCRIPTOR else 0)
+        if len(self._buffer) < length:
+            return False
+        del self._buffer[:length]
+        self._descriptor = None
+        return True
+
+    def _end_member(self):
+        member, self._member = self._member, None
+        if member is not None:
+            self.collector.end(member)
+            self._finished.append(member)
+
+    def _close(self):
+        if self._inflater is not None or self._remaining or self._member is not None or (
+                self._buffer and not self.done):
+            raise ArchiveError("Zip archive ends in the middle of a member.")
+
+
+def open_reader(head, collector):
+    """
+    Picks the reader for an archive from its first bytes.
+
+    Args:
+        head (bytes): First bytes of the archive, at least 512 unless the
+            archive is shorter.
+        collector: Receives the members.
+
+    Returns:
+        _Reader: Reader of the archive, None when the format is not
+        recognized.
+    """
+    if head[:4] in (ZIP_LOCAL_HEADER, b"PK\x05\x06"):
+        return ZipReader(collector)
+    if head[:2] == b"\x1f\x8b":
+        return GzipReader(collector)
+    if is_tar(head):
+        return TarReader(collector)
+    return None
@@ -0,0 +1,109 @@
+"""
+Benchmark of large data URI handling.
+
+Compares the single-pass utils.parse_data_uri with the previous
+validate-then-decode-again path, then times /classify-url/, /detect-url/ and
+/censor-url/ on the same data URIs (the endpoint part loads the models).
+
+Run from the repository root:
+
+    python -m benchmarks.bench_data_uri
+    python -m benchmarks.bench_data_uri --sizes 4096x3072 --skip-endpoints
+"""
+import argparse
+import base64
+import json
+import time
+
+import stages
+from benchmarks.bench_endpoints import StageCollector
+from benchmarks.images import data_uri, synthetic_image
+from benchmarks.standins import InMemoryS3
+from benchmarks.stats import summarize
+from utils import parse_data_uri
+
+URL_ENDPOINTS = ["/classify-url/", "/detect-url/", "/censor-url/"]
+
+
+def legacy_decode(uri):
+    """
+    The data URI path before single-pass parsing: the payload was split out
+    and base64-decoded once to validate it, then split and decoded again.
+    """
+    mime_type = uri.split(";")[0][5:]
+    if not any(mime_type.endswith(t) for t in ['jpg', 'jpeg', 'png', 'bmp', 'jfif']):
+        return None
+    base64.b64decode(uri.split(",")[1], validate=True)
+    return base64.b64decode(uri.split(",")[1])
+
+
+def time_calls(fn, arg, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn(arg)
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark large data URI decoding.")
+    parser.add_argument("--sizes", default="1024x768,2048x1536,4096x3072", help="Comma separated WIDTHxHEIGHT list.")
+    parser.add_argument("--format", default="bmp", help="Image format, bmp gives the largest payloads.")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--skip-endpoints", action="store_true", help="Only run the parsing micro-benchmark.")
+    parser.add_argument("--output", help="Where to write the JSON results.")
+    args = parser.parse_args(argv)
+
+    sizes = [tuple(int(v) for v in size.split("x")) for size in args.sizes.split(",")]
+    uris = {}
+    for width, height in sizes:
+        uris["{}x{}.{}".format(width, height, args.format)] = data_uri(
+            synthetic_image(width, height, args.format), args.format)
+
+    results = {"parsing": {}, "endpoints": {}}
+    print("{:<20} {:>10} {:>14} {:>14} {:>9}".format("image", "MB", "legacy p50 ms", "single p50 ms", "speedup"))
+    for label, uri in uris.items():
+        legacy = time_calls(legacy_decode, uri, args.iterations)
+        single = time_calls(parse_data_uri, uri, args.iterations)
+        results["parsing"][label] = {"uri_bytes": len(uri), "legacy_ms": legacy, "single_pass_ms": single}
+        print("{:<20} {:>10.1f} {:>14.2f} {:>14.2f} {:>8.2f}x".format(
+            label, len(uri) / 2 ** 20, legacy["p50"], single["p50"],
+            legacy["p50"] / single["p50"] if single["p50"] else 0.0))
+
+    if not args.skip_endpoints:
+        from fastapi.testclient import TestClient
+
+        import main as api
+
+        api.detection_model.s3_client = InMemoryS3()
+        client = TestClient(api.app)
+
+        print("\n{:<16} {:<20} {:>10} {:>10} {:>12}".format("endpoint", "image", "p50 ms", "p95 ms", "decode ms"))
+        for endpoint in URL_ENDPOINTS:
+            for label, uri in uris.items():
+                collector = StageCollector()
+                latencies = []
+                stages.add_observer(collector)
+                try:
+                    for _ in range(args.iterations):
+                        start = time.perf_counter()
+                        client.post(endpoint, json=[{"source": uri}])
+                        latencies.append(time.perf_counter() - start)
+                finally:
+                    stages.remove_observer(collector)
+                latency = summarize(latencies)
+                stage_summary = collector.summary()
+                results["endpoints"].setdefault(endpoint, {})[label] = {
+                    "latency_ms": latency, "stages_ms": stage_summary}
+                print("{:<16} {:<20} {:>10.1f} {:>10.1f} {:>12.2f}".format(
+                    endpoint, label, latency["p50"], latency["p95"],
+                    stage_summary.get("decode", {}).get("p50", 0.0)))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark of the per-image cost of the TFLite detector against batch size.
+
+Prepares synthetic images once, then times NudenyDetect.invoke_batch with
+interpreters resized to every batch size on CPU. Allocating an interpreter
+is done before timing starts.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_detect_batch
+    python -m benchmarks.bench_detect_batch --batch-sizes 1,4,16 --iterations 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.images import synthetic_image
+from benchmarks.stats import summarize
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark batched detection on CPU.")
+    parser.add_argument("--batch-sizes", default="1,2,4,8,16", help="Comma separated batch sizes.")
+    parser.add_argument("--iterations", type=int, default=10, help="Timed invocations per batch size.")
+    parser.add_argument("--size", default="1024x768", help="WIDTHxHEIGHT of the synthetic images.")
+    parser.add_argument("--output", help="Where to write the JSON results.")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.batch_sizes.split(",")]
+    width, height = (int(v) for v in args.size.split("x"))
+
+    # Imported late so that --help works without loading the model.
+    from detect import NudenyDetect, batch_sizes
+
+    detector = NudenyDetect()
+    inputs = []
+    for seed in range(max(sizes)):
+        image = cv2.imdecode(np.frombuffer(synthetic_image(width, height, seed=seed), np.uint8), cv2.IMREAD_COLOR)
+        inputs.append(detector.prepare(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)))
+
+    results = {"threads": os.cpu_count(), "batches": {}}
+    print("{:>6} {:>12} {:>14} {:>10} {:>9}".format("batch", "p50 ms", "per image ms", "img/s", "speedup"))
+    baseline = None
+    for size in sizes:
+        detector.batch_sizes = batch_sizes(size)
+        batch = inputs[:size]
+        # Allocates the interpreter of this batch size.
+        detector.invoke_batch(batch)
+        if detector.batch_sizes == [1] and size > 1:
+            print("The model only runs one image per invocation, batch {} ran image by image.".format(size),
+                  file=sys.stderr)
+
+        timings = []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            detector.invoke_batch(batch)
+            timings.append(time.perf_counter() - start)
+        latency = summarize(timings)
+        per_image = latency["p50"] / size
+        if baseline is None:
+            baseline = per_image
+        results["batches"][size] = {
+            "latency_ms": latency,
+            "per_image_ms": per_image,
+            "batched": detector.batch_sizes != [1] or size == 1
+        }
+        print("{:>6} {:>12.1f} {:>14.2f} {:>10.1f} {:>8.2f}x".format(
+            size, latency["p50"], per_image, 1000 / per_image if per_image else 0.0,
+            baseline / per_image if per_image else 0.0))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Offline benchmark of the six prediction endpoints.
+
+Runs the FastAPI app in-process against synthetic images, a local HTTP
+server standing in for image hosts and an in-memory S3 client, then reports
+per-stage timings and end-to-end latency/throughput for every endpoint.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_endpoints --iterations 20
+    python -m benchmarks.bench_endpoints --baseline benchmarks/results/<old>.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+from fastapi.testclient import TestClient
+
+import stages
+from benchmarks.images import CONTENT_TYPES, FORMATS, SIZES, data_uri, synthetic_image
+from benchmarks.standins import InMemoryS3, LocalImageServer, Route
+from benchmarks.stats import summarize
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+FILE_ENDPOINTS = ["/classify/", "/detect/", "/censor/"]
+URL_ENDPOINTS = ["/classify-url/", "/detect-url/", "/censor-url/"]
+
+
+class StageCollector:
+    """
+    Stage observer that keeps every timing it receives, grouped by stage.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name, seconds):
+        with self._lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    def summary(self):
+        return {
+            name: dict(summarize(self.timings[name]), total=sum(self.timings[name]) * 1000.0)
+            for name in stages.STAGES if name in self.timings
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def build_cases(sizes, formats, server, batch=1):
+    """
+    Builds one request body per image size and format, with `batch`
+    distinct images each. Identical images in a request would be predicted
+    once, since predictions of the same content are coalesced.
+
+    Returns:
+        list: (label, format, images) tuples, images being (image bytes,
+        URL, data URI) tuples.
+    """
+    cases = []
+    for index, (width, height) in enumerate(sizes):
+        for fmt in formats:
+            images = []
+            for slot in range(batch):
+                seed = index * batch + slot
+                data = synthetic_image(width, height, fmt, seed=seed)
+                path = "/img-{}x{}-{}.{}".format(width, height, seed, fmt)
+                server.routes[path] = Route(data, CONTENT_TYPES[fmt])
+                images.append((data, server.url(path), data_uri(data, fmt)))
+            cases.append(("{}x{}.{}".format(width, height, fmt), fmt, images))
+    return cases
+
+
+def run_endpoint(client, endpoint, cases, iterations, use_data_uri=False):
+    """
+    Sends `iterations` requests per case to one endpoint.
+
+    Returns:
+        dict: Latency, throughput and stage statistics.
+    """
+    collector = StageCollector()
+    latencies = []
+    errors = 0
+    images = 0
+
+    stages.add_observer(collector)
+    started = time.perf_counter()
+    try:
+        for label, fmt, case_images in cases:
+            for _ in range(iterations):
+                if endpoint in FILE_ENDPOINTS:
+                    files = [("files", ("{}-{}".format(i, label), data, CONTENT_TYPES[fmt]))
+                             for i, (data, _, _) in enumerate(case_images)]
+                    request_start = time.perf_counter()
+                    response = client.post(endpoint, files=files)
+                else:
+                    sources = [{"source": uri if use_data_uri else url} for _, url, uri in case_images]
+                    request_start = time.perf_counter()
+                    response = client.post(endpoint, json=sources)
+                latencies.append(time.perf_counter() - request_start)
+                images += len(case_images)
+                if response.status_code != 200:
+                    errors += 1
+    finally:
+        stages.remove_observer(collector)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "images": images,
+        "errors": errors,
+        "latency_ms": summarize(latencies),
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "throughput_images_per_sec": images / elapsed if elapsed else 0.0,
+        "stages_ms": collector.summary()
+    }
+
+
+def compare(results, baseline):
+    """
+    Prints latency deltas against a previous results file.
+    """
+    print("\n{:<28} {:>12} {:>12} {:>12}".format("endpoint", "p50 delta", "p95 delta", "p99 delta"))
+    for name, current in results["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if previous is None:
+            continue
+        deltas = []
+        for key in ("p50", "p95", "p99"):
+            before = previous["latency_ms"][key]
+            after = current["latency_ms"][key]
+            deltas.append("{:+.1f}%".format((after - before) / before * 100) if before else "n/a")
+        print("{:<28} {:>12} {:>12} {:>12}".format(name, *deltas))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the Nudeny API endpoints.")
+    parser.add_argument("--iterations", type=int, default=10, help="Requests per endpoint, size and format.")
+    parser.add_argument("--batch", type=int, default=1, help="Images per request.")
+    parser.add_argument("--sizes", default=",".join("{}x{}".format(w, h) for w, h in SIZES),
+                        help="Comma separated WIDTHxHEIGHT list.")
+    parser.add_argument("--formats", default=",".join(FORMATS), help="Comma separated list of jpg, png, bmp.")
+    parser.add_argument("--endpoints", default=",".join(FILE_ENDPOINTS + URL_ENDPOINTS),
+                        help="Comma separated endpoints to run.")
+    parser.add_argument("--url-cache", action="store_true",
+                        help="Keep the URL prediction cache on; repeated URLs then only measure cache hits.")
+    parser.add_argument("--output", help="Where to write the JSON results.")
+    parser.add_argument("--baseline", help="Previous results file to compare against.")
+    args = parser.parse_args(argv)
+
+    sizes = [tuple(int(v) for v in size.split("x")) for size in args.sizes.split(",")]
+    formats = args.formats.split(",")
+    endpoints = args.endpoints.split(",")
+
+    # Imported late so that --help works without loading the models.
+    import main as api
+    from url_cache import url_cache
+
+    api.detection_model.s3_client = InMemoryS3()
+    if not args.url_cache:
+        url_cache.ttl = 0
+    client = TestClient(api.app)
+
+    results = {
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {
+            "iterations": args.iterations,
+            "batch": args.batch,
+            "sizes": ["{}x{}".format(w, h) for w, h in sizes],
+            "formats": formats,
+            "url_cache": args.url_cache
+        },
+        "endpoints": {}
+    }
+
+    with LocalImageServer() as server:
+        cases = build_cases(sizes, formats, server, args.batch)
+        for endpoint in endpoints:
+            print("Benchmarking {} ...".format(endpoint), file=sys.stderr)
+            results["endpoints"][endpoint] = run_endpoint(client, endpoint, cases, args.iterations)
+            if endpoint in URL_ENDPOINTS:
+                name = endpoint + " (data URI)"
+                print("Benchmarking {} ...".format(name), file=sys.stderr)
+                results["endpoints"][name] = run_endpoint(
+                    client, endpoint, cases, args.iterations, use_data_uri=True)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, "bench-{}.json".format(
+            datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")))
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print("\n{:<28} {:>8} {:>10} {:>10} {:>10} {:>10}".format("endpoint", "errors", "p50 ms", "p95 ms", "p99 ms", "img/s"))
+    for name, result in results["endpoints"].items():
+        latency = result["latency_ms"]
+        print("{:<28} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            name, result["errors"], latency["p50"], latency["p95"], latency["p99"],
+            result["throughput_images_per_sec"]))
+    print("\nResults written to {}".format(output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
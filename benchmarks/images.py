@@ -0,0 +1,59 @@
+import base64
+
+import cv2
+import numpy as np
+
+SIZES = [(320, 240), (1280, 720), (3840, 2160)]
+FORMATS = ["jpg", "png", "bmp"]
+
+CONTENT_TYPES = {
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "bmp": "image/bmp"
+}
+
+
+def synthetic_image(width, height, fmt="jpg", seed=0):
+    """
+    Encodes a deterministic synthetic image.
+
+    The picture is a colour gradient with some noise on top so that JPEG and
+    PNG compress it roughly like a photo instead of a flat colour.
+
+    Args:
+        width (int): Image width.
+        height (int): Image height.
+        fmt (str): One of FORMATS.
+        seed (int): Seed of the noise, vary it to get distinct images.
+
+    Returns:
+        bytes: The encoded image.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    img = np.empty((height, width, 3), dtype=np.float32)
+    img[..., 0] = x[np.newaxis, :]
+    img[..., 1] = y[:, np.newaxis]
+    img[..., 2] = (x[np.newaxis, :] + y[:, np.newaxis]) / 2
+    img += rng.normal(0, 12, size=img.shape)
+    img = np.clip(img, 0, 255).astype(np.uint8)
+
+    success, encoded = cv2.imencode("." + fmt, img)
+    if not success:
+        raise Exception("Failed to encode synthetic image")
+    return encoded.tobytes()
+
+
+def data_uri(data, fmt="jpg"):
+    """
+    Wraps encoded image bytes in a base64 data URI.
+
+    Args:
+        data (bytes): Encoded image.
+        fmt (str): One of FORMATS.
+
+    Returns:
+        str: The data URI.
+    """
+    return "data:{};base64,{}".format(CONTENT_TYPES[fmt], base64.b64encode(data).decode("ascii"))
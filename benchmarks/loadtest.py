@@ -0,0 +1,310 @@
+"""
+Open-loop load generator for the Nudeny API.
+
+Requests are fired on a Poisson schedule at the configured rate regardless of
+how quickly earlier ones complete, so queueing inside the worker shows up in
+the latency numbers instead of silently lowering the offered load. Latency is
+measured from the scheduled send time.
+
+By default the app is started in-process with uvicorn, URL sources are served
+by a local HTTP server and censored images go to an in-memory S3 client, so a
+capacity-planning run needs no external services:
+
+    python -m benchmarks.loadtest --rate 20 --duration 60 \\
+        --mix classify=4,detect=2,censor=1,classify-url=1 \\
+        --batch-sizes 1,4,16 --sizes 640x480,1920x1080 --duplicate-ratio 0.3
+
+Use --target to load an already running server instead. Every option can also
+be given in a JSON file passed with --config (keys use underscores).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+import httpx
+import psutil
+
+from benchmarks.images import CONTENT_TYPES, synthetic_image
+from benchmarks.standins import InMemoryS3, LocalImageServer, Route
+from benchmarks.stats import summarize
+
+ENDPOINTS = {
+    "classify": "/classify/",
+    "detect": "/detect/",
+    "censor": "/censor/",
+    "classify-url": "/classify-url/",
+    "detect-url": "/detect-url/",
+    "censor-url": "/censor-url/"
+}
+
+
+class ImagePool:
+    """
+    Pre-encoded images requests are built from.
+
+    With probability `duplicate_ratio` a request image is one of a small hot
+    set shared by all requests, otherwise the next unique image in the pool.
+    """
+
+    def __init__(self, sizes, fmt, unique, duplicate_ratio, server, rng):
+        self.fmt = fmt
+        self.duplicate_ratio = duplicate_ratio
+        self.rng = rng
+        self.hot = []
+        self.unique = []
+        self._next = 0
+
+        seed = 0
+        for width, height in sizes:
+            for index in range(unique + 1):
+                data = synthetic_image(width, height, fmt, seed=seed)
+                path = "/load-{}.{}".format(seed, fmt)
+                server.routes[path] = Route(data, CONTENT_TYPES[fmt])
+                image = ("load-{}.{}".format(seed, fmt), data, server.url(path))
+                if index == 0:
+                    self.hot.append(image)
+                else:
+                    self.unique.append(image)
+                seed += 1
+
+    def pick(self):
+        if not self.unique or self.rng.random() < self.duplicate_ratio:
+            return self.rng.choice(self.hot)
+        image = self.unique[self._next % len(self.unique)]
+        self._next += 1
+        return image
+
+
+class ResourceSampler:
+    """
+    Samples CPU and RSS of the worker process in a background thread.
+    """
+
+    def __init__(self, pid, interval=0.5):
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.cpu = []
+        self.rss = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        self.process.cpu_percent(None)
+        while not self._stop.wait(self.interval):
+            try:
+                self.cpu.append(self.process.cpu_percent(None))
+                self.rss.append(self.process.memory_info().rss)
+            except psutil.Error:
+                return
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self):
+        return {
+            "cpu_percent_mean": sum(self.cpu) / len(self.cpu) if self.cpu else 0.0,
+            "cpu_percent_max": max(self.cpu) if self.cpu else 0.0,
+            "rss_mb_max": max(self.rss) / 2 ** 20 if self.rss else 0.0,
+            "rss_mb_last": self.rss[-1] / 2 ** 20 if self.rss else 0.0
+        }
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError("Unknown endpoint in mix: {}".format(name))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_in_process_app():
+    """
+    Starts main.app with uvicorn on a background thread.
+
+    Returns:
+        uvicorn.Server: The running server.
+        str: Its base URL.
+    """
+    import uvicorn
+
+    import main as api
+
+    api.detection_model.s3_client = InMemoryS3()
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, "http://127.0.0.1:{}".format(port)
+
+
+async def send(client, name, batch, pool, scheduled, results):
+    images = [pool.pick() for _ in range(batch)]
+    endpoint = ENDPOINTS[name]
+    try:
+        if name.endswith("-url"):
+            response = await client.post(endpoint, json=[{"source": url} for _, _, url in images])
+        else:
+            files = [("files", (filename, data, CONTENT_TYPES[pool.fmt])) for filename, data, _ in images]
+            response = await client.post(endpoint, files=files)
+        status = response.status_code
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    results.append((name, batch, status, time.perf_counter() - scheduled))
+
+
+async def generate(base_url, args, pool, rng):
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+    results = []
+    tasks = []
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        start = time.perf_counter()
+        next_at = start
+        while next_at - start < args.duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            name = rng.choices(names, weights)[0]
+            batch = rng.choice(args.batch_sizes)
+            tasks.append(asyncio.create_task(send(client, name, batch, pool, next_at, results)))
+            next_at += rng.expovariate(args.rate)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    return results, elapsed
+
+
+def report(results, elapsed):
+    by_endpoint = {}
+    for name, batch, status, latency in results:
+        by_endpoint.setdefault(name, []).append((batch, status, latency))
+    by_endpoint["all"] = [(batch, status, latency) for _, batch, status, latency in results]
+
+    summary = {}
+    for name, rows in by_endpoint.items():
+        ok = [latency for _, status, latency in rows if status == 200]
+        errors = {}
+        for _, status, _ in rows:
+            if status != 200:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+        summary[name] = {
+            "requests": len(rows),
+            "images": sum(batch for batch, _, _ in rows),
+            "error_rate": (len(rows) - len(ok)) / len(rows) if rows else 0.0,
+            "errors": errors,
+            "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+            "throughput_images_per_sec": sum(batch for batch, status, _ in rows if status == 200) / elapsed if elapsed else 0.0,
+            "latency_ms": summarize(ok)
+        }
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Open-loop load generator for the Nudeny API.")
+    parser.add_argument("--config", help="JSON file with default values for the options below.")
+    parser.add_argument("--target", help="Base URL of a running server. Starts the app in-process when omitted.")
+    parser.add_argument("--worker-pid", type=int, help="PID to sample CPU/RSS from when using --target.")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("classify=1,detect=1,censor=1"),
+                        help="Comma separated endpoint=weight list, e.g. classify=3,censor-url=1.")
+    parser.add_argument("--rate", type=float, default=5.0, help="Mean arrival rate in requests per second.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to generate load for.")
+    parser.add_argument("--batch-sizes", type=lambda v: [int(b) for b in v.split(",")], default=[1],
+                        help="Comma separated images-per-request values, picked uniformly.")
+    parser.add_argument("--sizes", type=lambda v: [tuple(int(d) for d in s.split("x")) for s in v.split(",")],
+                        default=[(640, 480)], help="Comma separated WIDTHxHEIGHT list.")
+    parser.add_argument("--format", default="jpg", choices=sorted(CONTENT_TYPES))
+    parser.add_argument("--unique-images", type=int, default=50, help="Distinct images per size.")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0,
+                        help="Probability that an image is one of the shared hot images.")
+    parser.add_argument("--max-connections", type=int, default=256)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Where to write the JSON report.")
+
+    args, _ = parser.parse_known_args(argv)
+    if args.config:
+        with open(args.config) as f:
+            parser.set_defaults(**json.load(f))
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    server = None
+    with LocalImageServer() as image_server:
+        pool = ImagePool(args.sizes, args.format, args.unique_images, args.duplicate_ratio, image_server, rng)
+
+        if args.target:
+            base_url = args.target
+            pid = args.worker_pid
+        else:
+            server, base_url = start_in_process_app()
+            pid = os.getpid()
+
+        sampler = ResourceSampler(pid) if pid else None
+        if sampler:
+            sampler.start()
+        try:
+            results, elapsed = asyncio.run(generate(base_url, args, pool, rng))
+        finally:
+            if sampler:
+                sampler.stop()
+            if server:
+                server.should_exit = True
+
+    summary = {
+        "config": {
+            "target": args.target or "in-process",
+            "mix": args.mix,
+            "rate": args.rate,
+            "duration": args.duration,
+            "batch_sizes": args.batch_sizes,
+            "sizes": ["{}x{}".format(w, h) for w, h in args.sizes],
+            "format": args.format,
+            "duplicate_ratio": args.duplicate_ratio
+        },
+        "elapsed": elapsed,
+        "endpoints": report(results, elapsed),
+        "worker": sampler.summary() if sampler else None
+    }
+
+    print("{:<14} {:>8} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+        "endpoint", "reqs", "err %", "rps", "p50 ms", "p95 ms", "p99 ms"))
+    for name, row in summary["endpoints"].items():
+        latency = row["latency_ms"]
+        print("{:<14} {:>8} {:>8.1f} {:>9.2f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            name, row["requests"], row["error_rate"] * 100, row["throughput_rps"],
+            latency["p50"], latency["p95"], latency["p99"]))
+    if summary["worker"]:
+        worker = summary["worker"]
+        print("\nworker cpu mean {:.0f}% max {:.0f}%, rss max {:.0f} MB".format(
+            worker["cpu_percent_mean"], worker["cpu_percent_max"], worker["rss_mb_max"]))
+        if not args.target:
+            print("(in-process: the load generator shares this process)", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class InMemoryS3:
+    """
+    Stand-in for the boto3 S3 client used by NudenyDetect.
+
+    Only implements upload_fileobj, which is all the censor endpoints use.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None):
+        data = fileobj.read()
+        if self.delay:
+            time.sleep(self.delay)
+        with self._lock:
+            self.objects[(bucket, key)] = (bytes(data), dict(ExtraArgs or {}))
+
+
+class Route:
+    """
+    A canned response served by LocalImageServer.
+
+    Args:
+        body (bytes): Response body.
+        content_type (str): Value of the Content-Type header.
+        status (int): HTTP status code.
+        delay (float): Seconds to wait before answering.
+        etag (str): ETag to send; a matching If-None-Match gets a 304.
+
+    Attributes:
+        hits (list): Request headers of every request the route answered.
+    """
+
+    def __init__(self, body, content_type="application/octet-stream", status=200, delay=0.0, etag=None):
+        self.body = body
+        self.content_type = content_type
+        self.status = status
+        self.delay = delay
+        self.etag = etag
+        self.hits = []
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def _respond(self, send_body):
+        route = self.server.routes.get(self.path.split("?")[0])
+        if route is None:
+            route = Route(b"", status=404)
+        route.hits.append(dict(self.headers))
+        if route.delay:
+            time.sleep(route.delay)
+
+        if route.etag is not None and self.headers.get("If-None-Match") == route.etag:
+            self.send_response(304)
+            self.send_header("ETag", route.etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(route.status)
+        self.send_header("Content-Type", route.content_type)
+        self.send_header("Content-Length", str(len(route.body)))
+        if route.etag is not None:
+            self.send_header("ETag", route.etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(route.body)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalImageServer:
+    """
+    Serves images over HTTP on 127.0.0.1 so URL endpoints can be exercised
+    without touching external hosts.
+
+    Usage:
+        with LocalImageServer({"/a.jpg": Route(data, "image/jpeg")}) as server:
+            server.url("/a.jpg")
+    """
+
+    def __init__(self, routes=None):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.routes = dict(routes or {})
+        self._thread = None
+
+    @property
+    def routes(self):
+        return self._server.routes
+
+    def url(self, path):
+        host, port = self._server.server_address
+        return "http://{}:{}{}".format(host, port, path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,42 @@
+import math
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of a list of numbers.
+
+    Args:
+        values (list): Samples.
+        q (float): Percentile between 0 and 100.
+
+    Returns:
+        float: The percentile, or 0.0 if there are no samples.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(q / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def summarize(values, scale=1000.0):
+    """
+    Summarizes timing samples given in seconds.
+
+    Args:
+        values (list): Samples in seconds.
+        scale (float): Multiplier applied to every statistic (ms by default).
+
+    Returns:
+        dict: count, mean, p50, p95, p99 and max.
+    """
+    if not values:
+        return {"count": 0, "mean": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) * scale,
+        "p50": percentile(values, 50) * scale,
+        "p95": percentile(values, 95) * scale,
+        "p99": percentile(values, 99) * scale,
+        "max": max(values) * scale
+    }
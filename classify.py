@@ -1,23 +1,73 @@
 import os
+import threading
 import tensorflow as tf
 from tensorflow.keras.models import load_model
 import numpy as np
 
-from PIL import Image
 from io import BytesIO
 
-from utils import is_supported_file_type, is_url_or_data_uri, is_valid_url, is_valid_data_uri
-from utils import download_image_url, decode_data_uri, is_data_uri_image, is_image_url
+from preprocess import open_image, classification_input
+from utils import check_image, is_url_or_data_uri, is_valid_url, parse_data_uri
+from utils import fetch_image_url, read_image_response
+from url_cache import url_cache
+from memory import memory_budget, image_cost
+from stages import stage
 
 
 MODEL_NAME = "nudeny-classifier.hdf5"
 MODEL_DIR = ".\models\classification"
 MODEL_PATH = os.path.join(MODEL_DIR, MODEL_NAME)
 
+# Classes in the order of the model outputs.
+CLASS_NAMES = ["nude", "safe", "sexy"]
+
+
+def class_name(prediction):
+    """
+    Args:
+        prediction (numpy.ndarray): Model output of one image.
+
+    Returns:
+        str: "nude", "sexy" or "safe".
+    """
+    max_index = np.argmax(prediction)
+    if (max_index == 0):
+        return "nude"
+    elif (max_index == 2):
+        return "sexy"
+    return "safe"
+
 
 class NudenyClassify:
     def __init__(self):
         self.model = load_model(MODEL_PATH)
+        # Predictions run in threadpool workers, one at a time.
+        self.lock = threading.Lock()
+
+    def predict_scores(self, inputs):
+        """
+        Runs the model on a batch of prepared images.
+
+        Args:
+            inputs (list): Outputs of preprocess.classification_input.
+
+        Returns:
+            numpy.ndarray: Score of every class in CLASS_NAMES, per image.
+        """
+        with self.lock, stage("inference"):
+            return np.asarray(self.model.predict_on_batch(np.stack(inputs)))
+
+    def predict_batch(self, inputs):
+        """
+        Classifies a batch of prepared images.
+
+        Args:
+            inputs (list): Outputs of preprocess.classification_input.
+
+        Returns:
+            list: Class of every image.
+        """
+        return [class_name(prediction) for prediction in self.predict_scores(inputs)]
 
     def classify(self, file, filename):
         """
@@ -31,21 +81,29 @@ class NudenyClassify:
             dict: Returns a dictionary with filename and 
             prediction class.
         """
-        if not is_supported_file_type(file):
+        with stage("validation"):
+            info, reduction = check_image(file)
+
+        if info is None:
             return {
                 "filename": filename,
                 "class": "invalid"
             }
 
-        img = Image.open(BytesIO(file))
+        with memory_budget.hold(image_cost(info, reduction, "classify")):
+            with stage("decode"):
+                img = open_image(BytesIO(file), info, reduction)
+
+            with stage("resize"):
+                img_input = classification_input(img)
+                resized_img = np.expand_dims(img_input, 0)
+            del img
 
-        if filename.endswith('.png'):
-            img = img.convert('RGB')
+        with self.lock, stage("inference"):
+            prediction = self.model.predict_on_batch(resized_img).flatten()
 
-        img_input = tf.image.resize(img, (224, 224))
-        resized_img = np.expand_dims(img_input, 0)
-        prediction = self.model.predict_on_batch(resized_img).flatten()
-        max_index = np.argmax(prediction)
+        with stage("postprocess"):
+            max_index = np.argmax(prediction)
         if (max_index == 0):
             return {
                 "filename": filename,
@@ -75,52 +133,90 @@ class NudenyClassify:
         """
         source_type = is_url_or_data_uri(source)
         if source_type == "url":
-            if not is_valid_url(source):
+            with stage("validation"):
+                valid = is_valid_url(source)
+            if not valid:
                 return {
                     "source": source,
                     "class": "invalid"
                 }
-            elif not is_image_url(source):
-                return {
+            return url_cache.lookup(
+                ("classify", source),
+                lambda headers: fetch_image_url(source, headers),
+                lambda response: self._classify_response(response, source),
+                lambda: {
                     "source": source,
                     "class": "invalid"
-                }
-            else:
-                bytes_io, type = download_image_url(source)
-                if bytes_io == None and type == None:
-                    return {
-                        "source": source,
-                        "class": "invalid"
-                    } 
-                img = Image.open(bytes_io)
+                })
 
         elif source_type == "data_uri":
-            if not is_data_uri_image(source):
+            with stage("decode"):
+                data, type = parse_data_uri(source)
+            if data is None:
                 return {
                     "source": source,
                     "class": "invalid"
                 }
-            elif not is_valid_data_uri(source):
-                return {
-                    "source": source,
-                    "class": "invalid"
-                }
-            else:
-                bytes_io, type = decode_data_uri(source)
-                img = Image.open(bytes_io)
-        elif source_type == "unknown":
+            # Probed before wrapping, BytesIO shares the bytes until its
+            # buffer is exported.
+            with stage("validation"):
+                info, reduction = check_image(data)
+            return self._classify_source(BytesIO(data), source, info, reduction)
+
+        return {
+            "source": source,
+            "class": "invalid"
+        }
+
+    def _classify_response(self, response, source):
+        """
+        Classifies the image of a successful URL response.
+        """
+        bytes_io, type = read_image_response(response)
+        if bytes_io == None and type == None:
+            return {
+                "source": source,
+                "class": "invalid"
+            }
+        with stage("validation"):
+            info, reduction = check_image(response.content)
+        return self._classify_source(bytes_io, source, info, reduction)
+
+    def _classify_source(self, bytes_io, source, info, reduction):
+        """
+        Classifies the downloaded or decoded image of a source.
+
+        Args:
+            bytes_io (BytesIO): Image file.
+            source (str): Image source.
+            info (ImageInfo): Probed format and dimensions, None when the
+                image failed validation.
+            reduction (int): Decode reduction from check_image.
+
+        Returns:
+            dict: Returns a dictionary with source and 
+            prediction class.
+        """
+        if info is None:
             return {
                 "source": source,
                 "class": "invalid"
             }
 
-        if type == 'png':
-            img = img.convert('RGB')
+        with memory_budget.hold(image_cost(info, reduction, "classify")):
+            with stage("decode"):
+                img = open_image(bytes_io, info, reduction)
+
+            with stage("resize"):
+                img_input = classification_input(img)
+                resized_img = np.expand_dims(img_input, 0)
+            del img
+
+        with self.lock, stage("inference"):
+            prediction = self.model.predict_on_batch(resized_img).flatten()
 
-        img_input = tf.image.resize(img, (224, 224))
-        resized_img = np.expand_dims(img_input, 0)
-        prediction = self.model.predict_on_batch(resized_img).flatten()
-        max_index = np.argmax(prediction)
+        with stage("postprocess"):
+            max_index = np.argmax(prediction)
         if (max_index == 0):
             return {
                 "source": source,
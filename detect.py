@@ -4,21 +4,69 @@ import cv2
 import tensorflow as tf
 from tensorflow.lite.python.interpreter import Interpreter
 import os
-import base64
-import requests
+import threading
+import time
 from dotenv import load_dotenv
 import uuid
 import boto3
-import mimetypes
-import imghdr
 
-from utils import is_supported_file_type, is_url_or_data_uri, is_valid_url, is_valid_data_uri
-from utils import is_data_uri_image, is_image_url
+from preprocess import decode_bgr, detection_input
+from utils import check_image, is_url_or_data_uri, is_valid_url, parse_data_uri
+from utils import fetch_image_url
+from url_cache import url_cache
+from memory import memory_budget, image_cost
+from stages import image, stage
+import metrics
 
 PATH_TO_SAVED_MODEL = ".\models\detection\EfficientDet2.tflite"
 PATH_TO_LABELS = ".\models\detection\labelmap.txt"
 min_conf_threshold = 0.5
 
+# Most images (at least 1) run through the detector in one invocation.
+# Interpreters are allocated for the powers of two up to this size.
+DETECT_BATCH_SIZE = max(1, int(os.environ.get("NUDENY_DETECT_BATCH_SIZE", "8")))
+
+
+def batch_sizes(max_batch_size):
+    """
+    Args:
+        max_batch_size (int): Largest batch.
+
+    Returns:
+        list: Batch sizes interpreters are allocated for, largest first.
+    """
+    sizes = []
+    size = 1
+    while size < max_batch_size:
+        sizes.append(size)
+        size *= 2
+    sizes.append(max(max_batch_size, 1))
+    return sorted(sizes, reverse=True)
+
+
+def scale_detections(detections, factor):
+    """
+    Maps detections on an image decoded at reduced scale back to the
+    coordinates of the full-size image.
+
+    Args:
+        detections (dict): Detections returned by inference.
+        factor (int): Decode reduction of the image.
+
+    Returns:
+        dict: Scaled detections.
+    """
+    if factor == 1:
+        return detections
+    return {
+        name: [
+            dict(exposed, top=exposed["top"] * factor, left=exposed["left"] * factor,
+                 bottom=exposed["bottom"] * factor, right=exposed["right"] * factor)
+            for exposed in parts
+        ]
+        for name, parts in detections.items()
+    }
+
 
 class NudenyDetect:
 
@@ -30,11 +78,19 @@ class NudenyDetect:
         # Load the Tensorflow Lite model into memory
         self.interpreter = Interpreter(model_path=PATH_TO_SAVED_MODEL)
         self.interpreter.allocate_tensors()
+        # The interpreter is not thread-safe and predictions run in
+        # threadpool workers.
+        self.lock = threading.Lock()
 
         # Get model details
         self.input_details = self.interpreter.get_input_details()
 
         self.output_details = self.interpreter.get_output_details()
+
+        # Interpreters resized to a batch of N images, allocated on first
+        # use. Only used under the lock.
+        self.batch_sizes = batch_sizes(DETECT_BATCH_SIZE)
+        self.interpreters = {1: (self.interpreter, self.input_details, self.output_details)}
         self.height = self.input_details[0]['shape'][1]
         self.width = self.input_details[0]['shape'][2]
 
@@ -51,12 +107,138 @@ class NudenyDetect:
         )
         self.s3_client = session.client('s3')
 
-    def inference(self, file):
+    def prepare(self, image_rgb):
+        """
+        Args:
+            image_rgb (numpy.ndarray): Decoded RGB image.
+
+        Returns:
+            numpy.ndarray: Model input of shape 1xHxWx3.
+        """
+        return detection_input(image_rgb, self.width, self.height, self.float_input,
+                               self.input_mean, self.input_std)
+
+    def invoke(self, input_data):
+        """
+        Runs the model on a prepared image.
+
+        Args:
+            input_data (numpy.ndarray): Output of prepare.
+
+        Returns:
+            numpy.ndarray: Boxes, classes and scores of the detected objects.
+        """
+        with self.lock, stage("inference"):
+            return self._invoke([input_data])[0]
+
+    def invoke_batch(self, inputs):
+        """
+        Runs the model on a batch of prepared images, in as few invocations
+        as the allocated batch sizes allow.
+
+        Args:
+            inputs (list): Outputs of prepare.
+
+        Returns:
+            list: Boxes, classes and scores of every image.
+        """
+        outputs = []
+        with self.lock, stage("inference"):
+            while len(outputs) < len(inputs):
+                remaining = len(inputs) - len(outputs)
+                size = next(size for size in self.batch_sizes if size <= remaining)
+                outputs += self._invoke(inputs[len(outputs):len(outputs) + size])
+        return outputs
+
+    def _interpreter(self, batch_size):
+        """
+        Returns the interpreter taking batch_size images, with its input and
+        output details, allocating it on first use.
+        """
+        if batch_size not in self.interpreters:
+            interpreter = Interpreter(model_path=PATH_TO_SAVED_MODEL)
+            input_details = interpreter.get_input_details()
+            interpreter.resize_tensor_input(input_details[0]['index'], [batch_size, self.height, self.width, 3])
+            interpreter.allocate_tensors()
+            self.interpreters[batch_size] = (interpreter, interpreter.get_input_details(),
+                                             interpreter.get_output_details())
+        return self.interpreters[batch_size]
+
+    def _invoke(self, inputs):
+        if len(inputs) > 1:
+            try:
+                interpreter, input_details, output_details = self._interpreter(len(inputs))
+                start = time.perf_counter()
+                interpreter.set_tensor(input_details[0]['index'], np.concatenate(inputs))
+                interpreter.invoke()
+            except (RuntimeError, ValueError):
+                # Models whose detection post-processing op only handles a
+                # single image run one image at a time.
+                metrics.DETECT_BATCH_FALLBACKS.inc()
+                self.interpreters.pop(len(inputs), None)
+                self.batch_sizes = [1]
+                return [output for input_data in inputs for output in self._invoke([input_data])]
+        else:
+            interpreter, input_details, output_details = self.interpreters[1]
+            start = time.perf_counter()
+            # Perform the actual detection by running the model with the image as input
+            interpreter.set_tensor(input_details[0]['index'], inputs[0])
+            interpreter.invoke()
+        metrics.DETECT_BATCH_SIZE.observe(len(inputs))
+        metrics.DETECT_BATCH_LATENCY.labels(str(len(inputs))).observe(time.perf_counter() - start)
+
+        # Retrieve detection results
+        boxes = interpreter.get_tensor(output_details[1]['index'])  # Bounding box coordinates of detected objects
+        classes = interpreter.get_tensor(output_details[3]['index'])  # Class index of detected objects
+        scores = interpreter.get_tensor(output_details[0]['index'])  # Confidence of detected objects
+        return [(boxes[i], classes[i], scores[i]) for i in range(len(inputs))]
+
+    def postprocess(self, boxes, classes, scores, imH, imW):
+        """
+        Turns the model output into detections on an imW x imH image.
+
+        Returns:
+            dict: Detections above min_conf_threshold per exposed part.
+        """
+        with stage("postprocess"):
+            # detections = []
+
+            detections = {
+                "female_breast": [],
+                "female_genitalia": [],
+                "male_genitalia": [],
+                "buttocks": []
+            }
+
+            for i in range(len(scores)):
+                if ((scores[i] > min_conf_threshold) and (scores[i] <= 1.0)):
+                    # Get bounding box coordinates and draw box
+                    # Interpreter can return coordinates that are outside of image dimensions, need to force them to be within image using max() and min()
+                    ymin = int(max(1, (boxes[i][0] * imH)))
+                    xmin = int(max(1, (boxes[i][1] * imW)))
+                    ymax = int(min(imH, (boxes[i][2] * imH)))
+                    xmax = int(min(imW, (boxes[i][3] * imW)))
+
+                    object_name = self.labels[int(classes[i])]
+
+                    exposed = {
+                        "confidence_score": scores[i] * 100,
+                        "top": ymin,
+                        "left": xmin,
+                        "bottom": ymax,
+                        "right": xmax
+                    }
+                
+                    detections[object_name].append(exposed)
+        return detections
+
+    def inference(self, file, reduction=1):
         """
         Detect exposed body parts in an image file
 
         Args:
             file (<class 'bytes'>): Image file.
+            reduction (int): Decode the image at 1/reduction scale.
 
         Returns:
             Any: Image with detection
@@ -64,61 +246,66 @@ class NudenyDetect:
         """
 
         # Load image and resize to expected shape [1xHxWx3]
-        img_stream = BytesIO(file)
-        img = cv2.imdecode(np.frombuffer(img_stream.read(), np.uint8), 1)
-        image_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        imH, imW, _ = img.shape
-        image_resized = cv2.resize(image_rgb, (self.width, self.height))
-        input_data = np.expand_dims(image_resized, axis=0)
-
-        # Normalize pixel values if using a floating model (i.e. if model is non-quantized)
-        if self.float_input:
-            input_data = (np.float32(input_data) -
-                          self.input_mean) / self.input_std
-
-        # Perform the actual detection by running the model with the image as input
-        self.interpreter.set_tensor(self.input_details[0]['index'], input_data)
-        self.interpreter.invoke()
+        with stage("decode"):
+            img = decode_bgr(file, reduction)
+            image_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            imH, imW, _ = img.shape
 
-        # Retrieve detection results
-        boxes = self.interpreter.get_tensor(self.output_details[1]['index'])[
-            0]  # Bounding box coordinates of detected objects
-        classes = self.interpreter.get_tensor(self.output_details[3]['index'])[
-            0]  # Class index of detected objects
-        scores = self.interpreter.get_tensor(self.output_details[0]['index'])[
-            0]  # Confidence of detected objects
-
-        # detections = []
-
-        detections = {
-            "female_breast": [],
-            "female_genitalia": [],
-            "male_genitalia": [],
-            "buttocks": []
-        }
+        with stage("resize"):
+            input_data = self.prepare(image_rgb)
 
-        for i in range(len(scores)):
-            if ((scores[i] > min_conf_threshold) and (scores[i] <= 1.0)):
-                # Get bounding box coordinates and draw box
-                # Interpreter can return coordinates that are outside of image dimensions, need to force them to be within image using max() and min()
-                ymin = int(max(1, (boxes[i][0] * imH)))
-                xmin = int(max(1, (boxes[i][1] * imW)))
-                ymax = int(min(imH, (boxes[i][2] * imH)))
-                xmax = int(min(imW, (boxes[i][3] * imW)))
-
-                object_name = self.labels[int(classes[i])]
-
-                exposed = {
-                    "confidence_score": scores[i] * 100,
-                    "top": ymin,
-                    "left": xmin,
-                    "bottom": ymax,
-                    "right": xmax
-                }
-                
-                detections[object_name].append(exposed)
+        boxes, classes, scores = self.invoke(input_data)
 
-        return img.copy(), detections
+        detections = self.postprocess(boxes, classes, scores, imH, imW)
+
+        return img, detections
+
+    def detect_batch(self, files):
+        """
+        Detect exposed body parts in several image files, running the
+        detector on all the valid ones at once.
+
+        Args:
+            files (list): Image file and filename pairs.
+        Returns:
+            list: predictions, in the order of files
+        """
+        predictions = [None] * len(files)
+        prepared = []
+        for i, (file, filename) in enumerate(files):
+            with image(filename):
+                with stage("validation"):
+                    info, reduction = check_image(file)
+
+                if info is None:
+                    predictions[i] = {
+                        "filename": filename,
+                        "exposed_parts": {}
+                    }
+                    continue
+
+                with memory_budget.hold(image_cost(info, reduction, "detect")):
+                    with stage("decode"):
+                        img = decode_bgr(file, reduction)
+                        image_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                        imH, imW, _ = img.shape
+                    with stage("resize"):
+                        prepared.append((i, self.prepare(image_rgb), imH, imW, reduction))
+                    # Only the model input is kept while the other images are decoded.
+                    del img, image_rgb
+
+        if not prepared:
+            return predictions
+
+        with image("batch of {} images".format(len(prepared))):
+            outputs = self.invoke_batch([input_data for _, input_data, _, _, _ in prepared])
+            for (i, _, imH, imW, reduction), (boxes, classes, scores) in zip(prepared, outputs):
+                detections = self.postprocess(boxes, classes, scores, imH, imW)
+                predictions[i] = {
+                    "filename": files[i][1],
+                    "exposed_parts": scale_detections(detections, reduction)
+                }
+        return predictions
 
     def detect(self, file, filename):
         """
@@ -130,17 +317,21 @@ class NudenyDetect:
         Returns:
             dict: predictions
         """
-        if not is_supported_file_type(file):
+        with stage("validation"):
+            info, reduction = check_image(file)
+
+        if info is None:
             return {
                 "filename": filename,
                 "exposed_parts": {}
             }
 
-        _, detections = self.inference(file)
+        with memory_budget.hold(image_cost(info, reduction, "detect")):
+            _, detections = self.inference(file, reduction)
 
         return {
             "filename": filename,
-            "exposed_parts": detections
+            "exposed_parts": scale_detections(detections, reduction)
         }
 
     def detectUrl(self, source):
@@ -154,49 +345,62 @@ class NudenyDetect:
         """
         source_type = is_url_or_data_uri(source)
         if source_type == "url":
-            if not is_valid_url(source):
+            with stage("validation"):
+                valid = is_valid_url(source)
+            if not valid:
                 return {
                     "source": source,
                     "exposed_parts": {}
                 }
-            elif not is_image_url(source):
-                return {
+            return url_cache.lookup(
+                ("detect", source),
+                lambda headers: fetch_image_url(source, headers),
+                lambda response: self._detect_source(response.content, source),
+                lambda: {
                     "source": source,
                     "exposed_parts": {}
-                }
-            else:
-                response = requests.get(source)
-                if response.status_code != 200:
-                    return {
-                        "source": source,
-                        "exposed_parts": {}
-                    }
-                file = response.content
+                })
 
         elif source_type == "data_uri":
-            if not is_data_uri_image(source):
-                return {
-                    "source": source,
-                    "exposed_parts": {}
-                }
-            elif not is_valid_data_uri(source):
+            with stage("decode"):
+                file, _ = parse_data_uri(source)
+            if file is None:
                 return {
                     "source": source,
                     "exposed_parts": {}
                 }
-            else:
-                file = base64.b64decode(source.split(",")[1])
-        elif source_type == "unknown":
+            return self._detect_source(file, source)
+
+        return {
+            "source": source,
+            "exposed_parts": {}
+        }
+
+    def _detect_source(self, file, source):
+        """
+        Detect exposed body parts in the downloaded or decoded image of a source
+
+        Args:
+            file (<class 'bytes'>): Image file.
+            source (str): Image URL or data URI.
+        Returns:
+            dict: predictions
+        """
+        with stage("validation"):
+            info, reduction = check_image(file)
+
+        if info is None:
             return {
                 "source": source,
                 "exposed_parts": {}
             }
 
-        _, detections = self.inference(file)
+        with memory_budget.hold(image_cost(info, reduction, "detect")):
+            _, detections = self.inference(file, reduction)
 
         return {
             "source": source,
-            "exposed_parts": detections
+            "exposed_parts": scale_detections(detections, reduction)
         }
 
     def censor(self, file, filename):
@@ -209,54 +413,64 @@ class NudenyDetect:
         Returns:
             dict: predictions
         """
-        if not is_supported_file_type(file):
+        with stage("validation"):
+            info, reduction = check_image(file)
+
+        if info is None:
             return {
                 "filename": filename,
                 "url": "",
                 "exposed_parts": {}
             }
 
-        censored_image, detections = self.inference(file)
+        with memory_budget.hold(image_cost(info, reduction, "censor")):
+            censored_image, detections = self.inference(file, reduction)
 
-        exposed_count = 0
-        for exposed_part in detections.values():
-            for prediction in exposed_part:
-                exposed_count += 1
-                start_point = (int(prediction['left']) - 20, int(prediction['top']) - 20)
-                end_point = (int(prediction['right']) + 20, int(prediction['bottom']) + 20)
-                censored_image = cv2.rectangle(censored_image, start_point, end_point, (0, 0, 0), -1)
+            with stage("postprocess"):
+                exposed_count = 0
+                for exposed_part in detections.values():
+                    for prediction in exposed_part:
+                        exposed_count += 1
+                        start_point = (int(prediction['left']) - 20, int(prediction['top']) - 20)
+                        end_point = (int(prediction['right']) + 20, int(prediction['bottom']) + 20)
+                        censored_image = cv2.rectangle(censored_image, start_point, end_point, (0, 0, 0), -1)
 
-        if exposed_count == 0:
-            return {
-                "filename": filename,
-                "url": "",
-                "exposed_parts": {}
-            }
+            if exposed_count == 0:
+                return {
+                    "filename": filename,
+                    "url": "",
+                    "exposed_parts": {}
+                }
+
+            # The object name leaves out the client's filename: uploads of the
+            # same image are coalesced and every requester gets this URL.
+            new_filename = str(uuid.uuid4()) + "." + info.format
 
-        new_filename = str(uuid.uuid4()) + "-" + filename
+            # This one is to write into disk and upload to S3 bucket.
+            # For this one create a tmp folder in root dir.
+            # local_path = os.path.join('tmp', new_filename)
+            # cv2.imwrite(local_path, censored_image)
 
-        # This one is to write into disk and upload to S3 bucket.
-        # For this one create a tmp folder in root dir.
-        # local_path = os.path.join('tmp', new_filename)
-        # cv2.imwrite(local_path, censored_image)
+            # with open(local_path, 'rb') as f:
+            #     self.s3_client.upload_file(f, "nudeny-storage", new_filename)
 
-        # with open(local_path, 'rb') as f:
-        #     self.s3_client.upload_file(f, "nudeny-storage", new_filename)
+            # os.remove(local_path)
 
-        # os.remove(local_path)
+            with stage("encode"):
+                image_type = info.format
+                success, encoded_image = cv2.imencode("."+image_type, censored_image)
 
-        image_type = imghdr.what(file="", h=file)
-        success, encoded_image = cv2.imencode("."+image_type, censored_image)
+            if not success:
+                raise Exception("Failed to encode image")
 
-        if not success:
-            raise Exception("Failed to encode image")
-        self.s3_client.upload_fileobj(BytesIO(encoded_image), "nudeny-storage", new_filename, ExtraArgs={
-            'ContentType': 'image/'+image_type})
+            with stage("upload"):
+                self.s3_client.upload_fileobj(BytesIO(encoded_image), "nudeny-storage", new_filename, ExtraArgs={
+                    'ContentType': 'image/'+image_type})
 
         return {
             "filename": filename,
             "url": "https://nudeny-storage.s3.ap-southeast-1.amazonaws.com/{}".format(new_filename),
-            "exposed_parts": detections
+            "exposed_parts": scale_detections(detections, reduction)
         }
     
     def censorUrl(self, source):
@@ -270,82 +484,91 @@ class NudenyDetect:
         """
         source_type = is_url_or_data_uri(source)
         if source_type == "url":
-            if not is_valid_url(source):
+            with stage("validation"):
+                valid = is_valid_url(source)
+            if not valid:
                 return {
                     "source": source,
                     "exposed_parts": {}
                 }
-            elif not is_image_url(source):
-                return {
+            return url_cache.lookup(
+                ("censor", source),
+                lambda headers: fetch_image_url(source, headers),
+                lambda response: self._censor_source(response.content, source),
+                lambda: {
                     "source": source,
                     "exposed_parts": {}
-                }
-            else:
-                response = requests.get(source)
-                if response.status_code != 200:
-                    return {
-                        "source": source,
-                        "exposed_parts": {}
-                    }
-                file = response.content
+                })
 
         elif source_type == "data_uri":
-            if not is_data_uri_image(source):
-                return {
-                    "source": source,
-                    "exposed_parts": {}
-                }
-            elif not is_valid_data_uri(source):
+            with stage("decode"):
+                file, _ = parse_data_uri(source)
+            if file is None:
                 return {
                     "source": source,
                     "exposed_parts": {}
                 }
-            else:
-                file = base64.b64decode(source.split(",")[1])
-        elif source_type == "unknown":
-            return {
-                "source": source,
-                "exposed_parts": {}
-            }
+            return self._censor_source(file, source)
 
-        censored_image, detections = self.inference(file)
+        return {
+            "source": source,
+            "exposed_parts": {}
+        }
 
-        exposed_count = 0
-        for exposed_part in detections.values():
-            for prediction in exposed_part:
-                exposed_count += 1
-                start_point = (int(prediction['left']) - 20, int(prediction['top']) - 20)
-                end_point = (int(prediction['right']) + 20, int(prediction['bottom']) + 20)
-                censored_image = cv2.rectangle(censored_image, start_point, end_point, (0, 0, 0), -1)
+    def _censor_source(self, file, source):
+        """
+        Censor exposed body parts in the downloaded or decoded image of a source
 
-        if exposed_count == 0:
+        Args:
+            file (<class 'bytes'>): Image file.
+            source (str): Image URL or data URI.
+        Returns:
+            dict: predictions
+        """
+        with stage("validation"):
+            info, reduction = check_image(file)
+
+        if info is None:
             return {
                 "source": source,
                 "url": "",
                 "exposed_parts": {}
             }
 
-        image_type = imghdr.what(file="", h=file)
+        with memory_budget.hold(image_cost(info, reduction, "censor")):
+            censored_image, detections = self.inference(file, reduction)
+
+            with stage("postprocess"):
+                exposed_count = 0
+                for exposed_part in detections.values():
+                    for prediction in exposed_part:
+                        exposed_count += 1
+                        start_point = (int(prediction['left']) - 20, int(prediction['top']) - 20)
+                        end_point = (int(prediction['right']) + 20, int(prediction['bottom']) + 20)
+                        censored_image = cv2.rectangle(censored_image, start_point, end_point, (0, 0, 0), -1)
 
-        if image_type == None:
-            content_type = response.headers.get('Content-Type')
-            if content_type is not None:
-                image_type = mimetypes.guess_extension(content_type.split(';')[0])[1:]
-            else:
-                print("Content type not found in headers")
+            if exposed_count == 0:
+                return {
+                    "source": source,
+                    "url": "",
+                    "exposed_parts": {}
+                }
 
-        new_filename = str(uuid.uuid4()) + "." + image_type
-        success, encoded_image = cv2.imencode("."+image_type, censored_image)
+            image_type = info.format
+            new_filename = str(uuid.uuid4()) + "." + image_type
+            with stage("encode"):
+                success, encoded_image = cv2.imencode("."+image_type, censored_image)
 
-        if not success:
-            raise Exception("Failed to encode image")
+            if not success:
+                raise Exception("Failed to encode image")
 
-        self.s3_client.upload_fileobj(BytesIO(encoded_image), "nudeny-storage", new_filename, ExtraArgs={
-            'ContentType': 'image/'+image_type})
+            with stage("upload"):
+                self.s3_client.upload_fileobj(BytesIO(encoded_image), "nudeny-storage", new_filename, ExtraArgs={
+                    'ContentType': 'image/'+image_type})
 
         return {
             "source": source,
             "url": "https://nudeny-storage.s3.ap-southeast-1.amazonaws.com/{}".format(new_filename),
-            "exposed_parts": detections
+            "exposed_parts": scale_detections(detections, reduction)
         }
 
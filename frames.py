@@ -0,0 +1,361 @@
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import metrics
+from classify import CLASS_NAMES
+from memory import image_cost, memory_budget
+from preprocess import classification_input
+from stages import stage
+from utils import MAX_IMAGE_PIXELS, ImageInfo
+
+# Frames sampled per second of the animation or clip when not asked otherwise.
+DEFAULT_FPS = float(os.environ.get("NUDENY_FRAME_FPS", "1"))
+
+# Most frames predicted for a single animation or clip.
+MAX_FRAMES = int(os.environ.get("NUDENY_MAX_FRAMES", "30"))
+
+# Frames predicted per model call.
+FRAME_BATCH_SIZE = int(os.environ.get("NUDENY_FRAME_BATCH_SIZE", "8"))
+
+# Sampled frames whose difference hash is at most this many bits away from
+# the last kept frame are dropped as near-duplicates.
+DHASH_DISTANCE = int(os.environ.get("NUDENY_DHASH_DISTANCE", "4"))
+
+# Score (0-1) of a frame that stops the scan: the "nude" probability when
+# classifying, the confidence of any exposed part when detecting.
+STOP_THRESHOLD = float(os.environ.get("NUDENY_FRAME_STOP_THRESHOLD", "0.8"))
+
+# Videos seek to the next sampled frame, instead of decoding every frame up
+# to it, when it is at least this many frames ahead. 0 never seeks.
+SEEK_FRAMES = int(os.environ.get("NUDENY_FRAME_SEEK_FRAMES", "25"))
+
+# GIF frames without a delay are shown for 100ms by browsers.
+DEFAULT_FRAME_MS = 100
+
+# Formats read with Pillow, anything else is handed to OpenCV as a video.
+PILLOW_SIGNATURES = [b"GIF87a", b"GIF89a", b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"BM"]
+
+SEVERITY = ["safe", "sexy", "nude"]
+
+
+class MediaError(ValueError):
+    """
+    The animation or clip cannot be decoded or is too large.
+    """
+
+
+def dhash(image_rgb):
+    """
+    Difference hash of an image: whether each pixel of a 9x8 grayscale
+    thumbnail is brighter than its left neighbour.
+
+    Args:
+        image_rgb (numpy.ndarray): RGB image.
+
+    Returns:
+        int: 64 bit hash.
+    """
+    gray = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), "big")
+
+
+def _check_size(width, height):
+    if width * height > MAX_IMAGE_PIXELS:
+        raise MediaError("Frames of {}x{} are over the pixel budget.".format(width, height))
+
+
+def _is_pillow(path):
+    with open(path, "rb") as f:
+        head = f.read(16)
+    return any(head.startswith(signature) for signature in PILLOW_SIGNATURES) or (
+        head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+
+
+def _sampled(samples, end, fps):
+    """
+    Whether the next sampling time, after samples were taken, falls before
+    the end of a frame. A time within rounding of the end belongs to the
+    next frame.
+    """
+    return samples / fps < end - 1e-6
+
+
+def _pillow_frames(path, fps):
+    """
+    Frames of an animated GIF, PNG or WebP (or of a still image) covering
+    the sampling times. Pillow has to go through every frame to composite
+    the next one, but only sampled frames are converted to RGB arrays.
+    """
+    try:
+        img = Image.open(path)
+    except (OSError, ValueError) as e:
+        raise MediaError(str(e))
+    with img:
+        _check_size(*img.size)
+        try:
+            # Counting the frames goes through the whole file.
+            n_frames = getattr(img, "n_frames", 1)
+        except (OSError, EOFError, ValueError) as e:
+            raise MediaError(str(e))
+        start_ms = 0
+        samples = 0
+        for index in range(n_frames):
+            try:
+                with stage("decode"):
+                    img.seek(index)
+                end_ms = start_ms + (img.info.get("duration") or DEFAULT_FRAME_MS)
+                image_rgb = None
+                if _sampled(samples, end_ms / 1000, fps):
+                    with stage("decode"):
+                        image_rgb = np.asarray(img.convert("RGB"))
+            except (OSError, EOFError, ValueError) as e:
+                raise MediaError(str(e))
+            if image_rgb is not None:
+                yield index, start_ms / 1000, image_rgb
+                while _sampled(samples, end_ms / 1000, fps):
+                    samples += 1
+            else:
+                metrics.FRAMES.labels("skipped").inc()
+            start_ms = end_ms
+
+
+def _video_frames(path, fps):
+    """
+    Frames of a video covering the sampling times. grab() decodes every
+    frame it passes, retrieve() only converts the sampled ones, so when the
+    next sampled frame is SEEK_FRAMES or more ahead the capture seeks to it
+    instead.
+    """
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            raise MediaError("Unsupported animation or video.")
+        _check_size(int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        source_fps = capture.get(cv2.CAP_PROP_FPS)
+        if not source_fps or source_fps != source_fps or source_fps <= 0:
+            source_fps = 25.0
+
+        index = 0
+        samples = 0
+        seek = SEEK_FRAMES > 0
+        while True:
+            # Frame holding the next sampling time.
+            target = int(samples / fps * source_fps)
+            if seek and target - index >= SEEK_FRAMES:
+                with stage("decode"):
+                    seek = capture.set(cv2.CAP_PROP_POS_FRAMES, target)
+                    position = int(capture.get(cv2.CAP_PROP_POS_FRAMES))
+                if seek:
+                    metrics.FRAMES.labels("skipped").inc(max(position - index, 0))
+                    # A capture that did not move forward is read frame by
+                    # frame from here on.
+                    seek = position > index
+                    index = position
+            with stage("decode"):
+                grabbed = capture.grab()
+            if not grabbed:
+                break
+            end = (index + 1) / source_fps
+            if _sampled(samples, end, fps):
+                with stage("decode"):
+                    retrieved, image_bgr = capture.retrieve()
+                if retrieved:
+                    yield index, index / source_fps, cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+                while _sampled(samples, end, fps):
+                    samples += 1
+            else:
+                metrics.FRAMES.labels("skipped").inc()
+            index += 1
+    finally:
+        capture.release()
+
+
+def _frame_size(path):
+    """
+    Width and height of the frames of an animation or clip, read from its
+    header.
+    """
+    if _is_pillow(path):
+        try:
+            with Image.open(path) as img:
+                size = img.size
+        except (OSError, ValueError) as e:
+            raise MediaError(str(e))
+    else:
+        capture = cv2.VideoCapture(path)
+        try:
+            if not capture.isOpened():
+                raise MediaError("Unsupported animation or video.")
+            size = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        finally:
+            capture.release()
+    _check_size(*size)
+    return size
+
+
+def sample_frames(path, fps=DEFAULT_FPS, distance=DHASH_DISTANCE, counts=None):
+    """
+    Decodes the frames of an animation or clip lazily, at fps frames per
+    second of its timeline, dropping near-duplicates of the last kept frame.
+
+    Args:
+        path (str): Animation or video file.
+        fps (float): Frames sampled per second.
+        distance (int): Largest dHash distance of a dropped frame.
+        counts (dict): Receives the number of "sampled" and "duplicate"
+            frames.
+
+    Yields:
+        int: Frame number.
+        float: Frame time in seconds.
+        numpy.ndarray: RGB frame.
+    """
+    counts = counts if counts is not None else {}
+    counts.setdefault("sampled", 0)
+    counts.setdefault("duplicate", 0)
+    frames = _pillow_frames(path, fps) if _is_pillow(path) else _video_frames(path, fps)
+    last_hash = None
+    for index, time, image_rgb in frames:
+        counts["sampled"] += 1
+        frame_hash = dhash(image_rgb)
+        if last_hash is not None and bin(frame_hash ^ last_hash).count("1") <= distance:
+            counts["duplicate"] += 1
+            metrics.FRAMES.labels("duplicate").inc()
+            continue
+        last_hash = frame_hash
+        yield index, time, image_rgb
+
+
+def _classify_input(model, image_rgb):
+    with stage("resize"):
+        return classification_input(image_rgb)
+
+
+def _detect_input(model, image_rgb):
+    with stage("resize"):
+        return model.prepare(image_rgb)
+
+
+def _classify_batch(model, batch, threshold):
+    results = []
+    for (index, time, _, _), scores in zip(batch, model.predict_scores([data for _, _, data, _ in batch])):
+        scores = {name: round(float(score), 4) for name, score in zip(CLASS_NAMES, scores)}
+        results.append(({
+            "frame": index,
+            "time": round(time, 3),
+            "class": max(scores, key=scores.get),
+            "scores": scores
+        }, scores["nude"] >= threshold))
+    return results
+
+
+def _detect_batch(model, batch, threshold):
+    results = []
+    outputs = model.invoke_batch([data for _, _, data, _ in batch])
+    for (index, time, _, (imH, imW)), (boxes, classes, scores) in zip(batch, outputs):
+        detections = model.postprocess(boxes, classes, scores, imH, imW)
+        hit = any(exposed["confidence_score"] >= threshold * 100
+                  for parts in detections.values() for exposed in parts)
+        results.append(({
+            "frame": index,
+            "time": round(time, 3),
+            "exposed_parts": detections
+        }, hit))
+    return results
+
+
+def _classify_verdict(frames):
+    if not frames:
+        return {"class": "invalid"}
+    return {"class": max((frame["class"] for frame in frames), key=SEVERITY.index)}
+
+
+def _detect_verdict(frames):
+    highest = {}
+    for frame in frames:
+        for name, parts in frame["exposed_parts"].items():
+            for exposed in parts:
+                highest[name] = max(highest.get(name, 0.0), float(exposed["confidence_score"]))
+    return {"exposed": bool(highest), "max_confidence_scores": highest}
+
+
+def predict_frames(path, kind, model, fps=DEFAULT_FPS, max_frames=MAX_FRAMES, threshold=STOP_THRESHOLD,
+                   batch_size=FRAME_BATCH_SIZE):
+    """
+    Classifies or detects the sampled frames of an animation or clip in
+    batches, stopping at the first batch holding a frame that scores at
+    least threshold.
+
+    Each frame is shrunk to the model input as soon as it is decoded, so
+    batches only hold model inputs. The memory of the one full-size frame
+    decoded at a time is held from the memory budget for the whole scan.
+
+    Args:
+        path (str): Animation or video file.
+        kind (str): "classify" or "detect".
+        model (NudenyClassify or NudenyDetect): Model of the kind.
+        fps (float): Frames sampled per second.
+        max_frames (int): Most frames predicted.
+        threshold (float): Score, between 0 and 1, that stops the scan.
+        batch_size (int): Frames per model call.
+
+    Returns:
+        dict: Aggregate verdict, per-frame results and frame counts.
+        "complete" is false and "error" is set when decoding failed, the
+        verdict then only covers the frames before the failure.
+    """
+    prepare = _classify_input if kind == "classify" else _detect_input
+    predict_batch = _classify_batch if kind == "classify" else _detect_batch
+    verdict = _classify_verdict if kind == "classify" else _detect_verdict
+
+    counts = {}
+    results = []
+    stopped_early = False
+    error = None
+    batch = []
+    frames = sample_frames(path, fps, counts=counts)
+    try:
+        width, height = _frame_size(path)
+        with memory_budget.hold(image_cost(ImageInfo("frame", width, height), 1, kind)):
+            while not stopped_early and len(results) < max_frames:
+                frame = next(frames, None)
+                done = frame is None
+                if not done:
+                    index, time, image_rgb = frame
+                    batch.append((index, time, prepare(model, image_rgb), image_rgb.shape[:2]))
+                    # Only the model input is kept.
+                    del frame, image_rgb
+                if batch and (done or len(batch) == batch_size or len(results) + len(batch) == max_frames):
+                    for result, hit in predict_batch(model, batch, threshold):
+                        results.append(result)
+                        stopped_early = stopped_early or hit
+                    metrics.FRAMES.labels("predicted").inc(len(batch))
+                    batch = []
+                if done:
+                    break
+    except MediaError as e:
+        if not results:
+            return dict(verdict([]), complete=False, frames=[], error=str(e))
+        error = str(e)
+    finally:
+        frames.close()
+    if stopped_early:
+        metrics.FRAME_EARLY_EXITS.inc()
+
+    response = verdict(results)
+    response.update({
+        "complete": error is None,
+        "stopped_early": stopped_early,
+        "frames_sampled": counts.get("sampled", 0),
+        "frames_duplicate": counts.get("duplicate", 0),
+        "frames": results
+    })
+    if error is not None:
+        # Frames after a decoding error were not looked at.
+        response["error"] = error
+    return response
+
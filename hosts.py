@@ -0,0 +1,296 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import urlparse
+
+import requests
+
+import metrics
+
+# Seconds a single fetch may take, connecting and reading the body included.
+FETCH_TIMEOUT = float(os.environ.get("NUDENY_FETCH_TIMEOUT", "5"))
+
+# Per-host overrides of FETCH_TIMEOUT, e.g. "cdn.example.com=2,slow.example.org=10".
+FETCH_HOST_TIMEOUTS = os.environ.get("NUDENY_FETCH_HOST_TIMEOUTS", "")
+
+# Seconds all fetches of a single request may take together.
+FETCH_BUDGET = float(os.environ.get("NUDENY_FETCH_BUDGET", "15"))
+
+# Consecutive failures after which a host's circuit opens.
+BREAKER_FAILURES = int(os.environ.get("NUDENY_BREAKER_FAILURES", "5"))
+
+# Seconds an open circuit fails fast before a probe request is let through.
+BREAKER_COOLDOWN = float(os.environ.get("NUDENY_BREAKER_COOLDOWN", "30"))
+
+# Most hosts tracked, least recently used ones are forgotten first.
+MAX_TRACKED_HOSTS = int(os.environ.get("NUDENY_MAX_TRACKED_HOSTS", "1000"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_deadline = ContextVar("fetch_deadline", default=None)
+
+
+class FetchSkipped(requests.RequestException):
+    """
+    A fetch that was not attempted. The host or the URL is not to blame.
+    """
+
+
+class CircuitOpen(FetchSkipped):
+    """
+    The host's circuit is open, the fetch failed fast.
+    """
+
+
+class BudgetExhausted(FetchSkipped):
+    """
+    The request has used up its fetch budget.
+    """
+
+
+def parse_timeouts(value):
+    """
+    Parses a per-host timeout list.
+
+    Args:
+        value (str): Comma separated host=seconds pairs.
+
+    Returns:
+        dict: Timeout in seconds per host.
+    """
+    timeouts = {}
+    for item in value.split(","):
+        host, _, seconds = item.strip().partition("=")
+        if host:
+            timeouts[host.lower()] = float(seconds)
+    return timeouts
+
+
+@contextmanager
+def fetch_budget(seconds=FETCH_BUDGET):
+    """
+    Limits the total time the fetches made inside the block may take.
+
+    Args:
+        seconds (float): Budget of the block, 0 or less for no budget.
+    """
+    if seconds <= 0:
+        yield
+        return
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_budget():
+    """
+    Returns:
+        float: Seconds left in the current fetch budget, None when there is
+        no budget.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+class HostState:
+    """
+    Circuit state and fetch statistics of one host.
+    """
+
+    def __init__(self):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.last_error = None
+
+    def snapshot(self):
+        attempted = self.requests - self.rejected
+        return {
+            "state": self.state,
+            "requests": self.requests,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "consecutive_failures": self.consecutive_failures,
+            "mean_latency_ms": round(self.latency_total / attempted * 1000, 3) if attempted else 0.0,
+            "max_latency_ms": round(self.latency_max * 1000, 3),
+            "last_error": self.last_error
+        }
+
+
+class HostGuard:
+    """
+    Fetches URLs with a per-host timeout and a circuit breaker per host.
+
+    A host that fails BREAKER_FAILURES times in a row, by timing out,
+    refusing connections or answering 5xx/429, has its circuit opened and
+    fetches to it fail fast with CircuitOpen. After the cooldown a single
+    probe fetch is let through (half-open): success closes the circuit,
+    failure opens it for another cooldown.
+
+    Fetches also stay within the budget set by fetch_budget, if any.
+    """
+
+    def __init__(self, timeout=FETCH_TIMEOUT, host_timeouts=FETCH_HOST_TIMEOUTS,
+                 failure_threshold=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN, max_hosts=MAX_TRACKED_HOSTS):
+        self.timeout = timeout
+        self.host_timeouts = parse_timeouts(host_timeouts) if isinstance(host_timeouts, str) else dict(host_timeouts)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def timeout_for(self, host):
+        return self.host_timeouts.get(host, self.timeout)
+
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = HostState()
+            while len(self._hosts) > self.max_hosts:
+                _, evicted = self._hosts.popitem(last=False)
+                if evicted.state != CLOSED:
+                    metrics.OPEN_CIRCUITS.dec()
+        self._hosts.move_to_end(host)
+        return state
+
+    def _acquire(self, host):
+        with self._lock:
+            state = self._host(host)
+            state.requests += 1
+            if state.state == OPEN and time.monotonic() - state.opened_at >= self.cooldown:
+                state.state = HALF_OPEN
+            if state.state == HALF_OPEN and not state.probing:
+                state.probing = True
+                return True
+            if state.state != CLOSED:
+                state.rejected += 1
+                metrics.FETCHES.labels("rejected").inc()
+                raise CircuitOpen("Circuit of {} is open.".format(host))
+            return False
+
+    def _release(self, host, probe, outcome, seconds, error=None):
+        metrics.FETCHES.labels(outcome).inc()
+        metrics.FETCH_LATENCY.observe(seconds)
+        with self._lock:
+            state = self._host(host)
+            if probe:
+                state.probing = False
+            state.latency_total += seconds
+            state.latency_max = max(state.latency_max, seconds)
+            if outcome == "ok":
+                state.consecutive_failures = 0
+                if state.state != CLOSED:
+                    state.state = CLOSED
+                    metrics.OPEN_CIRCUITS.dec()
+                return
+
+            state.failures += 1
+            state.consecutive_failures += 1
+            state.last_error = error
+            if outcome == "timeout":
+                state.timeouts += 1
+            if probe or (state.state == CLOSED and state.consecutive_failures >= self.failure_threshold):
+                if state.state == CLOSED:
+                    metrics.OPEN_CIRCUITS.inc()
+                state.state = OPEN
+                state.opened_at = time.monotonic()
+
+    def request(self, method, url, headers=None):
+        """
+        Sends a request and reads the whole response.
+
+        Args:
+            method (str): "GET" or "HEAD".
+            url (str): URL to fetch.
+            headers (dict): Extra request headers.
+
+        Returns:
+            requests.Response: The response, with its body already read.
+
+        Raises:
+            CircuitOpen: The host's circuit is open.
+            BudgetExhausted: The request's fetch budget is used up.
+            requests.RequestException: The fetch failed or timed out.
+        """
+        host = (urlparse(url).hostname or "").lower()
+        timeout = self.timeout_for(host)
+        remaining = remaining_budget()
+        if remaining is not None:
+            if remaining <= 0:
+                metrics.FETCHES.labels("budget_exhausted").inc()
+                raise BudgetExhausted("Fetch budget exhausted before fetching {}.".format(url))
+            timeout = min(timeout, remaining)
+
+        probe = self._acquire(host)
+        start = time.monotonic()
+        outcome, error = "error", None
+        try:
+            response = requests.request(method, url, headers=headers, timeout=timeout, stream=True)
+            _read_body(response, start + timeout)
+            if response.status_code >= 500 or response.status_code == 429:
+                error = "HTTP {}".format(response.status_code)
+            else:
+                outcome = "ok"
+            return response
+        except requests.Timeout as e:
+            outcome, error = "timeout", type(e).__name__
+            raise
+        except requests.RequestException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self._release(host, probe, outcome, time.monotonic() - start, error)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Circuit state and fetch statistics per host.
+        """
+        with self._lock:
+            return {host: state.snapshot() for host, state in self._hosts.items()}
+
+    def reset(self):
+        with self._lock:
+            for state in self._hosts.values():
+                if state.state != CLOSED:
+                    metrics.OPEN_CIRCUITS.dec()
+            self._hosts.clear()
+
+
+def _read_body(response, deadline):
+    """
+    Reads the body of a streamed response, giving up once the deadline has
+    passed. The deadline is checked between chunks, each chunk is bounded
+    by the read timeout of the request.
+    """
+    chunks = []
+    try:
+        for chunk in response.iter_content(2 ** 16):
+            chunks.append(chunk)
+            if time.monotonic() > deadline:
+                raise requests.Timeout("Timed out reading {}.".format(response.url))
+    except requests.RequestException:
+        response.close()
+        raise
+    response._content = b"".join(chunks)
+
+
+host_guard = HostGuard()
@@ -0,0 +1,494 @@
+import hashlib
+import os
+import tempfile
+
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from multipart.multipart import MultipartParser, parse_options_header
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import MissingError
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+import stages
+from archive import ArchiveError, BLOCK, open_reader
+from utils import probe_image, decode_reduction
+
+# Largest single upload accepted, larger files are answered as invalid.
+MAX_FILE_BYTES = int(os.environ.get("NUDENY_MAX_FILE_BYTES", str(20 * 2 ** 20)))
+
+# Largest request body accepted, larger requests are rejected with 413.
+MAX_REQUEST_BYTES = int(os.environ.get("NUDENY_MAX_REQUEST_BYTES", str(200 * 2 ** 20)))
+
+# Largest uncompressed archive accepted by the archive endpoints.
+MAX_ARCHIVE_BYTES = int(os.environ.get("NUDENY_MAX_ARCHIVE_BYTES", str(2 * 2 ** 30)))
+
+# Most members an archive may hold.
+MAX_ARCHIVE_MEMBERS = int(os.environ.get("NUDENY_MAX_ARCHIVE_MEMBERS", "10000"))
+
+# Largest animation or video accepted by the frame endpoints, it is
+# spooled to a temporary file rather than held in memory.
+MAX_MEDIA_BYTES = int(os.environ.get("NUDENY_MAX_MEDIA_BYTES", str(100 * 2 ** 20)))
+
+# Archive members predicted at once while the rest of the archive streams in.
+ARCHIVE_PIPELINE_DEPTH = int(os.environ.get("NUDENY_ARCHIVE_PIPELINE_DEPTH", "2"))
+
+# Bytes buffered before the image header is first probed.
+SNIFF_BYTES = 32
+
+# Request body schema of the file endpoints, which parse multipart themselves.
+FILES_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["files"],
+                    "properties": {
+                        "files": {"type": "array", "items": {"type": "string", "format": "binary"}}
+                    }
+                }
+            }
+        }
+    }
+}
+
+# Request body schema of the raw endpoints, the image itself.
+RAW_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/octet-stream": {"schema": {"type": "string", "format": "binary"}}}
+    }
+}
+
+# Request body schema of the archive endpoints, a tar, tar.gz or zip.
+ARCHIVE_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            media_type: {"schema": {"type": "string", "format": "binary"}}
+            for media_type in ("application/x-tar", "application/gzip", "application/zip")
+        }
+    }
+}
+
+
+class IngestedFile:
+    """
+    An uploaded file or archive member read by one of the ingest functions.
+
+    Attributes:
+        filename (str): Filename sent by the client, or the member name.
+        data (bytearray): File content, empty when the file was rejected.
+        size (int): Bytes received for this file.
+        info (ImageInfo): Format and dimensions probed from the header.
+        digest (str): SHA-256 of the content, None when the file was rejected.
+        rejected (str): "unsupported", "too_large" or "too_many_pixels",
+        None when accepted.
+    """
+
+    def __init__(self, filename, stats=None):
+        self.filename = filename
+        self.data = b""
+        self.size = 0
+        self.info = None
+        self.digest = None
+        self.rejected = None
+        self._buffer = bytearray()
+        self._hash = hashlib.sha256()
+        self._stats = stats
+
+    def release(self):
+        """
+        Drops the file content once it is no longer needed.
+        """
+        if self._stats is not None:
+            self._stats.buffer(-len(self.data) - len(self._buffer))
+        self.data = b""
+        self._buffer = bytearray()
+
+
+class MediaFile:
+    """
+    An animation or video spooled to disk by ingest_media.
+
+    Attributes:
+        path (str): Temporary file holding the upload.
+        size (int): Bytes received.
+        digest (str): SHA-256 of the content.
+    """
+
+    def __init__(self, path, size, digest):
+        self.path = path
+        self.size = size
+        self.digest = digest
+
+    def remove(self):
+        """
+        Deletes the temporary file.
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class IngestStats:
+    """
+    Memory accounting of one ingested request.
+    """
+
+    def __init__(self):
+        self.received_bytes = 0
+        self.buffered_bytes = 0
+        self.peak_buffered_bytes = 0
+
+    def buffer(self, amount):
+        self.buffered_bytes += amount
+        if self.buffered_bytes > self.peak_buffered_bytes:
+            self.peak_buffered_bytes = self.buffered_bytes
+
+
+class _Collector:
+    """
+    Buffers files that arrive piece by piece.
+
+    The header of every file is probed as soon as it arrives, so
+    unsupported files, oversized files and images declaring more pixels than
+    the budget are dropped before the rest of them is buffered.
+    """
+
+    def __init__(self, max_file_bytes, stats):
+        self.max_file_bytes = max_file_bytes
+        self.stats = stats
+
+    def begin(self, filename):
+        return IngestedFile(filename, self.stats)
+
+    def write(self, file, chunk):
+        file.size += len(chunk)
+        if file.rejected is not None:
+            return
+
+        if file.size > self.max_file_bytes:
+            self.reject(file, "too_large")
+            return
+
+        file._buffer += chunk
+        file._hash.update(chunk)
+        self.stats.buffer(len(chunk))
+        if file.info is None and len(file._buffer) >= SNIFF_BYTES:
+            self._probe(file)
+
+    def _probe(self, file):
+        """
+        Probes the header buffered so far. Undecided until the header is
+        complete, then the file is either kept or rejected.
+        """
+        info = probe_image(file._buffer)
+        if info is None:
+            self.reject(file, "unsupported")
+        elif info.complete:
+            file.info = info
+            if decode_reduction(info) is None:
+                self.reject(file, "too_many_pixels")
+
+    def end(self, file):
+        if file.rejected is not None:
+            return
+        if file.info is None:
+            self._probe(file)
+        if file.rejected is not None:
+            return
+        if file.info is None:
+            # The file ended before its header did.
+            self.reject(file, "unsupported")
+            return
+        file.data = file._buffer
+        file.digest = file._hash.hexdigest()
+        file._buffer = bytearray()
+
+    def reject(self, file, reason):
+        file.rejected = reason
+        file.release()
+        metrics.INGEST_REJECTIONS.labels(reason).inc()
+
+
+class _FilesParser:
+
+    def __init__(self, field, collector):
+        self.field = field
+        self.collector = collector
+        self.files = []
+        self._current = None
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished
+        }
+
+    def on_part_begin(self):
+        self._current = None
+        self._headers = {}
+
+    def on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if options.get(b"name", b"").decode("latin-1") != self.field or b"filename" not in options:
+            return
+        self._current = self.collector.begin(options[b"filename"].decode("utf-8", "replace"))
+        self.files.append(self._current)
+
+    def on_part_data(self, data, start, end):
+        if self._current is not None:
+            self.collector.write(self._current, data[start:end])
+
+    def on_part_end(self):
+        file = self._current
+        self._current = None
+        if file is not None:
+            self.collector.end(file)
+
+
+def _observe(stats):
+    metrics.REQUEST_PEAK_BUFFERED_BYTES.observe(stats.peak_buffered_bytes)
+    stages.note("peak_buffered_bytes", stats.peak_buffered_bytes)
+
+
+def _check_content_length(request, max_bytes):
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail="Request body too large.")
+
+
+def missing_files_error(field="files"):
+    """
+    Returns:
+        RequestValidationError: The same 422 FastAPI answers when a required
+        form field is missing.
+    """
+    return RequestValidationError([ErrorWrapper(MissingError(), loc=("body", field))])
+
+
+async def ingest_files(request, field="files", max_file_bytes=MAX_FILE_BYTES, max_request_bytes=MAX_REQUEST_BYTES):
+    """
+    Streams the multipart body of a request and collects its uploaded files.
+
+    The header of every part is probed as soon as it arrives, so
+    unsupported files, oversized files and images declaring more pixels than
+    the budget are dropped before the rest of them is buffered. Only
+    accepted files are kept in memory.
+
+    Args:
+        request (Request): Incoming multipart/form-data request.
+        field (str): Form field holding the files.
+        max_file_bytes (int): Largest accepted file.
+        max_request_bytes (int): Largest accepted request body.
+
+    Returns:
+        list: IngestedFile for every file part, in upload order.
+        IngestStats: Bytes received and peak bytes buffered.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise missing_files_error(field)
+
+    _check_content_length(request, max_request_bytes)
+
+    stats = IngestStats()
+    handler = _FilesParser(field, _Collector(max_file_bytes, stats))
+    parser = MultipartParser(boundary, handler.callbacks())
+
+    async for chunk in request.stream():
+        stats.received_bytes += len(chunk)
+        if stats.received_bytes > max_request_bytes:
+            raise HTTPException(status_code=413, detail="Request body too large.")
+        parser.write(chunk)
+    parser.finalize()
+
+    if not handler.files:
+        raise missing_files_error(field)
+
+    _observe(stats)
+    return handler.files, stats
+
+
+async def ingest_raw(request, filename, max_file_bytes=MAX_FILE_BYTES):
+    """
+    Streams a request whose body is a single image.
+
+    Reading stops as soon as the header shows the body is not a supported
+    image.
+
+    Args:
+        request (Request): Incoming application/octet-stream request.
+        filename (str): Name the image is reported under.
+        max_file_bytes (int): Largest accepted image, larger bodies are
+            rejected with 413.
+
+    Returns:
+        IngestedFile: The image.
+        IngestStats: Bytes received and peak bytes buffered.
+    """
+    _check_content_length(request, max_file_bytes)
+
+    stats = IngestStats()
+    collector = _Collector(max_file_bytes, stats)
+    file = collector.begin(filename)
+    async for chunk in request.stream():
+        stats.received_bytes += len(chunk)
+        if stats.received_bytes > max_file_bytes:
+            raise HTTPException(status_code=413, detail="Request body too large.")
+        collector.write(file, chunk)
+        if file.rejected is not None:
+            break
+    collector.end(file)
+
+    _observe(stats)
+    return file, stats
+
+
+async def ingest_archive(request, max_file_bytes=MAX_FILE_BYTES, max_archive_bytes=MAX_ARCHIVE_BYTES,
+                         max_members=MAX_ARCHIVE_MEMBERS):
+    """
+    Streams a tar, tar.gz or zip archive and yields its members as soon as
+    each of them has arrived, so they can be predicted while the rest of
+    the archive is still being received. Members go through the same
+    checks as multipart uploads, and each member is only held in memory
+    until it is released. Inflating, parsing and hashing run in the
+    threadpool, since a small compressed archive can expand to gigabytes.
+
+    Args:
+        request (Request): Incoming request with the archive as body.
+        max_file_bytes (int): Largest accepted member.
+        max_archive_bytes (int): Largest accepted uncompressed archive.
+        max_members (int): Most members accepted.
+
+    Yields:
+        IngestedFile: Every regular file of the archive, in archive order.
+        A repeated name gets a #2, #3, ... suffix.
+    """
+    _check_content_length(request, max_archive_bytes)
+
+    stats = IngestStats()
+    collector = _Collector(max_file_bytes, stats)
+    head = bytearray()
+    reader = None
+    members = 0
+    names = {}
+
+    async def chunks():
+        async for chunk in request.stream():
+            stats.received_bytes += len(chunk)
+            if stats.received_bytes > max_archive_bytes:
+                raise HTTPException(status_code=413, detail="Archive too large.")
+            yield chunk
+
+    def accept(files):
+        nonlocal members
+        members += len(files)
+        if members > max_members:
+            raise HTTPException(status_code=413, detail="Too many members in the archive.")
+        if reader.size > max_archive_bytes:
+            raise HTTPException(status_code=413, detail="Archive too large.")
+        for file in files:
+            # Tar and zip both allow a name to repeat, later ones are
+            # reported as name#2, name#3, ...
+            name = file.filename
+            count = names.get(name, 0)
+            while file.filename in names:
+                count += 1
+                file.filename = "{}#{}".format(name, count)
+            names[name] = max(count, 1)
+            names.setdefault(file.filename, 1)
+        return files
+
+    try:
+        async for chunk in chunks():
+            if reader is None:
+                # Buffer enough of the archive to recognize its format.
+                head += chunk
+                if len(head) < BLOCK:
+                    continue
+                reader = open_reader(head, collector)
+                if reader is None:
+                    break
+                chunk, head = head, None
+            for file in accept(await run_in_threadpool(reader.feed, chunk)):
+                yield file
+            if reader.done:
+                break
+
+        if reader is None and head:
+            reader = open_reader(head, collector)
+            if reader is not None:
+                for file in accept(await run_in_threadpool(reader.feed, head)):
+                    yield file
+        if reader is None:
+            raise HTTPException(status_code=415, detail="Expected a tar, tar.gz or zip archive.")
+        for file in accept(await run_in_threadpool(reader.close)):
+            yield file
+    except ArchiveError as e:
+        raise HTTPException(status_code=400, detail="Invalid archive: {}".format(e))
+
+    _observe(stats)
+
+
+async def ingest_media(request, max_bytes=MAX_MEDIA_BYTES):
+    """
+    Streams a request whose body is an animation or video to a temporary
+    file, since decoders need to seek through it.
+
+    Args:
+        request (Request): Incoming application/octet-stream request.
+        max_bytes (int): Largest accepted body, larger bodies are rejected
+            with 413.
+
+    Returns:
+        MediaFile: The spooled upload, to be removed by the caller.
+    """
+    _check_content_length(request, max_bytes)
+
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(prefix="nudeny-", delete=False) as f:
+        media = MediaFile(f.name, 0, None)
+        try:
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail="Request body too large.")
+                digest.update(chunk)
+                f.write(chunk)
+        except BaseException:
+            f.close()
+            media.remove()
+            raise
+
+    if not size:
+        media.remove()
+        raise HTTPException(status_code=400, detail="Empty request body.")
+    media.size = size
+    media.digest = digest.hexdigest()
+    return media
@@ -1,8 +1,12 @@
-from fastapi import FastAPI, UploadFile, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Response, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from typing import List
 from pydantic import BaseModel
 import concurrent.futures
+import asyncio
+import math
 
 from fastapi import FastAPI
 from slowapi import Limiter, _rate_limit_exceeded_handler
@@ -10,12 +14,28 @@ from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
 from classify import NudenyClassify
-from detect import NudenyDetect
+from detect import NudenyDetect, DETECT_BATCH_SIZE
+from admin import require_admin
+from admission import AdmissionControl, RATE_LIMIT_STORAGE_URI
+from ingest import ingest_files, ingest_raw, ingest_archive, FILES_OPENAPI, RAW_OPENAPI, ARCHIVE_OPENAPI
+from ingest import ARCHIVE_PIPELINE_DEPTH, ingest_media
+from frames import DEFAULT_FPS, MAX_FRAMES, STOP_THRESHOLD, predict_frames
+from singleflight import SingleFlight
+from hosts import host_guard, fetch_budget
+from memory import memory_budget
+from tracing import TraceMiddleware
+import metrics
+import profiler
+import stages
 
-classification_model = NudenyClassify()
-detection_model = NudenyDetect()
+with metrics.time_model_load("classification"):
+    classification_model = NudenyClassify()
+with metrics.time_model_load("detection"):
+    detection_model = NudenyDetect()
 
-limiter = Limiter(key_func=get_remote_address)
+limiter = Limiter(key_func=get_remote_address, storage_uri=RATE_LIMIT_STORAGE_URI)
+admission_control = AdmissionControl()
+single_flight = SingleFlight()
 app = FastAPI()
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
@@ -27,17 +47,191 @@ app.add_middleware(
     allow_origins=origins,
     allow_methods=methods,
 )
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(TraceMiddleware)
 
 class Image(BaseModel):
     source: str
 
-@app.post("/classify/")
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Expose Prometheus metrics.
+    """
+    payload, content_type = metrics.render()
+    return Response(content=payload, media_type=content_type)
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+async def get_profile(seconds: float = 10, interval: float = 0.01):
+    """
+    Sample the worker's stacks and return them as collapsed stacks
+    for flame-graph tools.
+    """
+    # Written so that NaN fails the check too.
+    if not (0 < seconds < math.inf and 0 < interval < math.inf):
+        raise HTTPException(status_code=400, detail="seconds and interval must be positive.")
+    sampler = await run_in_threadpool(profiler.profile, seconds, interval)
+    if sampler is None:
+        raise HTTPException(status_code=409, detail="A profile is already running.")
+    return PlainTextResponse(sampler.folded())
+
+@app.get("/admin/hosts", dependencies=[Depends(require_admin)])
+async def get_hosts():
+    """
+    Circuit state, failures and fetch latency of every image host
+    this worker fetched from.
+    """
+    return host_guard.stats()
+
+@app.get("/admin/memory", dependencies=[Depends(require_admin)])
+async def get_memory():
+    """
+    Capacity, current and peak usage of this worker's memory budget
+    for decoded images.
+    """
+    return memory_budget.stats()
+
+def source_label(source):
+    """
+    Shortens data URIs so they can be used as a trace label.
+    """
+    return source if len(source) <= 100 else source[:100] + "..."
+
+def prediction_response(predictions):
+    """
+    Wrap predictions in the response body, adding the timing breakdown
+    when the request is traced.
+    """
+    response = {"Prediction": predictions}
+    trace = stages.current_trace()
+    if trace is not None:
+        response["Trace"] = trace.breakdown()
+    return response
+
+async def predict_file(file, kind, predict):
+    """
+    Run predict(file, filename) on an ingested file and release it. Uploads
+    with the same content as one already being predicted wait for that
+    prediction.
+    """
+    with stages.image(file.filename):
+        if file.digest is None:
+            prediction = predict(file.data, file.filename)
+        else:
+            prediction = await single_flight.do((kind, file.digest), predict, file.data, file.filename)
+            prediction["filename"] = file.filename
+    file.release()
+    return prediction
+
+async def predict_files(files, kind, predict):
+    """
+    Run predict(file, filename) on every ingested file, releasing each
+    file as soon as its prediction is done.
+    """
+    predictions = []
+    for file in files:
+        predictions.append(await predict_file(file, kind, predict))
+    return prediction_response(predictions)
+
+async def predict_file_batches(files, kind, predict, predict_batch, batch_size):
+    """
+    Run predict_batch([(file, filename), ...]) on the accepted files,
+    batch_size of them at a time, and predict(file, filename) on the
+    rejected ones. Uploads with the same content as one already being
+    predicted wait for that prediction. Files are released batch by batch.
+    """
+    predictions = [None] * len(files)
+    accepted = []
+    for i, file in enumerate(files):
+        if file.digest is None:
+            predictions[i] = await predict_file(file, kind, predict)
+        else:
+            accepted.append(i)
+
+    for start in range(0, len(accepted), batch_size):
+        batch = accepted[start:start + batch_size]
+        results = await single_flight.do_batch(
+            [(kind, files[i].digest) for i in batch], predict_batch,
+            [(files[i].data, files[i].filename) for i in batch])
+        for i, prediction in zip(batch, results):
+            prediction["filename"] = files[i].filename
+            files[i].release()
+            predictions[i] = prediction
+    return prediction_response(predictions)
+
+async def predict_archive(request, kind, predict):
+    """
+    Run predict(file, filename) on every member of the archive in the
+    request body while it streams in, keeping up to ARCHIVE_PIPELINE_DEPTH
+    members in flight. Every member is admitted on its own since their
+    number is only known at the end.
+    """
+    client = get_remote_address(request)
+    admission_control.check_capacity()
+
+    async def predict_member(file):
+        with admission_control.admit(client, kind, 1):
+            return await predict_file(file, kind, predict)
+
+    predictions = {}
+    pending = []
+    try:
+        async for file in ingest_archive(request):
+            if len(pending) >= ARCHIVE_PIPELINE_DEPTH:
+                name, task = pending.pop(0)
+                predictions[name] = await task
+            pending.append((file.filename, asyncio.ensure_future(predict_member(file))))
+        for name, task in pending:
+            predictions[name] = await task
+    finally:
+        for _, task in pending:
+            task.cancel()
+    metrics.IMAGES_PER_REQUEST.labels("/{}-archive/".format(kind)).observe(len(predictions))
+    return prediction_response(predictions)
+
+async def predict_sources(images, kind, predict):
+    """
+    Run predict(source) on every image source. Sources already being
+    predicted wait for that prediction. All URL fetches of the request
+    share one fetch budget.
+    """
+    predictions = []
+    with fetch_budget():
+        for image in images:
+            with stages.image(source_label(image.source)):
+                predictions.append(await single_flight.do((kind, image.source), predict, image.source))
+    return prediction_response(predictions)
+
+async def predict_media(request, kind, model, filename, fps, max_frames, threshold):
+    """
+    Sample the frames of the animation or video in the request body and
+    predict them in batches. The same upload with the same parameters
+    waits for a prediction already running.
+    """
+    if fps <= 0 or max_frames <= 0 or not 0 < threshold <= 1:
+        raise HTTPException(status_code=400, detail="fps and max_frames must be positive, threshold within (0, 1].")
+    admission_control.check_capacity()
+    media = await ingest_media(request)
+    try:
+        with admission_control.admit(get_remote_address(request), kind, max_frames), stages.image(filename):
+            prediction = await single_flight.do((kind + "-frames", media.digest, fps, max_frames, threshold),
+                                                predict_frames, media.path, kind, model, fps, max_frames, threshold)
+    finally:
+        media.remove()
+    prediction["filename"] = filename
+    return prediction_response([prediction])
+
+@app.post("/classify/", openapi_extra=FILES_OPENAPI)
 @limiter.limit("30000/minute")
-async def create_upload_files(request: Request, files: List[UploadFile]):
+async def create_upload_files(request: Request):
     """
     Receive image file request.
     """
-    return {"Prediction": [classification_model.classify(await file.read(), file.filename) for file in files]}
+    admission_control.check_capacity()
+    files, _ = await ingest_files(request)
+    metrics.IMAGES_PER_REQUEST.labels("/classify/").observe(len(files))
+    with admission_control.admit(get_remote_address(request), "classify", len(files)):
+        return await predict_files(files, "classify", classification_model.classify)
 
 @app.post("/classify-url/")
 @limiter.limit("30000/minute")
@@ -47,19 +241,57 @@ async def create_item(request: Request, images: List[Image]):
     """
     if len(images) == 0:
         raise HTTPException(status_code=400, detail="No source(s) provided.")
+    metrics.IMAGES_PER_REQUEST.labels("/classify-url/").observe(len(images))
     # with concurrent.futures.ThreadPoolExecutor() as executor:
     #     results = list(executor.map(classification_model.classifyUrl, [image.source for image in images]))
     
     # return {"Prediction": results}
-    return {"Prediction": [classification_model.classifyUrl(image.source) for image in images]}
+    with admission_control.admit(get_remote_address(request), "classify", len(images)):
+        return await predict_sources(images, "classify", classification_model.classifyUrl)
+
+@app.post("/classify-raw/", openapi_extra=RAW_OPENAPI)
+@limiter.limit("30000/minute")
+async def create_raw_file(request: Request, filename: str = "image"):
+    """
+    Receive a single image as the request body.
+    """
+    admission_control.check_capacity()
+    file, _ = await ingest_raw(request, filename)
+    metrics.IMAGES_PER_REQUEST.labels("/classify-raw/").observe(1)
+    with admission_control.admit(get_remote_address(request), "classify", 1):
+        return prediction_response([await predict_file(file, "classify", classification_model.classify)])
+
+@app.post("/classify-archive/", openapi_extra=ARCHIVE_OPENAPI)
+@limiter.limit("30000/minute")
+async def create_archive(request: Request):
+    """
+    Receive a tar, tar.gz or zip archive of images, predictions are
+    keyed by member name.
+    """
+    return await predict_archive(request, "classify", classification_model.classify)
 
-@app.post("/detect/")
+@app.post("/classify-frames/", openapi_extra=RAW_OPENAPI)
 @limiter.limit("30000/minute")
-async def create_upload_files(request: Request, files: List[UploadFile]):
+async def create_frames(request: Request, filename: str = "clip", fps: float = DEFAULT_FPS,
+                        max_frames: int = MAX_FRAMES, threshold: float = STOP_THRESHOLD):
+    """
+    Receive an animated GIF, PNG, WebP or a video as the request body,
+    classify sampled frames and aggregate them into the worst class.
+    """
+    return await predict_media(request, "classify", classification_model, filename, fps, max_frames, threshold)
+
+@app.post("/detect/", openapi_extra=FILES_OPENAPI)
+@limiter.limit("30000/minute")
+async def create_upload_files(request: Request):
     """
     Receive image file request.
     """
-    return {"Prediction": [detection_model.detect(await file.read(), file.filename) for file in files]}
+    admission_control.check_capacity()
+    files, _ = await ingest_files(request)
+    metrics.IMAGES_PER_REQUEST.labels("/detect/").observe(len(files))
+    with admission_control.admit(get_remote_address(request), "detect", len(files)):
+        return await predict_file_batches(files, "detect", detection_model.detect,
+                                          detection_model.detect_batch, DETECT_BATCH_SIZE)
 
 @app.post("/detect-url/")
 @limiter.limit("30000/minute")
@@ -69,19 +301,57 @@ async def create_item(request: Request, images: List[Image]):
     """
     if len(images) == 0:
         raise HTTPException(status_code=400, detail="No source(s) provided.")
+    metrics.IMAGES_PER_REQUEST.labels("/detect-url/").observe(len(images))
     # with concurrent.futures.ThreadPoolExecutor() as executor:
     #     results = list(executor.map(detection_model.detectUrl, [image.source for image in images]))
     
     # return {"Prediction": results}
-    return {"Prediction": [detection_model.detectUrl(image.source) for image in images]}
+    with admission_control.admit(get_remote_address(request), "detect", len(images)):
+        return await predict_sources(images, "detect", detection_model.detectUrl)
 
-@app.post("/censor/")
+@app.post("/detect-raw/", openapi_extra=RAW_OPENAPI)
 @limiter.limit("30000/minute")
-async def create_upload_files(request: Request, files: List[UploadFile]):
+async def create_raw_file(request: Request, filename: str = "image"):
+    """
+    Receive a single image as the request body.
+    """
+    admission_control.check_capacity()
+    file, _ = await ingest_raw(request, filename)
+    metrics.IMAGES_PER_REQUEST.labels("/detect-raw/").observe(1)
+    with admission_control.admit(get_remote_address(request), "detect", 1):
+        return prediction_response([await predict_file(file, "detect", detection_model.detect)])
+
+@app.post("/detect-archive/", openapi_extra=ARCHIVE_OPENAPI)
+@limiter.limit("30000/minute")
+async def create_archive(request: Request):
+    """
+    Receive a tar, tar.gz or zip archive of images, predictions are
+    keyed by member name.
+    """
+    return await predict_archive(request, "detect", detection_model.detect)
+
+@app.post("/detect-frames/", openapi_extra=RAW_OPENAPI)
+@limiter.limit("30000/minute")
+async def create_frames(request: Request, filename: str = "clip", fps: float = DEFAULT_FPS,
+                        max_frames: int = MAX_FRAMES, threshold: float = STOP_THRESHOLD):
+    """
+    Receive an animated GIF, PNG, WebP or a video as the request body,
+    detect exposed parts on sampled frames and report the highest
+    confidence of every part.
+    """
+    return await predict_media(request, "detect", detection_model, filename, fps, max_frames, threshold)
+
+@app.post("/censor/", openapi_extra=FILES_OPENAPI)
+@limiter.limit("30000/minute")
+async def create_upload_files(request: Request):
     """
     Receive image file request.
     """
-    return {"Prediction": [detection_model.censor(await file.read(), file.filename) for file in files]}
+    admission_control.check_capacity()
+    files, _ = await ingest_files(request)
+    metrics.IMAGES_PER_REQUEST.labels("/censor/").observe(len(files))
+    with admission_control.admit(get_remote_address(request), "censor", len(files)):
+        return await predict_files(files, "censor", detection_model.censor)
 
 @app.post("/censor-url/")
 @limiter.limit("30000/minute")
@@ -91,9 +361,32 @@ async def create_item(request: Request, images: List[Image]):
     """
     if len(images) == 0:
         raise HTTPException(status_code=400, detail="No source(s) provided.")
+    metrics.IMAGES_PER_REQUEST.labels("/censor-url/").observe(len(images))
     # with concurrent.futures.ThreadPoolExecutor() as executor:
     #     results = list(executor.map(detection_model.censorUrl, [image.source for image in images]))
     
     # return {"Prediction": results}
-    return {"Prediction": [detection_model.censorUrl(image.source) for image in images]}
+    with admission_control.admit(get_remote_address(request), "censor", len(images)):
+        return await predict_sources(images, "censor", detection_model.censorUrl)
+
+@app.post("/censor-raw/", openapi_extra=RAW_OPENAPI)
+@limiter.limit("30000/minute")
+async def create_raw_file(request: Request, filename: str = "image"):
+    """
+    Receive a single image as the request body.
+    """
+    admission_control.check_capacity()
+    file, _ = await ingest_raw(request, filename)
+    metrics.IMAGES_PER_REQUEST.labels("/censor-raw/").observe(1)
+    with admission_control.admit(get_remote_address(request), "censor", 1):
+        return prediction_response([await predict_file(file, "censor", detection_model.censor)])
+
+@app.post("/censor-archive/", openapi_extra=ARCHIVE_OPENAPI)
+@limiter.limit("30000/minute")
+async def create_archive(request: Request):
+    """
+    Receive a tar, tar.gz or zip archive of images, predictions are
+    keyed by member name.
+    """
+    return await predict_archive(request, "censor", detection_model.censor)
     
\ No newline at end of file
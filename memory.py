@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+
+import metrics
+import stages
+from admission import OVERLOAD_RETRY_AFTER, parse_costs
+
+# Bytes of decoded images a worker holds at once, 0 disables the budget.
+MEMORY_BUDGET_BYTES = int(os.environ.get("NUDENY_MEMORY_BUDGET_BYTES", str(2 * 2 ** 30)))
+
+# Seconds an image waits for budget to free up before the request is
+# answered with 503.
+MEMORY_WAIT_SECONDS = float(os.environ.get("NUDENY_MEMORY_WAIT_SECONDS", "5"))
+
+# Full-size RGB buffers each endpoint family holds per image: the decoded
+# image and its copies, e.g. the float32 array classification resizes from
+# counts as four.
+DECODE_COPIES = os.environ.get("NUDENY_DECODE_COPIES", "classify=5,detect=2,censor=3")
+
+_copies = parse_costs(DECODE_COPIES)
+
+
+def image_cost(info, reduction, endpoint, copies=None):
+    """
+    Estimates the memory an image takes while it is predicted.
+
+    Args:
+        info (ImageInfo): Probed dimensions.
+        reduction (int): Decode reduction of the image.
+        endpoint (str): Endpoint family, e.g. "censor".
+        copies (dict): Buffers per endpoint family, DECODE_COPIES by default.
+
+    Returns:
+        int: Estimated bytes.
+    """
+    if copies is None:
+        copies = _copies
+    return -(-info.width // reduction) * -(-info.height // reduction) * 3 * copies.get(endpoint, 1)
+
+
+class MemoryBudget:
+    """
+    Bounds the memory a worker spends on decoded images.
+
+    Every image reserves its estimated decoded size before it is decoded
+    and gives it back as soon as its buffers are dropped. Reservations wait
+    for budget to free up, for at most wait seconds, then fail with 503.
+    An image estimated larger than the whole budget waits until it can run
+    alone.
+
+    Reservations are made from threadpool workers, where the decoding
+    happens.
+    """
+
+    def __init__(self, capacity=MEMORY_BUDGET_BYTES, wait=MEMORY_WAIT_SECONDS, retry_after=OVERLOAD_RETRY_AFTER):
+        self.capacity = capacity
+        self.wait = wait
+        self.retry_after = retry_after
+        self.in_use = 0
+        self.peak = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def hold(self, amount):
+        """
+        Holds amount bytes of the budget for the duration of the block.
+
+        Args:
+            amount (int): Estimated bytes, see image_cost.
+        """
+        if not self.capacity:
+            yield 0
+            return
+        amount = min(amount, self.capacity)
+        self._reserve(amount)
+        try:
+            yield amount
+        finally:
+            self._release(amount)
+
+    def _reserve(self, amount):
+        start = time.monotonic()
+        with self._condition:
+            self.waiting += 1
+            try:
+                while self.in_use + amount > self.capacity:
+                    remaining = start + self.wait - time.monotonic()
+                    if remaining <= 0:
+                        metrics.ADMISSION_REJECTIONS.labels("memory").inc()
+                        raise HTTPException(
+                            status_code=503,
+                            detail="Server is busy, retry later.",
+                            headers={"Retry-After": str(self.retry_after)})
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_use += amount
+            self.peak = max(self.peak, self.in_use)
+            metrics.MEMORY_BUDGET_IN_USE.set(self.in_use)
+            metrics.MEMORY_BUDGET_PEAK.set(self.peak)
+
+        waited = time.monotonic() - start
+        metrics.MEMORY_BUDGET_WAIT.observe(waited)
+        trace = stages.current_trace()
+        if trace is not None and waited >= 0.001:
+            trace.notes["memory_wait_ms"] = round(trace.notes.get("memory_wait_ms", 0.0) + waited * 1000, 3)
+
+    def _release(self, amount):
+        with self._condition:
+            self.in_use -= amount
+            metrics.MEMORY_BUDGET_IN_USE.set(self.in_use)
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        Returns:
+            dict: Capacity, current and peak usage in bytes, and the number
+            of images waiting for budget.
+        """
+        with self._condition:
+            return {
+                "capacity_bytes": self.capacity,
+                "in_use_bytes": self.in_use,
+                "peak_bytes": self.peak,
+                "waiting": self.waiting
+            }
+
+
+memory_budget = MemoryBudget()
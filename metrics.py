@@ -0,0 +1,158 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import REGISTRY, generate_latest, multiprocess
+
+import stages
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+IMAGE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+REQUESTS = Counter(
+    "nudeny_requests_total", "HTTP requests handled.", ["endpoint", "status"])
+REQUEST_LATENCY = Histogram(
+    "nudeny_request_duration_seconds", "End-to-end request latency.", ["endpoint"], buckets=LATENCY_BUCKETS)
+IN_FLIGHT = Gauge(
+    "nudeny_requests_in_flight", "Requests currently being handled.", ["endpoint"], multiprocess_mode="livesum")
+STAGE_LATENCY = Histogram(
+    "nudeny_stage_duration_seconds", "Time spent per image in each pipeline stage.", ["endpoint", "stage"],
+    buckets=STAGE_BUCKETS)
+IMAGES_PER_REQUEST = Histogram(
+    "nudeny_images_per_request", "Files or sources sent in a single request.", ["endpoint"], buckets=IMAGE_BUCKETS)
+MODEL_LOAD_SECONDS = Gauge(
+    "nudeny_model_load_seconds", "Time it took to load each model at startup.", ["model"], multiprocess_mode="max")
+ADMISSION_REJECTIONS = Counter(
+    "nudeny_admission_rejections_total", "Requests turned away by admission control.", ["reason"])
+IN_FLIGHT_COST = Gauge(
+    "nudeny_in_flight_cost", "Weighted images currently admitted on this worker.", multiprocess_mode="livesum")
+REQUEST_PEAK_BUFFERED_BYTES = Histogram(
+    "nudeny_request_peak_buffered_bytes", "Peak upload bytes held in memory while ingesting a request.",
+    buckets=(2 ** 16, 2 ** 18, 2 ** 20, 2 ** 22, 2 ** 24, 2 ** 26, 2 ** 28, 2 ** 30))
+INGEST_REJECTIONS = Counter(
+    "nudeny_ingest_rejections_total", "Uploaded files dropped while streaming the request.", ["reason"])
+URL_CACHE_REQUESTS = Counter(
+    "nudeny_url_cache_requests_total", "URL prediction cache lookups by result.", ["result"])
+URL_CACHE_ENTRIES = Gauge(
+    "nudeny_url_cache_entries", "URLs held in the prediction cache.", multiprocess_mode="livesum")
+COALESCED_WORK = Counter(
+    "nudeny_coalesced_work_total", "Images answered by waiting on an identical prediction already running.",
+    ["kind"])
+FETCHES = Counter(
+    "nudeny_fetches_total", "Image URL fetches by outcome.", ["result"])
+FETCH_LATENCY = Histogram(
+    "nudeny_fetch_duration_seconds", "Time spent fetching image URLs.", buckets=LATENCY_BUCKETS)
+FRAMES = Counter(
+    "nudeny_frames_total", "Animation and video frames by what happened to them.", ["result"])
+FRAME_EARLY_EXITS = Counter(
+    "nudeny_frame_early_exits_total", "Animations and videos whose scan stopped at a frame over the threshold.")
+OPEN_CIRCUITS = Gauge(
+    "nudeny_open_circuits", "Image hosts whose circuit is open or half-open.", multiprocess_mode="livesum")
+DETECT_BATCH_SIZE = Histogram(
+    "nudeny_detect_batch_size", "Images per detector invocation.", buckets=(1, 2, 4, 8, 16, 32, 64))
+DETECT_BATCH_LATENCY = Histogram(
+    "nudeny_detect_batch_duration_seconds", "Time of a detector invocation, by images in it.", ["batch_size"],
+    buckets=STAGE_BUCKETS)
+DETECT_BATCH_FALLBACKS = Counter(
+    "nudeny_detect_batch_fallbacks_total",
+    "Batched detector invocations the model rejected, which then ran one image at a time.")
+MEMORY_BUDGET_IN_USE = Gauge(
+    "nudeny_memory_budget_in_use_bytes", "Estimated bytes of decoded images currently held.",
+    multiprocess_mode="livesum")
+MEMORY_BUDGET_PEAK = Gauge(
+    "nudeny_memory_budget_peak_bytes", "Highest memory budget usage of each worker since it started.",
+    multiprocess_mode="liveall")
+MEMORY_BUDGET_WAIT = Histogram(
+    "nudeny_memory_budget_wait_seconds", "Time images waited for memory budget before decoding.",
+    buckets=STAGE_BUCKETS)
+
+_endpoint = ContextVar("metrics_endpoint", default="other")
+
+
+def _observe_stage(name, seconds):
+    STAGE_LATENCY.labels(_endpoint.get(), name).observe(seconds)
+
+
+stages.add_observer(_observe_stage)
+
+
+@contextmanager
+def time_model_load(model):
+    """
+    Records how long the wrapped block took to load a model.
+
+    Args:
+        model (str): Model label, e.g. "classification".
+    """
+    start = time.perf_counter()
+    yield
+    MODEL_LOAD_SECONDS.labels(model).set(time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting requests, in-flight requests and latency per
+    endpoint. Paths that are not routes of the app are reported as "other"
+    so that random URLs cannot blow up label cardinality.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.endpoints = None
+
+    def endpoint_label(self, scope):
+        if self.endpoints is None:
+            self.endpoints = set(route.path for route in scope["app"].routes)
+        path = scope["path"]
+        if path in self.endpoints:
+            return path
+        if path.rstrip("/") + "/" in self.endpoints:
+            return path.rstrip("/") + "/"
+        return "other"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        endpoint = self.endpoint_label(scope)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        token = _endpoint.set(endpoint)
+        in_flight = IN_FLIGHT.labels(endpoint)
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+            REQUESTS.labels(endpoint, str(status["code"])).inc()
+            in_flight.dec()
+            _endpoint.reset(token)
+
+
+def render():
+    """
+    Renders all metrics in the Prometheus text format.
+
+    When PROMETHEUS_MULTIPROC_DIR is set (several uvicorn/gunicorn workers),
+    the values of every worker are aggregated.
+
+    Returns:
+        bytes: Metrics payload.
+        str: Content type of the payload.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
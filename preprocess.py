@@ -0,0 +1,92 @@
+import cv2
+import numpy as np
+from PIL import Image
+
+# Input size of the classification model.
+CLASSIFY_SIZE = (224, 224)
+
+# cv2.imdecode flags decoding a JPEG at 1/1, 1/2, 1/4 and 1/8 scale.
+DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+# Image sizes are checked against utils.MAX_IMAGE_PIXELS from the header
+# before Pillow sees them, and oversized JPEGs are opened in draft mode, so
+# Pillow's own decompression bomb check would only reject those drafts.
+Image.MAX_IMAGE_PIXELS = None
+
+
+def open_image(file, info, reduction):
+    """
+    Decodes an image as RGB.
+
+    Args:
+        file (file-like): Image file.
+        info (ImageInfo): Probed format and dimensions.
+        reduction (int): Scale the image down by this factor while decoding.
+
+    Returns:
+        PIL.Image.Image: Decoded image.
+    """
+    img = Image.open(file)
+    if reduction > 1:
+        img.draft('RGB', (info.width // reduction, info.height // reduction))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.load()
+    return img
+
+
+def classification_input(img):
+    """
+    Resizes a decoded image to the classification model input.
+
+    Bilinear with half-pixel centers and no antialiasing on float pixels,
+    the same as tf.image.resize defaults.
+
+    Args:
+        img (PIL.Image.Image): RGB image.
+
+    Returns:
+        numpy.ndarray: float32 array of shape 224x224x3.
+    """
+    return cv2.resize(np.asarray(img, dtype=np.float32), CLASSIFY_SIZE, interpolation=cv2.INTER_LINEAR)
+
+
+def decode_bgr(file, reduction):
+    """
+    Decodes an image with OpenCV.
+
+    Args:
+        file (<class 'bytes'>): Image file.
+        reduction (int): Decode the image at 1/reduction scale.
+
+    Returns:
+        numpy.ndarray: BGR image, None when it cannot be decoded.
+    """
+    return cv2.imdecode(np.frombuffer(file, np.uint8), DECODE_FLAGS[reduction])
+
+
+def detection_input(image_rgb, width, height, float_input, mean=127.5, std=127.5):
+    """
+    Resizes a decoded image to the detection model input.
+
+    Args:
+        image_rgb (numpy.ndarray): RGB image.
+        width (int): Model input width.
+        height (int): Model input height.
+        float_input (bool): Whether the model takes normalized floats.
+
+    Returns:
+        numpy.ndarray: Input of shape 1xHxWx3.
+    """
+    image_resized = cv2.resize(image_rgb, (width, height))
+    input_data = np.expand_dims(image_resized, axis=0)
+
+    # Normalize pixel values if using a floating model (i.e. if model is non-quantized)
+    if float_input:
+        input_data = (np.float32(input_data) - mean) / std
+    return input_data
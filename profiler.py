@@ -0,0 +1,91 @@
+import math
+import os
+import sys
+import threading
+import time
+
+MAX_PROFILE_SECONDS = 60.0
+MIN_INTERVAL = 0.001
+
+
+class StackSampler:
+    """
+    Samples the Python stacks of every thread of this worker.
+
+    The result is in the folded/collapsed format ("frame;frame;frame count"
+    per line) read by flamegraph.pl, speedscope and most flame-graph viewers.
+    Nothing runs unless a profile is being taken.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = max(interval, MIN_INTERVAL)
+        self.counts = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="nudeny-profiler", daemon=True)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self):
+        """
+        Returns:
+            str: Collapsed stacks, one "stack count" pair per line.
+        """
+        return "".join("{} {}\n".format(stack, count) for stack, count in sorted(self.counts.items()))
+
+
+_profile_lock = threading.Lock()
+
+
+def profile(seconds, interval=0.01):
+    """
+    Samples the worker for a number of seconds.
+
+    Args:
+        seconds (float): How long to sample, capped at MAX_PROFILE_SECONDS.
+        interval (float): Seconds between samples.
+
+    Returns:
+        StackSampler: The finished sampler, or None if another profile is
+        already running.
+
+    Raises:
+        ValueError: seconds or interval is not a positive number.
+    """
+    # Written so that NaN fails the check too.
+    if not (0 < seconds < math.inf and 0 < interval < math.inf):
+        raise ValueError("seconds and interval must be positive")
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    try:
+        sampler = StackSampler(interval)
+        sampler.start()
+        time.sleep(min(seconds, MAX_PROFILE_SECONDS))
+        sampler.stop()
+        return sampler
+    finally:
+        _profile_lock.release()
@@ -0,0 +1,373 @@
+"""
+Offline bulk scan of stored images, without going through the HTTP API.
+
+Scans directory trees and/or a manifest of paths and URLs. Worker
+processes read, hash, decode and resize images, the main process runs the
+models on batches of them and appends one JSON line per image to the
+results file. Progress is checkpointed after every batch, so rerunning
+the same command after a crash resumes where it stopped.
+
+Run from the repository root:
+
+    python scan.py /data/images --output results.jsonl
+    python scan.py --manifest paths.txt --task detect --workers 8 --batch-size 64 \\
+        --skip-results old-results.jsonl --output results.jsonl
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from io import BytesIO
+import multiprocessing
+
+import cv2
+import requests
+
+from preprocess import open_image, classification_input, decode_bgr, detection_input
+from utils import check_image, fetch_url, is_url_or_data_uri
+
+TASKS = {"classify": ["classify"], "detect": ["detect"], "both": ["classify", "detect"]}
+
+OK = "ok"
+SKIPPED = "skipped"
+INVALID = "invalid"
+
+_worker = {}
+
+
+def iter_items(paths, manifest=None):
+    """
+    Lists the images to scan, always in the same order so that a
+    checkpointed position means the same thing when a run is resumed.
+
+    Args:
+        paths (list): Files and directories, directories are walked
+            recursively in sorted order.
+        manifest (str): File with one path or URL per line, blank lines and
+            lines starting with # are ignored.
+
+    Yields:
+        str: Path or URL of every image.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+    if manifest:
+        with open(manifest, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line
+
+
+def load_digests(paths):
+    """
+    Args:
+        paths (list): Results files of previous scans.
+
+    Returns:
+        set: SHA-256 digests of the images they hold.
+    """
+    digests = set()
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    digest = json.loads(line).get("sha256")
+                except ValueError:
+                    # A line cut short by a crash.
+                    continue
+                if digest:
+                    digests.add(bytes.fromhex(digest))
+    return digests
+
+
+def _init_worker(tasks, detection_shape, skip_digests):
+    _worker["tasks"] = tasks
+    _worker["detection_shape"] = detection_shape
+    _worker["skip_digests"] = skip_digests
+
+
+def _read(item):
+    if is_url_or_data_uri(item) == "url":
+        response = fetch_url(item)
+        if response.status_code != 200:
+            raise IOError("HTTP {}".format(response.status_code))
+        return response.content
+    with open(item, "rb") as f:
+        return f.read()
+
+
+def prepare_item(job):
+    """
+    Reads, hashes and decodes one image in a worker process.
+
+    Args:
+        job (tuple): Position and path or URL of the image.
+
+    Returns:
+        tuple: Position, path, hex digest, status and the model inputs per
+        task (or an error message when the image cannot be read).
+    """
+    index, item = job
+    try:
+        data = _read(item)
+    except (OSError, requests.RequestException) as e:
+        return index, item, None, INVALID, str(e) or type(e).__name__
+
+    digest = hashlib.sha256(data).digest()
+    if digest in _worker["skip_digests"]:
+        return index, item, digest.hex(), SKIPPED, None
+
+    info, reduction = check_image(data)
+    if info is None:
+        return index, item, digest.hex(), INVALID, None
+
+    inputs = {}
+    try:
+        if "classify" in _worker["tasks"]:
+            inputs["classify"] = classification_input(open_image(BytesIO(data), info, reduction))
+        if "detect" in _worker["tasks"]:
+            img = decode_bgr(data, reduction)
+            if img is None:
+                raise ValueError("cannot decode image")
+            width, height, float_input = _worker["detection_shape"]
+            image_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            inputs["detect"] = (detection_input(image_rgb, width, height, float_input),
+                                img.shape[0], img.shape[1], reduction)
+    except (OSError, ValueError, cv2.error) as e:
+        return index, item, digest.hex(), INVALID, str(e)
+    return index, item, digest.hex(), OK, inputs
+
+
+class ResultWriter:
+    """
+    Appends results to a JSONL file and checkpoints how far the scan got.
+
+    The checkpoint records the number of items done and the size of the
+    results file at that point. Resuming truncates whatever was written
+    after the last checkpoint, so no result is lost or duplicated.
+
+    Args:
+        path (str): Results file.
+        checkpoint_path (str): Checkpoint file.
+        fingerprint (dict): What is being scanned; a checkpoint taken for
+            something else is refused.
+        overwrite (bool): Whether an existing results file without a
+            checkpoint may be replaced.
+    """
+
+    def __init__(self, path, checkpoint_path, fingerprint, overwrite=False):
+        self.path = path
+        self.checkpoint_path = checkpoint_path
+        self.fingerprint = fingerprint
+        self.done = 0
+
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            if checkpoint["fingerprint"] != fingerprint:
+                raise ValueError("{} belongs to a different scan.".format(checkpoint_path))
+            self.done = checkpoint["done"]
+            self.file = open(path, "r+b")
+            self.file.truncate(checkpoint["offset"])
+            self.file.seek(checkpoint["offset"])
+        elif os.path.exists(path) and not overwrite:
+            raise FileExistsError("{} already exists, pass --overwrite to replace it.".format(path))
+        else:
+            self.file = open(path, "wb")
+            self.commit(0)
+
+    def write(self, record):
+        self.file.write(json.dumps(record, default=float).encode("utf-8") + b"\n")
+
+    def commit(self, done):
+        """
+        Makes the results written so far durable and records that the
+        first done items are finished.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.done = done
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": self.fingerprint, "done": done, "offset": self.file.tell()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def close(self, complete=False):
+        self.file.close()
+        if complete and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+class Progress:
+    """
+    Counts scanned images and reports throughput every interval seconds.
+    """
+
+    def __init__(self, interval, stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.counts = {OK: 0, SKIPPED: 0, INVALID: 0}
+        self.start = self.last_time = time.monotonic()
+        self.last_total = 0
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def add(self, status):
+        self.counts[status] += 1
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_time < self.interval:
+            return
+        total = self.total
+        elapsed = now - self.start
+        recent = (total - self.last_total) / (now - self.last_time) if now > self.last_time else 0.0
+        print("{} images ({} scanned, {} skipped, {} invalid) in {:.0f}s, {:.1f} images/s overall, "
+              "{:.1f} images/s recently".format(
+                  total, self.counts[OK], self.counts[SKIPPED], self.counts[INVALID], elapsed,
+                  total / elapsed if elapsed else 0.0, recent),
+              file=self.stream, flush=True)
+        self.last_time = now
+        self.last_total = total
+
+
+def run_batch(batch, tasks, models, writer):
+    """
+    Runs the models on the images of a batch and writes their results in
+    scan order.
+    """
+    ready = [result for result in batch if result[3] == OK]
+    outputs = {}
+    if ready and "classify" in tasks:
+        outputs["classify"] = models["classify"].predict_batch([result[4]["classify"] for result in ready])
+    if ready and "detect" in tasks:
+        from detect import scale_detections
+
+        detector = models["detect"]
+        raw = detector.invoke_batch([result[4]["detect"][0] for result in ready])
+        outputs["detect"] = [
+            scale_detections(detector.postprocess(boxes, classes, scores, imH, imW), reduction)
+            for (boxes, classes, scores), (_, imH, imW, reduction)
+            in zip(raw, [result[4]["detect"] for result in ready])
+        ]
+
+    position = {id(result): i for i, result in enumerate(ready)}
+    for result in batch:
+        _, item, digest, status, payload = result
+        if status == SKIPPED:
+            continue
+        record = {"path": item, "sha256": digest}
+        if status == OK:
+            i = position[id(result)]
+            if "classify" in tasks:
+                record["class"] = outputs["classify"][i]
+            if "detect" in tasks:
+                record["exposed_parts"] = outputs["detect"][i]
+        else:
+            if "classify" in tasks:
+                record["class"] = "invalid"
+            if "detect" in tasks:
+                record["exposed_parts"] = {}
+            if payload:
+                record["error"] = payload
+        writer.write(record)
+
+
+def load_models(tasks):
+    models = {}
+    if "classify" in tasks:
+        from classify import NudenyClassify
+        models["classify"] = NudenyClassify()
+    if "detect" in tasks:
+        from detect import NudenyDetect
+        models["detect"] = NudenyDetect()
+    return models
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scan stored images offline.")
+    parser.add_argument("paths", nargs="*", help="Image files or directories to scan.")
+    parser.add_argument("--manifest", help="File with one image path or URL per line.")
+    parser.add_argument("--task", choices=sorted(TASKS), default="classify")
+    parser.add_argument("--output", required=True, help="JSONL results file.")
+    parser.add_argument("--checkpoint", help="Checkpoint file, defaults to OUTPUT.checkpoint.")
+    parser.add_argument("--overwrite", action="store_true", help="Replace an existing results file.")
+    parser.add_argument("--skip-results", action="append", default=[], metavar="FILE",
+                        help="Skip images whose hash is in this previous results file, repeatable.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Decode processes.")
+    parser.add_argument("--batch-size", type=int, default=32, help="Images per model call.")
+    parser.add_argument("--chunksize", type=int, default=4, help="Images handed to a worker at once.")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Seconds between progress lines.")
+    args = parser.parse_args(argv)
+
+    if not args.paths and not args.manifest:
+        parser.error("give at least one path or --manifest")
+
+    tasks = TASKS[args.task]
+    fingerprint = {"paths": args.paths, "manifest": args.manifest, "task": args.task}
+    writer = ResultWriter(args.output, args.checkpoint or args.output + ".checkpoint", fingerprint, args.overwrite)
+    if writer.done:
+        print("Resuming after {} images.".format(writer.done), file=sys.stderr)
+
+    skip_digests = load_digests(args.skip_results)
+    models = load_models(tasks)
+    detection_shape = None
+    if "detect" in tasks:
+        detector = models["detect"]
+        detection_shape = (detector.width, detector.height, detector.float_input)
+
+    # Workers only get new images once the ones they decoded are picked up,
+    # so decoded images cannot pile up while the models are busy.
+    slots = threading.BoundedSemaphore(max(args.batch_size, 4 * args.workers * args.chunksize))
+
+    def jobs():
+        for job in itertools.islice(enumerate(iter_items(args.paths, args.manifest)), writer.done, None):
+            slots.acquire()
+            yield job
+
+    progress = Progress(args.report_every)
+    batch = []
+    ready = 0
+    complete = False
+    # Spawned workers do not load the models or TensorFlow.
+    context = multiprocessing.get_context("spawn")
+    try:
+        with context.Pool(args.workers, _init_worker, (tasks, detection_shape, skip_digests)) as pool:
+            for result in pool.imap(prepare_item, jobs(), args.chunksize):
+                slots.release()
+                batch.append(result)
+                progress.add(result[3])
+                if result[3] == OK:
+                    ready += 1
+                # Runs of skipped or invalid images are checkpointed too.
+                if ready >= args.batch_size or len(batch) >= 8 * args.batch_size:
+                    run_batch(batch, tasks, models, writer)
+                    writer.commit(result[0] + 1)
+                    batch, ready = [], 0
+                progress.report()
+            if batch:
+                run_batch(batch, tasks, models, writer)
+                writer.commit(batch[-1][0] + 1)
+        complete = True
+    finally:
+        writer.close(complete)
+        progress.report(force=True)
+
+
+if __name__ == "__main__":
+    main()
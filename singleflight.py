@@ -0,0 +1,121 @@
+import asyncio
+import copy
+
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+import stages
+
+
+class SingleFlight:
+    """
+    Coalesces identical work that is requested concurrently.
+
+    The first caller of a key runs the work in the threadpool. Callers
+    asking for the same key while it runs wait for that run instead of
+    starting their own, and get a copy of its result or its exception.
+    Nothing is kept once the run finishes, repeated work is left to the
+    caches.
+
+    Must only be used from the event loop.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, fn, *args):
+        """
+        Runs fn(*args) in the threadpool unless a run for the same key is
+        already in flight.
+
+        Args:
+            key (tuple): Identity of the work, its first item is the kind of
+                work, e.g. ("detect", sha256).
+            fn (callable): Blocking function computing the result.
+
+        Returns:
+            Any: Result of fn, copied for every caller but the first.
+        """
+        call = self._calls.get(key)
+        if call is not None:
+            self._coalesced(key)
+            # Shielded so that a caller going away does not cancel the run
+            # other callers are waiting for.
+            return copy.deepcopy(await asyncio.shield(call))
+
+        call = asyncio.ensure_future(run_in_threadpool(fn, *args))
+        self._start(key, call)
+        return await asyncio.shield(call)
+
+    async def do_batch(self, keys, fn, items):
+        """
+        Runs fn on the items whose key is not already in flight, in a single
+        threadpool call, and waits for the runs of the others.
+
+        Args:
+            keys (list): Identity of the work of every item.
+            fn (callable): Blocking function taking a list of items and
+                returning the list of their results.
+            items (list): Arguments of the work, one per key.
+
+        Returns:
+            list: Result of every item, in order.
+        """
+        calls = []
+        batch_calls = []
+        batch_items = []
+        for key, item in zip(keys, items):
+            call = self._calls.get(key)
+            if call is not None:
+                self._coalesced(key)
+                calls.append((call, True))
+                continue
+            call = asyncio.get_running_loop().create_future()
+            self._start(key, call)
+            calls.append((call, False))
+            batch_calls.append(call)
+            batch_items.append(item)
+
+        if batch_items:
+            batch = asyncio.ensure_future(run_in_threadpool(fn, batch_items))
+            batch.add_done_callback(lambda _: self._settle(batch, batch_calls))
+
+        results = []
+        for call, coalesced in calls:
+            result = await asyncio.shield(call)
+            results.append(copy.deepcopy(result) if coalesced else result)
+        return results
+
+    def _start(self, key, call):
+        self._calls[key] = call
+        call.add_done_callback(lambda _: self._finish(key, call))
+
+    def _coalesced(self, key):
+        metrics.COALESCED_WORK.labels(key[0]).inc()
+        trace = stages.current_trace()
+        if trace is not None:
+            trace.notes["coalesced_images"] = trace.notes.get("coalesced_images", 0) + 1
+
+    @staticmethod
+    def _settle(batch, calls):
+        """
+        Hands the results, or the failure, of a batch run to the call of
+        every item.
+        """
+        for i, call in enumerate(calls):
+            if batch.cancelled():
+                call.cancel()
+            elif batch.exception() is not None:
+                call.set_exception(batch.exception())
+            else:
+                call.set_result(batch.result()[i])
+
+    def _finish(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.cancelled():
+            # Marks the exception as retrieved when every caller went away.
+            call.exception()
@@ -0,0 +1,179 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Pipeline stages an image goes through, in the order they normally happen.
+STAGES = [
+    "validation",
+    "fetch",
+    "decode",
+    "resize",
+    "inference",
+    "postprocess",
+    "encode",
+    "upload"
+]
+
+_observers = []
+_trace = ContextVar("stage_trace", default=None)
+_image = ContextVar("stage_image", default=None)
+
+
+class Trace:
+    """
+    Stage timings of a single traced request, overall and per image.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.totals = {}
+        self.images = []
+        self.notes = {}
+
+    def add(self, name, seconds, image=None):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        if image is not None:
+            image["stages"][name] = image["stages"].get(name, 0.0) + seconds
+
+    def breakdown(self):
+        """
+        Returns:
+            dict: Total and per-stage milliseconds of the request and of
+            every image it processed.
+        """
+        breakdown = {
+            "total_ms": round((time.perf_counter() - self.start) * 1000, 3),
+            "stages_ms": _to_ms(self.totals),
+            "images": [
+                {"image": image["image"], "stages_ms": _to_ms(image["stages"])}
+                for image in self.images
+            ]
+        }
+        breakdown.update(self.notes)
+        return breakdown
+
+    def server_timing(self):
+        """
+        Returns:
+            str: Value for the Server-Timing response header.
+        """
+        metrics = ["{};dur={:.3f}".format(name, seconds * 1000) for name, seconds in _ordered(self.totals)]
+        metrics.append("total;dur={:.3f}".format((time.perf_counter() - self.start) * 1000))
+        return ", ".join(metrics)
+
+
+def _ordered(timings):
+    return sorted(timings.items(), key=lambda item: STAGES.index(item[0]) if item[0] in STAGES else len(STAGES))
+
+
+def _to_ms(timings):
+    return {name: round(seconds * 1000, 3) for name, seconds in _ordered(timings)}
+
+
+def add_observer(observer):
+    """
+    Registers a callback that receives every finished stage.
+
+    Args:
+        observer (callable): Called as observer(stage_name, seconds).
+    """
+    if observer not in _observers:
+        _observers.append(observer)
+
+
+def remove_observer(observer):
+    """
+    Unregisters a callback added with add_observer.
+
+    Args:
+        observer (callable): Callback to remove.
+    """
+    if observer in _observers:
+        _observers.remove(observer)
+
+
+@contextmanager
+def tracing():
+    """
+    Records every stage run inside the block in a new Trace.
+
+    Yields:
+        Trace: The trace being recorded.
+    """
+    trace = Trace()
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+def current_trace():
+    """
+    Returns:
+        Trace: The trace of the current request, or None when not tracing.
+    """
+    return _trace.get()
+
+
+def note(key, value):
+    """
+    Adds a value to the breakdown of the traced request, if any.
+
+    Args:
+        key (str): Name of the value in the breakdown.
+        value (Any): JSON serializable value.
+    """
+    trace = _trace.get()
+    if trace is not None:
+        trace.notes[key] = value
+
+
+@contextmanager
+def image(label):
+    """
+    Attributes the stages run inside the block to one image of the traced
+    request. Does nothing when the request is not traced.
+
+    Args:
+        label (str): Filename or source of the image.
+    """
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+
+    entry = {"image": label, "stages": {}}
+    trace.images.append(entry)
+    token = _image.set(entry)
+    try:
+        yield
+    finally:
+        _image.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a block of the image pipeline.
+
+    Nothing is measured when no observer is registered and the request is
+    not traced.
+
+    Args:
+        name (str): Stage name, one of STAGES.
+    """
+    trace = _trace.get()
+    if not _observers and trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if trace is not None:
+            trace.add(name, elapsed, _image.get())
+        for observer in list(_observers):
+            observer(name, elapsed)
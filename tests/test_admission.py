@@ -0,0 +1,95 @@
+import pytest
+from fastapi import HTTPException
+
+from admission import AdmissionControl, parse_costs
+
+
+def make_control(rate_limit="10/minute", max_in_flight_cost=8):
+    return AdmissionControl(storage_uri="memory://", rate_limit=rate_limit,
+                            costs="classify=1,detect=2,censor=4", max_in_flight_cost=max_in_flight_cost)
+
+
+def test_parse_costs():
+    assert parse_costs("classify=1, detect=2,censor=4") == {"classify": 1, "detect": 2, "censor": 4}
+
+
+def test_weight_by_images_and_endpoint():
+    control = make_control()
+    assert control.weight("classify", 3) == 3
+    assert control.weight("censor", 3) == 12
+    assert control.weight("detect", 0) == 2
+
+
+def test_rate_limit_counts_images():
+    control = make_control(rate_limit="10/minute", max_in_flight_cost=100)
+    with control.admit("client", "classify", 6):
+        pass
+    with pytest.raises(HTTPException) as e:
+        with control.admit("client", "classify", 6):
+            pass
+    assert e.value.status_code == 429
+    assert int(e.value.headers["Retry-After"]) >= 1
+    assert control.in_flight_cost == 0
+
+    # Other clients have their own budget.
+    with control.admit("other", "classify", 6):
+        pass
+
+
+def test_overload_is_shed_without_charging():
+    control = make_control(rate_limit="100/minute", max_in_flight_cost=8)
+    with control.admit("a", "censor", 2):
+        assert control.in_flight_cost == 8
+        with pytest.raises(HTTPException) as e:
+            with control.admit("b", "classify", 1):
+                pass
+        assert e.value.status_code == 503
+        assert e.value.headers["Retry-After"] == "1"
+    assert control.in_flight_cost == 0
+
+    stats = control.limiter.get_window_stats(control.limit, "images", "b")
+    assert stats[1] == 100
+
+
+def test_check_capacity_before_reading_the_body():
+    control = make_control(rate_limit="100/minute", max_in_flight_cost=8)
+    control.check_capacity()
+    with control.admit("a", "censor", 1):
+        control.check_capacity()
+        with control.admit("a", "classify", 4):
+            with pytest.raises(HTTPException) as e:
+                control.check_capacity()
+            assert e.value.status_code == 503
+            assert e.value.headers["Retry-After"] == "1"
+    control.check_capacity()
+
+
+def test_request_larger_than_worker_budget_runs_alone():
+    control = make_control(rate_limit="100/minute", max_in_flight_cost=8)
+    with control.admit("a", "censor", 3):
+        assert control.in_flight_cost == 12
+        with pytest.raises(HTTPException) as e:
+            with control.admit("b", "classify", 1):
+                pass
+        assert e.value.status_code == 503
+
+    with control.admit("a", "classify", 1):
+        with pytest.raises(HTTPException) as e:
+            with control.admit("b", "censor", 3):
+                pass
+        assert e.value.status_code == 503
+    assert control.in_flight_cost == 0
+
+
+def test_failing_rate_limit_storage_releases_weight():
+    control = make_control(max_in_flight_cost=8)
+
+    def hit(*args, **kwargs):
+        raise ConnectionError("storage unreachable")
+
+    control.limiter.hit = hit
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            with control.admit("a", "censor", 2):
+                pass
+    assert control.in_flight_cost == 0
@@ -0,0 +1,121 @@
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from archive import ArchiveError, open_reader
+
+
+class Member:
+
+    def __init__(self, name):
+        self.name = name
+        self.data = bytearray()
+        self.rejected = None
+        self.ended = False
+
+
+class Collector:
+
+    def begin(self, name):
+        return Member(name)
+
+    def write(self, member, chunk):
+        member.data += chunk
+
+    def end(self, member):
+        member.ended = True
+
+    def reject(self, member, reason):
+        member.rejected = reason
+
+
+FILES = {
+    "a.jpg": b"a" * 1000,
+    "dir/b.png": b"b" * 5000,
+    "empty.bmp": b"",
+    "x" * 150 + ".jpg": b"long name" * 100
+}
+
+
+def tar_bytes(mode="w", format=tarfile.GNU_FORMAT):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode, format=format) as tar:
+        directory = tarfile.TarInfo("dir")
+        directory.type = tarfile.DIRTYPE
+        tar.addfile(directory)
+        for name, data in FILES.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def zip_bytes(compression=zipfile.ZIP_DEFLATED, stream=False):
+    buffer = io.BytesIO()
+    target = NonSeekable(buffer) if stream else buffer
+    with zipfile.ZipFile(target, "w", compression=compression) as archive:
+        archive.writestr("dir/", b"")
+        for name, data in FILES.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+class NonSeekable(io.RawIOBase):
+    """
+    Makes zipfile write data descriptors, as when zipping to a pipe.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def seekable(self):
+        return False
+
+
+def read(data, chunk_size=7):
+    reader = open_reader(data[:512], Collector())
+    members = []
+    for start in range(0, len(data), chunk_size):
+        members += reader.feed(data[start:start + chunk_size])
+    members += reader.close()
+    return reader, members
+
+
+@pytest.mark.parametrize("data", [
+    tar_bytes(),
+    tar_bytes(format=tarfile.PAX_FORMAT),
+    tar_bytes(mode="w:gz"),
+    zip_bytes(),
+    zip_bytes(zipfile.ZIP_STORED),
+    zip_bytes(stream=True)
+], ids=["gnu", "pax", "gzip", "zip", "zip-stored", "zip-streamed"])
+def test_reads_members_incrementally(data):
+    reader, members = read(data)
+    assert reader.done
+    assert {member.name: bytes(member.data) for member in members} == FILES
+    assert all(member.ended for member in members)
+
+
+def test_unknown_format():
+    assert open_reader(b"\x00" * 10 + b"not an archive" * 100, Collector()) is None
+
+
+def test_truncated_archive():
+    data = tar_bytes()
+    reader = open_reader(data[:512], Collector())
+    reader.feed(data[:1000])
+    with pytest.raises(ArchiveError):
+        reader.close()
+
+
+def test_stored_zip_members_without_sizes_cannot_be_streamed():
+    with pytest.raises(ArchiveError):
+        read(zip_bytes(zipfile.ZIP_STORED, stream=True))
@@ -0,0 +1,132 @@
+import cv2
+import numpy as np
+import pytest
+from prometheus_client import REGISTRY
+
+import detect
+
+LABELS = ["female_breast", "female_genitalia", "male_genitalia", "buttocks"]
+
+
+class FakeInterpreter:
+    """
+    Stands in for the TFLite interpreter. Every image is detected as a
+    single object whose box and class come from its first pixel.
+    """
+
+    # Largest batch the model accepts, None for any.
+    max_batch = None
+    invocations = []
+
+    def __init__(self, model_path=None):
+        self.batch = 1
+        self.input = None
+
+    def get_input_details(self):
+        return [{"index": 0, "shape": np.array([self.batch, 4, 4, 3]), "dtype": np.uint8}]
+
+    def get_output_details(self):
+        # Scores, boxes, count and classes, in the order of the model.
+        return [{"index": 1}, {"index": 2}, {"index": 3}, {"index": 4}]
+
+    def resize_tensor_input(self, index, shape):
+        self.batch = shape[0]
+
+    def allocate_tensors(self):
+        if self.max_batch is not None and self.batch > self.max_batch:
+            raise RuntimeError("Batch of {} is not supported.".format(self.batch))
+
+    def set_tensor(self, index, value):
+        assert value.shape == (self.batch, 4, 4, 3)
+        self.input = value
+
+    def invoke(self):
+        FakeInterpreter.invocations.append(self.batch)
+
+    def get_tensor(self, index):
+        values = self.input[:, 0, 0, 0].astype(np.float32)
+        if index == 1:
+            return np.repeat([[0.9, 0.1]], self.batch, axis=0)
+        if index == 2:
+            return np.stack([[[v / 100, v / 100, 0.5, 0.5], [0, 0, 0, 0]] for v in values])
+        if index == 3:
+            return np.full(self.batch, 2.0)
+        return np.stack([[v % 4, 0] for v in values])
+
+
+@pytest.fixture
+def detector(tmp_path, monkeypatch):
+    labels = tmp_path / "labelmap.txt"
+    labels.write_text("\n".join(LABELS))
+    monkeypatch.setattr(detect, "PATH_TO_LABELS", str(labels))
+    monkeypatch.setattr(detect, "Interpreter", FakeInterpreter)
+    monkeypatch.setattr(FakeInterpreter, "max_batch", None)
+    monkeypatch.setattr(FakeInterpreter, "invocations", [])
+    return detect.NudenyDetect()
+
+
+def fallbacks():
+    return REGISTRY.get_sample_value("nudeny_detect_batch_fallbacks_total") or 0
+
+
+def test_batch_sizes():
+    assert detect.batch_sizes(8) == [8, 4, 2, 1]
+    assert detect.batch_sizes(6) == [6, 4, 2, 1]
+    assert detect.batch_sizes(1) == [1]
+    assert detect.batch_sizes(0) == [1]
+
+
+def test_invoke_batch_splits_into_allocated_sizes(detector):
+    inputs = [np.full((1, 4, 4, 3), value, np.uint8) for value in range(13)]
+    outputs = detector.invoke_batch(inputs)
+
+    assert FakeInterpreter.invocations == [8, 4, 1]
+    assert sorted(detector.interpreters) == [1, 4, 8]
+    assert len(outputs) == 13
+    for value, (boxes, classes, scores) in enumerate(outputs):
+        assert boxes[0][0] == pytest.approx(value / 100)
+        assert classes[0] == value % 4
+        assert list(scores) == pytest.approx([0.9, 0.1])
+
+
+def test_invoke_batch_falls_back_to_single_images(detector):
+    FakeInterpreter.max_batch = 1
+    before = fallbacks()
+    inputs = [np.full((1, 4, 4, 3), value, np.uint8) for value in range(3)]
+    outputs = detector.invoke_batch(inputs)
+
+    assert FakeInterpreter.invocations == [1, 1, 1]
+    assert [classes[0] for _, classes, _ in outputs] == [0, 1, 2]
+    assert detector.batch_sizes == [1]
+    assert fallbacks() == before + 1
+
+    # Later batches go straight to single images.
+    detector.invoke_batch(inputs)
+    assert FakeInterpreter.invocations == [1] * 6
+    assert fallbacks() == before + 1
+
+
+def test_detect_batch(detector):
+    def png(value):
+        return cv2.imencode(".png", np.full((40, 20, 3), value, np.uint8))[1].tobytes()
+
+    files = [(png(10), "a.png"), (b"not an image", "b.txt"), (png(21), "c.png")]
+    predictions = detector.detect_batch(files)
+
+    assert FakeInterpreter.invocations == [2]
+    assert [prediction["filename"] for prediction in predictions] == ["a.png", "b.txt", "c.png"]
+    assert predictions[1]["exposed_parts"] == {}
+    [exposed] = predictions[0]["exposed_parts"]["male_genitalia"]
+    assert exposed["confidence_score"] == pytest.approx(90)
+    assert (exposed["top"], exposed["left"], exposed["bottom"], exposed["right"]) == (4, 2, 20, 10)
+    assert predictions[2]["exposed_parts"]["female_genitalia"]
+
+
+def test_scale_detections():
+    detections = {"buttocks": [{"confidence_score": 80.0, "top": 1, "left": 2, "bottom": 3, "right": 4}],
+                  "female_breast": []}
+    assert detect.scale_detections(detections, 1) is detections
+    assert detect.scale_detections(detections, 4) == {
+        "buttocks": [{"confidence_score": 80.0, "top": 4, "left": 8, "bottom": 12, "right": 16}],
+        "female_breast": []
+    }
@@ -0,0 +1,169 @@
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+import frames
+from memory import MemoryBudget
+
+
+def pattern(value, size=(64, 48)):
+    # Random blocks, a different layout for every value.
+    blocks = np.random.RandomState(value).randint(0, 2, (8, 8, 1)).astype(np.uint8) * 255
+    return np.ascontiguousarray(cv2.resize(np.repeat(blocks, 3, axis=2), size, interpolation=cv2.INTER_NEAREST))
+
+
+def write_gif(path, values, duration=100):
+    images = [Image.fromarray(pattern(value) if np.isscalar(value) else value) for value in values]
+    images[0].save(path, save_all=True, append_images=images[1:], duration=duration, loop=0)
+
+
+class FakeClassify:
+
+    def __init__(self, nude_from):
+        self.nude_from = nude_from
+        self.calls = []
+        self.shapes = set()
+
+    def predict_scores(self, inputs):
+        self.calls.append(len(inputs))
+        self.shapes.update(input.shape for input in inputs)
+        done = sum(self.calls) - len(inputs)
+        return np.array([[0.9, 0.1, 0.0] if done + i >= self.nude_from else [0.0, 0.9, 0.1]
+                         for i in range(len(inputs))])
+
+
+def test_dhash_ignores_small_changes():
+    image = pattern(1)
+    assert frames.dhash(image) == frames.dhash(np.clip(image.astype(int) + 3, 0, 255).astype(np.uint8))
+    assert bin(frames.dhash(image) ^ frames.dhash(pattern(2))).count("1") > frames.DHASH_DISTANCE
+
+
+def test_samples_gif_at_fps_and_drops_duplicates(tmp_path):
+    path = str(tmp_path / "clip.gif")
+    # 20 frames of 100ms: 2 seconds, the last ten nearly alike (Pillow
+    # would merge identical frames).
+    write_gif(path, list(range(1, 11)) + [np.maximum(pattern(1), 10 * i) for i in range(1, 11)])
+
+    counts = {}
+    sampled = list(frames.sample_frames(path, fps=5, counts=counts))
+    assert [index for index, _, _ in sampled] == [0, 2, 4, 6, 8, 10]
+    assert counts == {"sampled": 10, "duplicate": 4}
+    assert sampled[1][1] == pytest.approx(0.2)
+
+
+def write_video(path, frames):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 48))
+    if not writer.isOpened():
+        pytest.skip("OpenCV was built without a video writer")
+    for value in range(frames):
+        writer.write(cv2.cvtColor(pattern(value), cv2.COLOR_RGB2BGR))
+    writer.release()
+
+
+def test_samples_video(tmp_path):
+    path = str(tmp_path / "clip.avi")
+    write_video(path, 30)
+
+    sampled = list(frames.sample_frames(path, fps=2, distance=-1))
+    assert [index for index, _, _ in sampled] == [0, 5, 10, 15, 20, 25]
+    assert sampled[0][2].shape == (48, 64, 3)
+
+
+def test_seeks_to_sparse_video_samples(tmp_path, monkeypatch):
+    path = str(tmp_path / "clip.avi")
+    write_video(path, 100)
+    monkeypatch.setattr(frames, "SEEK_FRAMES", 3)
+    grabs = []
+    open_capture = cv2.VideoCapture
+
+    class CountingCapture:
+        def __init__(self, path):
+            self.capture = open_capture(path)
+
+        def grab(self):
+            grabs.append(1)
+            return self.capture.grab()
+
+        def __getattr__(self, name):
+            return getattr(self.capture, name)
+
+    monkeypatch.setattr(frames.cv2, "VideoCapture", CountingCapture)
+
+    sampled = list(frames.sample_frames(path, fps=0.5, distance=-1))
+    assert [index for index, _, _ in sampled] == [0, 20, 40, 60, 80]
+    assert sampled[2][1] == pytest.approx(4.0)
+    # The frames sought to are the frames at those indices, give or take
+    # JPEG compression.
+    for index, _, image_rgb in sampled:
+        assert bin(frames.dhash(image_rgb) ^ frames.dhash(pattern(index))).count("1") <= frames.DHASH_DISTANCE
+    assert len(grabs) == 6
+
+
+def test_predict_frames_stops_early(tmp_path):
+    path = str(tmp_path / "clip.gif")
+    write_gif(path, list(range(1, 21)))
+    model = FakeClassify(nude_from=5)
+
+    prediction = frames.predict_frames(path, "classify", model, fps=10, max_frames=20, threshold=0.8, batch_size=4)
+    assert prediction["class"] == "nude"
+    assert prediction["stopped_early"]
+    assert model.calls == [4, 4]
+    assert [frame["class"] for frame in prediction["frames"]] == ["safe"] * 5 + ["nude"] * 3
+
+
+def test_predict_frames_limits_frames(tmp_path):
+    path = str(tmp_path / "clip.gif")
+    write_gif(path, list(range(1, 21)))
+    model = FakeClassify(nude_from=100)
+
+    prediction = frames.predict_frames(path, "classify", model, fps=10, max_frames=6, batch_size=4)
+    assert prediction["class"] == "safe"
+    assert not prediction["stopped_early"]
+    assert model.calls == [4, 2]
+
+
+def test_predict_frames_holds_one_frame_of_memory(tmp_path, monkeypatch):
+    path = str(tmp_path / "clip.gif")
+    write_gif(path, list(range(1, 21)))
+    budget = MemoryBudget(capacity=10 ** 9, wait=0)
+    monkeypatch.setattr(frames, "memory_budget", budget)
+    model = FakeClassify(nude_from=100)
+
+    frames.predict_frames(path, "classify", model, fps=10, batch_size=4)
+    # Batches hold model inputs, not the 64x48 frames.
+    assert model.shapes == {(224, 224, 3)}
+    assert budget.stats()["peak_bytes"] == 64 * 48 * 3 * 5
+    assert budget.stats()["in_use_bytes"] == 0
+
+
+def test_predict_frames_invalid_media(tmp_path):
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(b"not a video" * 100)
+
+    prediction = frames.predict_frames(str(path), "classify", FakeClassify(0))
+    assert prediction["class"] == "invalid"
+    assert prediction["frames"] == []
+    assert not prediction["complete"]
+    assert "error" in prediction
+
+
+def test_predict_frames_reports_decoding_errors_after_some_frames(tmp_path):
+    path = tmp_path / "clip.gif"
+    write_gif(str(path), list(range(1, 21)))
+    data = path.read_bytes()
+    path.write_bytes(data[:len(data) // 2])
+
+    prediction = frames.predict_frames(str(path), "classify", FakeClassify(100), fps=10, batch_size=2)
+    assert prediction["frames"]
+    assert not prediction["complete"]
+    assert prediction["error"]
+
+
+def test_predict_frames_complete(tmp_path):
+    path = str(tmp_path / "clip.gif")
+    write_gif(path, list(range(1, 5)))
+
+    prediction = frames.predict_frames(path, "classify", FakeClassify(100), fps=10)
+    assert prediction["complete"]
+    assert "error" not in prediction
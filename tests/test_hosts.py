@@ -0,0 +1,77 @@
+import time
+
+import pytest
+import requests
+
+from benchmarks.standins import LocalImageServer, Route
+from hosts import BudgetExhausted, CircuitOpen, HostGuard, fetch_budget, parse_timeouts
+
+
+@pytest.fixture
+def server():
+    with LocalImageServer() as server:
+        yield server
+
+
+def test_parse_timeouts():
+    assert parse_timeouts("") == {}
+    assert parse_timeouts("CDN.example.com=2, slow.example.org=10.5") == {
+        "cdn.example.com": 2.0, "slow.example.org": 10.5}
+
+
+def test_slow_hosts_time_out(server):
+    server.routes["/slow.jpg"] = Route(b"x", "image/jpeg", delay=0.5)
+    guard = HostGuard(timeout=5, host_timeouts={"127.0.0.1": 0.1})
+
+    start = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        guard.request("GET", server.url("/slow.jpg"))
+    assert time.monotonic() - start < 0.4
+    assert guard.stats()["127.0.0.1"]["timeouts"] == 1
+
+
+def test_failing_host_opens_circuit_and_recovers(server):
+    route = server.routes["/a.jpg"] = Route(b"x", "image/jpeg", status=503)
+    guard = HostGuard(timeout=1, failure_threshold=3, cooldown=0.2)
+    url = server.url("/a.jpg")
+
+    for _ in range(3):
+        assert guard.request("GET", url).status_code == 503
+    with pytest.raises(CircuitOpen):
+        guard.request("GET", url)
+    assert len(route.hits) == 3
+    assert guard.stats()["127.0.0.1"]["state"] == "open"
+
+    # The probe after the cooldown still fails, so the circuit opens again.
+    time.sleep(0.25)
+    assert guard.request("GET", url).status_code == 503
+    with pytest.raises(CircuitOpen):
+        guard.request("GET", url)
+
+    route.status = 200
+    time.sleep(0.25)
+    assert guard.request("GET", url).content == b"x"
+    assert guard.request("GET", url).status_code == 200
+
+    stats = guard.stats()["127.0.0.1"]
+    assert stats["state"] == "closed"
+    assert stats["failures"] == 4
+    assert stats["rejected"] == 2
+    assert stats["last_error"] == "HTTP 503"
+
+
+def test_client_errors_do_not_count_as_failures(server):
+    guard = HostGuard(timeout=1, failure_threshold=1)
+    assert guard.request("GET", server.url("/missing.jpg")).status_code == 404
+    assert guard.stats()["127.0.0.1"]["state"] == "closed"
+
+
+def test_fetch_budget_is_shared_by_the_block(server):
+    server.routes["/slow.jpg"] = Route(b"x", "image/jpeg", delay=0.3)
+    guard = HostGuard(timeout=5)
+
+    with fetch_budget(0.2):
+        with pytest.raises(requests.Timeout):
+            guard.request("GET", server.url("/slow.jpg"))
+        with pytest.raises(BudgetExhausted):
+            guard.request("GET", server.url("/slow.jpg"))
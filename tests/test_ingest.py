@@ -0,0 +1,164 @@
+import hashlib
+import io
+import os
+import struct
+import tarfile
+import zlib
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from ingest import ingest_archive, ingest_files, ingest_media, ingest_raw
+
+
+def png_bytes(width=2, height=2, padding=0):
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    chunk = b"IHDR" + ihdr
+    data = b"\x89PNG\r\n\x1a\n" + struct.pack(">I", len(ihdr)) + chunk + struct.pack(">I", zlib.crc32(chunk))
+    return data + b"\x00" * padding
+
+
+app = FastAPI()
+
+
+@app.post("/upload")
+async def upload(request: Request):
+    files, stats = await ingest_files(request, max_file_bytes=1000, max_request_bytes=5000)
+    return {
+        "files": [{"filename": f.filename, "size": len(f.data), "rejected": f.rejected, "digest": f.digest}
+                  for f in files],
+        "peak": stats.peak_buffered_bytes
+    }
+
+
+@app.post("/raw")
+async def raw(request: Request):
+    file, _ = await ingest_raw(request, "body.png", max_file_bytes=1000)
+    return {"size": len(file.data), "rejected": file.rejected}
+
+
+@app.post("/archive")
+async def archive(request: Request):
+    members = []
+    async for file in ingest_archive(request, max_file_bytes=1000, max_archive_bytes=50000, max_members=5):
+        members.append([file.filename, len(file.data), file.rejected])
+        file.release()
+    return members
+
+
+@app.post("/media")
+async def media(request: Request):
+    media = await ingest_media(request, max_bytes=1000)
+    with open(media.path, "rb") as f:
+        data = f.read()
+    media.remove()
+    return {"size": media.size, "digest": media.digest, "data": data.decode(), "removed": not os.path.exists(media.path)}
+
+
+client = TestClient(app)
+
+
+def tar_bytes(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def test_accepts_supported_files():
+    response = client.post("/upload", files=[("files", ("a.png", png_bytes(), "image/png"))])
+    assert response.status_code == 200
+    assert response.json()["files"] == [{
+        "filename": "a.png", "size": len(png_bytes()), "rejected": None,
+        "digest": hashlib.sha256(png_bytes()).hexdigest()}]
+
+
+def test_rejects_unsupported_and_oversized_files():
+    files = [
+        ("files", ("a.txt", b"hello world" * 10, "text/plain")),
+        ("files", ("big.png", png_bytes(padding=2000), "image/png")),
+        ("files", ("ok.png", png_bytes(), "image/png"))
+    ]
+    response = client.post("/upload", files=files)
+    assert response.status_code == 200
+    body = response.json()
+    assert [f["rejected"] for f in body["files"]] == ["unsupported", "too_large", None]
+    assert body["files"][0]["size"] == 0
+    assert body["files"][0]["digest"] is None
+    assert body["peak"] <= 1000 + len(png_bytes())
+
+
+def test_rejects_images_over_pixel_budget():
+    response = client.post("/upload", files=[("files", ("bomb.png", png_bytes(30000, 30000), "image/png"))])
+    assert response.status_code == 200
+    assert response.json()["files"][0]["rejected"] == "too_many_pixels"
+
+
+def test_rejects_large_requests():
+    files = [("files", ("{}.png".format(i), png_bytes(padding=900), "image/png")) for i in range(10)]
+    response = client.post("/upload", files=files)
+    assert response.status_code == 413
+
+
+def test_missing_files():
+    response = client.post("/upload")
+    assert response.status_code == 422
+    assert response.json() == {
+        "detail": [
+            {
+                "loc": [
+                    "body",
+                    "files"
+                ],
+                "msg": "field required",
+                "type": "value_error.missing"
+            }
+        ]
+    }
+
+
+def test_raw_image():
+    response = client.post("/raw", content=png_bytes(), headers={"Content-Type": "application/octet-stream"})
+    assert response.json() == {"size": len(png_bytes()), "rejected": None}
+
+    response = client.post("/raw", content=b"hello world" * 10)
+    assert response.json() == {"size": 0, "rejected": "unsupported"}
+
+    response = client.post("/raw", content=png_bytes(padding=2000))
+    assert response.status_code == 413
+
+
+def test_archive_members():
+    files = [("a.png", png_bytes()), ("notes.txt", b"hello world" * 10), ("big.png", png_bytes(padding=2000))]
+    response = client.post("/archive", content=tar_bytes(files))
+    assert response.status_code == 200
+    assert response.json() == [
+        ["a.png", len(png_bytes()), None],
+        ["notes.txt", 0, "unsupported"],
+        ["big.png", 0, "too_large"]
+    ]
+
+
+def test_archive_limits():
+    files = [("{}.png".format(i), png_bytes()) for i in range(6)]
+    assert client.post("/archive", content=tar_bytes(files)).status_code == 413
+    assert client.post("/archive", content=b"not an archive").status_code == 415
+    assert client.post("/archive", content=tar_bytes(files)[:100]).status_code == 400
+
+
+def test_media_is_spooled_to_disk():
+    response = client.post("/media", content=b"frames" * 100)
+    assert response.json() == {
+        "size": 600, "digest": hashlib.sha256(b"frames" * 100).hexdigest(), "data": "frames" * 100, "removed": True}
+    assert client.post("/media", content=b"frames" * 200).status_code == 413
+    assert client.post("/media", content=b"").status_code == 400
+
+
+def test_archive_repeated_names():
+    files = [(name, png_bytes()) for name in ("x/a.png", "x/a.png", "x/a.png#3", "x/a.png", "x/a.png#2")]
+    response = client.post("/archive", content=tar_bytes(files))
+    assert [member[0] for member in response.json()] == [
+        "x/a.png", "x/a.png#2", "x/a.png#3", "x/a.png#4", "x/a.png#2#2"]
@@ -251,3 +251,40 @@ def test_detect_url():
 def test_censor_url():
     response = requests.post("http://127.0.0.1:8000/censor-url", json=DATA_URL)
     assert response.status_code == 200
+
+# Metrics
+
+
+def test_metrics():
+    response = requests.get("http://127.0.0.1:8000/metrics")
+    assert response.status_code == 200
+    assert "nudeny_requests_total" in response.text
+    assert "nudeny_stage_duration_seconds" in response.text
+
+# Tracing
+
+
+def test_classify_trace():
+    files = []
+    for path in PATHS:
+        if not os.path.exists(path):
+            raise Exception("Path provided does not exists.")
+        files.append(('files', open(path, 'rb')))
+    response = requests.post("http://127.0.0.1:8000/classify", files=files, headers={"X-Nudeny-Trace": "1"})
+    assert response.status_code == 200
+    assert "Server-Timing" in response.headers
+    assert len(response.json()["Trace"]["images"]) == len(PATHS)
+
+
+def test_profile_requires_admin():
+    response = requests.get("http://127.0.0.1:8000/admin/profile?seconds=1")
+    assert response.status_code in (403, 404)
+
+
+def test_profile_rejects_non_positive_durations():
+    token = os.environ.get("NUDENY_ADMIN_TOKEN")
+    if not token:
+        return
+    for query in ("seconds=-1", "seconds=0", "seconds=nan", "seconds=1&interval=0", "seconds=1&interval=nan"):
+        response = requests.get("http://127.0.0.1:8000/admin/profile?" + query, headers={"X-Admin-Token": token})
+        assert response.status_code == 400
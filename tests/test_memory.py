@@ -0,0 +1,63 @@
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from memory import MemoryBudget, image_cost
+from utils import ImageInfo
+
+
+def test_image_cost():
+    info = ImageInfo("jpeg", 1001, 500, 3)
+    copies = {"classify": 5, "detect": 2}
+    assert image_cost(info, 1, "classify", copies) == 1001 * 500 * 3 * 5
+    assert image_cost(info, 2, "detect", copies) == 501 * 250 * 3 * 2
+    assert image_cost(info, 1, "other", copies) == 1001 * 500 * 3
+
+
+def test_tracks_usage_and_peak():
+    budget = MemoryBudget(capacity=100, wait=0)
+    with budget.hold(60):
+        with budget.hold(30):
+            assert budget.stats() == {"capacity_bytes": 100, "in_use_bytes": 90, "peak_bytes": 90, "waiting": 0}
+    assert budget.stats()["in_use_bytes"] == 0
+    assert budget.stats()["peak_bytes"] == 90
+
+
+def test_rejects_when_exhausted():
+    budget = MemoryBudget(capacity=100, wait=0.05, retry_after=3)
+    with budget.hold(80):
+        with pytest.raises(HTTPException) as e:
+            with budget.hold(30):
+                pass
+    assert e.value.status_code == 503
+    assert e.value.headers == {"Retry-After": "3"}
+    assert budget.stats()["in_use_bytes"] == 0
+
+
+def test_waits_for_release():
+    budget = MemoryBudget(capacity=100, wait=5)
+    held = threading.Event()
+
+    def hold():
+        with budget.hold(80):
+            held.set()
+            time.sleep(0.1)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+    start = time.monotonic()
+    # Larger than the whole budget, runs alone once the other image is done.
+    with budget.hold(500) as amount:
+        assert time.monotonic() - start >= 0.05
+        assert amount == 100
+    thread.join()
+    assert budget.stats()["peak_bytes"] == 100
+
+
+def test_disabled_budget():
+    budget = MemoryBudget(capacity=0)
+    with budget.hold(10 ** 12):
+        assert budget.stats()["in_use_bytes"] == 0
@@ -0,0 +1,17 @@
+import pytest
+
+import profiler
+
+
+def test_profile_rejects_non_positive_durations():
+    with pytest.raises(ValueError):
+        profiler.profile(-1)
+    with pytest.raises(ValueError):
+        profiler.profile(1, interval=0)
+    for value in (float("nan"), float("inf")):
+        with pytest.raises(ValueError):
+            profiler.profile(value)
+        with pytest.raises(ValueError):
+            profiler.profile(1, interval=value)
+    # The profile lock was not taken.
+    assert profiler.profile(0.05, 0.01) is not None
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+import scan
+from benchmarks.images import synthetic_image
+
+
+def test_iter_items_is_sorted_and_reads_manifests(tmp_path):
+    for name in ("b/2.jpg", "b/1.jpg", "a.jpg"):
+        path = tmp_path / "images" / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"")
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("# comment\nhttp://example.com/x.jpg\n\n/data/y.png\n")
+
+    items = list(scan.iter_items([str(tmp_path / "images")], str(manifest)))
+    assert [item.replace(str(tmp_path), "") for item in items[:3]] == [
+        "/images/a.jpg", "/images/b/1.jpg", "/images/b/2.jpg"]
+    assert items[3:] == ["http://example.com/x.jpg", "/data/y.png"]
+
+
+def test_prepare_item(tmp_path):
+    image = tmp_path / "a.jpg"
+    image.write_bytes(synthetic_image(640, 480))
+    text = tmp_path / "notes.txt"
+    text.write_bytes(b"hello world" * 10)
+
+    scan._init_worker(["classify", "detect"], (320, 320, True), set())
+    index, _, digest, status, inputs = scan.prepare_item((0, str(image)))
+    assert status == scan.OK
+    assert inputs["classify"].shape == (224, 224, 3)
+    assert inputs["detect"][0].shape == (1, 320, 320, 3)
+    assert inputs["detect"][1:] == (480, 640, 1)
+
+    assert scan.prepare_item((1, str(text)))[3] == scan.INVALID
+    assert scan.prepare_item((2, str(tmp_path / "missing.jpg")))[3] == scan.INVALID
+
+    scan._init_worker(["classify"], None, {bytes.fromhex(digest)})
+    assert scan.prepare_item((0, str(image)))[3] == scan.SKIPPED
+
+
+def test_writer_resumes_from_checkpoint(tmp_path):
+    output = str(tmp_path / "results.jsonl")
+    checkpoint = output + ".checkpoint"
+    fingerprint = {"paths": ["x"], "manifest": None, "task": "classify"}
+
+    writer = scan.ResultWriter(output, checkpoint, fingerprint)
+    writer.write({"path": "a", "sha256": "00"})
+    writer.commit(1)
+    writer.write({"path": "b", "sha256": "11"})
+    writer.close()
+
+    writer = scan.ResultWriter(output, checkpoint, fingerprint)
+    assert writer.done == 1
+    writer.write({"path": "c", "sha256": "22"})
+    writer.commit(2)
+    writer.close(complete=True)
+
+    with open(output) as f:
+        assert [json.loads(line)["path"] for line in f] == ["a", "c"]
+    assert scan.load_digests([output]) == {b"\x00", b"\x22"}
+
+    with pytest.raises(FileExistsError):
+        scan.ResultWriter(output, checkpoint, fingerprint)
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_run():
+    calls = []
+    lock = threading.Lock()
+
+    def work(value):
+        with lock:
+            calls.append(value)
+        time.sleep(0.05)
+        return {"value": value}
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*[flight.do(("detect", "a"), work, "a") for _ in range(5)])
+        assert len(flight) == 0
+        return results
+
+    results = asyncio.run(run())
+    assert calls == ["a"]
+    assert results == [{"value": "a"}] * 5
+    # Waiting callers get their own copy of the result.
+    assert len(set(id(result) for result in results)) == 5
+
+
+def test_different_keys_run_separately():
+    def work(value):
+        time.sleep(0.01)
+        return value
+
+    async def run():
+        flight = SingleFlight()
+        return await asyncio.gather(
+            flight.do(("detect", "a"), work, "a"),
+            flight.do(("censor", "a"), work, "b"),
+            flight.do(("detect", "c"), work, "c"))
+
+    assert asyncio.run(run()) == ["a", "b", "c"]
+
+
+def test_errors_reach_every_caller_and_are_not_kept():
+    attempts = []
+
+    def work():
+        attempts.append(1)
+        time.sleep(0.01)
+        raise ValueError("broken image")
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*[flight.do(("classify", "a"), work) for _ in range(3)],
+                                       return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        with pytest.raises(ValueError):
+            await flight.do(("classify", "a"), work)
+
+    asyncio.run(run())
+    assert len(attempts) == 2
+
+
+def test_batches_share_runs_with_single_calls():
+    batches = []
+
+    def work(value):
+        time.sleep(0.05)
+        return {"value": value}
+
+    def work_batch(values):
+        batches.append(values)
+        return [{"value": value} for value in values]
+
+    async def run():
+        flight = SingleFlight()
+        single = asyncio.ensure_future(flight.do(("detect", "a"), work, "a"))
+        await asyncio.sleep(0.01)
+        results = await flight.do_batch(
+            [("detect", "a"), ("detect", "b"), ("detect", "c"), ("detect", "b")], work_batch, ["a", "b", "c", "b"])
+        assert await single == {"value": "a"}
+        assert len(flight) == 0
+        return results
+
+    results = asyncio.run(run())
+    assert batches == [["b", "c"]]
+    assert results == [{"value": "a"}, {"value": "b"}, {"value": "c"}, {"value": "b"}]
+    assert results[1] is not results[3]
+
+
+def test_batch_errors_reach_every_item():
+    def work_batch(values):
+        raise ValueError("broken batch")
+
+    async def run():
+        flight = SingleFlight()
+        with pytest.raises(ValueError):
+            await flight.do_batch([("detect", "a"), ("detect", "b")], work_batch, ["a", "b"])
+        assert len(flight) == 0
+
+    asyncio.run(run())
@@ -0,0 +1,92 @@
+import time
+
+import pytest
+
+from benchmarks.standins import LocalImageServer, Route
+from hosts import CircuitOpen
+from url_cache import UrlCache
+from utils import fetch_url
+
+
+@pytest.fixture
+def server():
+    with LocalImageServer() as server:
+        yield server
+
+
+def lookup(cache, url):
+    return cache.lookup(
+        ("classify", url),
+        lambda headers: fetch_url(url, headers),
+        lambda response: {"source": url, "class": "safe", "size": len(response.content)},
+        lambda: {"source": url, "class": "invalid"})
+
+
+def test_fresh_entries_are_served_without_fetching(server):
+    route = server.routes["/a.jpg"] = Route(b"x" * 10, "image/jpeg")
+    cache = UrlCache(ttl=60, negative_ttl=5)
+    url = server.url("/a.jpg")
+
+    assert lookup(cache, url)["size"] == 10
+    assert lookup(cache, url)["size"] == 10
+    assert len(route.hits) == 1
+
+
+def test_stale_entries_are_revalidated(server):
+    route = server.routes["/a.jpg"] = Route(b"x" * 10, "image/jpeg", etag='"v1"')
+    cache = UrlCache(ttl=0.05, negative_ttl=5)
+    url = server.url("/a.jpg")
+
+    first = lookup(cache, url)
+    time.sleep(0.1)
+    route.body = b"y" * 20
+    second = lookup(cache, url)
+
+    assert second == first
+    assert route.hits[1]["If-None-Match"] == '"v1"'
+
+    route.etag = '"v2"'
+    time.sleep(0.1)
+    assert lookup(cache, url)["size"] == 20
+
+
+def test_failures_are_cached_negatively(server):
+    route = server.routes["/missing.jpg"] = Route(b"", status=404)
+    cache = UrlCache(ttl=60, negative_ttl=0.05)
+    url = server.url("/missing.jpg")
+
+    assert lookup(cache, url)["class"] == "invalid"
+    assert lookup(cache, url)["class"] == "invalid"
+    assert len(route.hits) == 1
+
+    time.sleep(0.1)
+    lookup(cache, url)
+    assert len(route.hits) == 2
+    assert "If-None-Match" not in route.hits[1]
+
+
+def test_skipped_fetches_serve_stale_entries(server):
+    server.routes["/a.jpg"] = Route(b"x" * 10, "image/jpeg")
+    cache = UrlCache(ttl=0.05, negative_ttl=60)
+    url = server.url("/a.jpg")
+
+    def open_circuit(headers):
+        raise CircuitOpen("open")
+
+    def skipped(key):
+        return cache.lookup(("classify", key), open_circuit, None, lambda: {"source": key, "class": "invalid"})
+
+    assert lookup(cache, url)["size"] == 10
+    time.sleep(0.1)
+    assert skipped(url)["size"] == 10
+
+    assert skipped("http://other/")["class"] == "invalid"
+    assert ("classify", "http://other/") not in cache._entries
+
+
+def test_max_entries(server):
+    cache = UrlCache(ttl=60, negative_ttl=60, max_entries=2)
+    for name in ("a", "b", "c"):
+        server.routes["/{}.jpg".format(name)] = Route(b"x", "image/jpeg")
+        lookup(cache, server.url("/{}.jpg".format(name)))
+    assert len(cache._entries) == 2
@@ -0,0 +1,62 @@
+import base64
+import struct
+import zlib
+
+from utils import ImageInfo, check_image, decode_reduction, is_supported_file_type, parse_data_uri, probe_image
+
+
+def png_header(width, height, color_type=2):
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    chunk = b"IHDR" + ihdr
+    return b"\x89PNG\r\n\x1a\n" + struct.pack(">I", len(ihdr)) + chunk + struct.pack(">I", zlib.crc32(chunk))
+
+
+def jpeg_header(width, height, components=3):
+    app0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+    sof = b"\xff\xc0" + struct.pack(">HBHHB", 8 + 3 * components, 8, height, width, components) + b"\x00" * 3 * components
+    return b"\xff\xd8" + app0 + sof
+
+
+def bmp_header(width, height, bits=24):
+    dib = struct.pack("<IiiHHIIiiII", 40, width, height, 1, bits, 0, 0, 0, 0, 0, 0)
+    return b"BM" + struct.pack("<IHHI", 14 + len(dib), 0, 0, 14 + len(dib)) + dib
+
+
+def test_probe_formats():
+    for data, fmt, channels in [(png_header(640, 480), "png", 3),
+                                (jpeg_header(640, 480), "jpeg", 3),
+                                (bmp_header(640, -480), "bmp", 3)]:
+        info = probe_image(data)
+        assert (info.format, info.width, info.height, info.channels) == (fmt, 640, 480, channels)
+
+
+def test_probe_truncated_and_unsupported():
+    assert not probe_image(jpeg_header(640, 480)[:12]).complete
+    assert not probe_image(png_header(640, 480)[:20]).complete
+    assert probe_image(b"GIF89a\x01\x00\x01\x00") is None
+    assert probe_image(b"") is None
+    assert not is_supported_file_type(jpeg_header(640, 480)[:12])
+
+
+def test_pixel_budget():
+    assert decode_reduction(ImageInfo("png", 1000, 1000, 3), max_pixels=10 ** 6) == 1
+    assert decode_reduction(ImageInfo("jpeg", 3000, 3000, 3), max_pixels=10 ** 6) == 4
+    assert decode_reduction(ImageInfo("png", 3000, 3000, 3), max_pixels=10 ** 6) is None
+    assert decode_reduction(ImageInfo("jpeg", 65000, 65000, 3), max_pixels=10 ** 6) is None
+
+
+def test_decompression_bomb_is_rejected_from_header():
+    info, reduction = check_image(png_header(30000, 30000))
+    assert info is None and reduction is None
+
+    info, reduction = check_image(jpeg_header(30000, 30000))
+    assert info.format == "jpeg" and reduction == 8
+
+
+def test_parse_data_uri():
+    payload = png_header(2, 2)
+    uri = "data:image/png;base64," + base64.b64encode(payload).decode()
+    assert parse_data_uri(uri) == (payload, "png")
+    assert parse_data_uri("data:image/png;base64,not*base64") == (None, None)
+    assert parse_data_uri("data:image/gif;base64,R0lGODlh") == (None, None)
+    assert parse_data_uri("data:text/plain;base64,aGVsbG8=") == (None, None)
@@ -0,0 +1,47 @@
+import stages
+
+TRACE_HEADER = "x-nudeny-trace"
+
+
+class TraceMiddleware:
+    """
+    ASGI middleware enabling per-request tracing.
+
+    Requests sent with an `X-Nudeny-Trace: 1` header have their pipeline
+    stages recorded and get a `Server-Timing` header on the response. Other
+    requests only pay for one header lookup.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not is_trace_requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        with stages.tracing() as trace:
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                    message = dict(message, headers=headers)
+                await send(message)
+
+            await self.app(scope, receive, send_wrapper)
+
+
+def is_trace_requested(scope):
+    """
+    Checks if the request asked to be traced.
+
+    Args:
+        scope (dict): ASGI scope.
+
+    Returns:
+        boolean: Returns true if the trace header is set to a truthy value.
+    """
+    for name, value in scope["headers"]:
+        if name == TRACE_HEADER.encode("latin-1"):
+            return value.strip().lower() in (b"1", b"true", b"yes", b"on")
+    return False
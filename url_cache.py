@@ -0,0 +1,154 @@
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+import metrics
+from hosts import FetchSkipped
+
+# Seconds a prediction for a URL is served without contacting its host.
+URL_CACHE_TTL = float(os.environ.get("NUDENY_URL_CACHE_TTL", "300"))
+
+# Seconds a failing URL is answered as invalid without retrying it.
+URL_CACHE_NEGATIVE_TTL = float(os.environ.get("NUDENY_URL_CACHE_NEGATIVE_TTL", "30"))
+
+# Most URLs kept, least recently used ones are evicted first.
+URL_CACHE_MAX_ENTRIES = int(os.environ.get("NUDENY_URL_CACHE_MAX_ENTRIES", "10000"))
+
+
+class CacheEntry:
+
+    def __init__(self, prediction, expires, etag=None, last_modified=None, negative=False):
+        self.prediction = prediction
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+        self.negative = negative
+
+    def validators(self):
+        """
+        Returns:
+            dict: Conditional request headers for revalidating this entry.
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class UrlCache:
+    """
+    Predictions of image URLs, stored with the ETag/Last-Modified of the
+    response they were computed from.
+
+    Fresh entries are served directly. Stale entries are revalidated with a
+    conditional GET and the stored prediction is reused on 304. URLs that
+    fail to download are remembered for a shorter time. Fetches that are
+    skipped because the host's circuit is open or the request is out of
+    fetch budget serve the stale prediction if there is one, and are not
+    remembered as failures.
+    """
+
+    def __init__(self, ttl=URL_CACHE_TTL, negative_ttl=URL_CACHE_NEGATIVE_TTL, max_entries=URL_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            metrics.URL_CACHE_ENTRIES.set(len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            metrics.URL_CACHE_ENTRIES.set(0)
+
+    def lookup(self, key, fetch, process, invalid):
+        """
+        Returns the prediction for a URL, fetching it only when needed.
+
+        Args:
+            key (tuple): Cache key, the model and the URL.
+            fetch (callable): fetch(headers) performs the GET with the given
+                conditional headers and returns the response, or None when
+                the URL cannot be fetched.
+            process (callable): process(response) computes the prediction
+                from a 200 response.
+            invalid (callable): invalid() returns the prediction answered
+                for URLs that cannot be fetched.
+
+        Returns:
+            dict: The prediction.
+        """
+        if self.ttl <= 0:
+            try:
+                response = self._fetch(fetch, {})
+            except FetchSkipped:
+                return invalid()
+            if response is None or response.status_code != 200:
+                return invalid()
+            return process(response)
+
+        entry = self._get(key)
+        now = time.monotonic()
+        if entry is not None and now < entry.expires:
+            metrics.URL_CACHE_REQUESTS.labels("negative_hit" if entry.negative else "hit").inc()
+            return copy.deepcopy(entry.prediction)
+
+        headers = entry.validators() if entry is not None and not entry.negative else {}
+        try:
+            response = self._fetch(fetch, headers)
+        except FetchSkipped:
+            if entry is not None and not entry.negative:
+                metrics.URL_CACHE_REQUESTS.labels("stale").inc()
+                return copy.deepcopy(entry.prediction)
+            metrics.URL_CACHE_REQUESTS.labels("skipped").inc()
+            return invalid()
+
+        if response is not None and response.status_code == 304 and headers:
+            metrics.URL_CACHE_REQUESTS.labels("revalidated").inc()
+            entry.expires = time.monotonic() + self.ttl
+            self._put(key, entry)
+            return copy.deepcopy(entry.prediction)
+
+        metrics.URL_CACHE_REQUESTS.labels("miss").inc()
+        if response is None or response.status_code != 200:
+            prediction = invalid()
+            self._put(key, CacheEntry(prediction, time.monotonic() + self.negative_ttl, negative=True))
+            return copy.deepcopy(prediction)
+
+        prediction = process(response)
+        if "no-store" not in response.headers.get("Cache-Control", ""):
+            self._put(key, CacheEntry(
+                copy.deepcopy(prediction), time.monotonic() + self.ttl,
+                etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified")))
+        return prediction
+
+    def _fetch(self, fetch, headers):
+        try:
+            return fetch(headers)
+        except FetchSkipped:
+            raise
+        except requests.RequestException:
+            return None
+
+
+url_cache = UrlCache()
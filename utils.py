@@ -2,7 +2,34 @@ from urllib.parse import urlparse
 from io import BytesIO
 import requests
 import base64
-import imghdr
+import binascii
+import struct
+import os
+
+from hosts import host_guard
+from stages import stage
+
+# Largest decoded image, in pixels, the models are allowed to work on.
+MAX_IMAGE_PIXELS = int(os.environ.get("NUDENY_MAX_IMAGE_PIXELS", str(40 * 10 ** 6)))
+
+# JPEG can be decoded at 1/2, 1/4 or 1/8 scale without decoding it fully.
+JPEG_REDUCTIONS = [2, 4, 8]
+
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+# A data URI header ("data:image/jpeg;base64") never gets anywhere near this.
+MAX_DATA_URI_HEADER = 256
+
+try:
+    binascii.a2b_base64(b"", strict_mode=True)
+
+    def _b64decode_strict(payload):
+        # Validates and decodes in a single pass (Python 3.11+).
+        return binascii.a2b_base64(payload, strict_mode=True)
+except TypeError:
+    def _b64decode_strict(payload):
+        return base64.b64decode(payload, validate=True)
 
 def is_valid_url(url):
     """
@@ -61,7 +88,7 @@ def is_image_url(url):
         else:
             return False
         
-    response = requests.head(url)
+    response = host_guard.request("HEAD", url)
     content_type = response.headers['content-type'].split('/')
 
     if len(content_type) == 1:
@@ -101,12 +128,53 @@ def is_data_uri_image(data_uri):
     Returns:
         boolean: Returns url, data_uri or unknown.
     """
-    if data_uri.startswith("data:image/"):
-        image_types = ['jpg','jpeg','png','bmp', 'jfif']
-        mime_type = data_uri.split(";")[0][5:]
-        return any(mime_type.endswith(image_type) for image_type in image_types)
-    else:
+    media_type = data_uri_media_type(data_uri)
+    if media_type is None:
         return False
+    image_types = ['jpg','jpeg','png','bmp', 'jfif']
+    return any(media_type.endswith(image_type) for image_type in image_types)
+
+def data_uri_media_type(data_uri):
+    """
+    Reads the media type of an image data URI from its header only.
+
+    Args:
+        data_uri (str): Data URI.
+
+    Returns:
+        str: Lower-case image media type, e.g. image/png.
+        None: If the URI is not an image data URI.
+    """
+    if not data_uri.startswith("data:image/"):
+        return None
+    comma = data_uri.find(",", 0, MAX_DATA_URI_HEADER)
+    if comma == -1:
+        return None
+    return data_uri[5:comma].split(";")[0].lower()
+
+def parse_data_uri(data_uri):
+    """
+    Validates and decodes an image data URI in a single pass.
+
+    Only the short header is split; the payload is sliced once and
+    base64-decoded once, with validation done by the decoder itself.
+
+    Args:
+        data_uri (str): Data URI.
+
+    Returns:
+        bytes: Decoded image.
+        str: The file type of the data URI, e.g. png.
+        None, None: If the URI is not a valid base64 image data URI.
+    """
+    if not is_data_uri_image(data_uri):
+        return None, None
+    comma = data_uri.find(",", 0, MAX_DATA_URI_HEADER)
+    try:
+        data = _b64decode_strict(data_uri[comma + 1:])
+    except (binascii.Error, ValueError):
+        return None, None
+    return data, data_uri_media_type(data_uri)[6:]
 
 def is_valid_data_uri(data_uri):
     """
@@ -119,12 +187,161 @@ def is_valid_data_uri(data_uri):
         boolean: Returns True if data_uri is valid, otherwise
         False.
     """
-    try:
-        base64.b64decode(data_uri.split(",")[1], validate=True)
-    except:
-        return False
-    
-    return True
+    data, _ = parse_data_uri(data_uri)
+    return data is not None
+
+
+class ImageInfo:
+    """
+    Format and dimensions read from an image header.
+
+    Attributes:
+        format (str): jpeg, png or bmp.
+        width (int): Width in pixels, None when the header is truncated.
+        height (int): Height in pixels, None when the header is truncated.
+        channels (int): Colour channels, None when the header is truncated.
+    """
+
+    def __init__(self, format, width=None, height=None, channels=None):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.channels = channels
+
+    @property
+    def complete(self):
+        return self.width is not None
+
+    @property
+    def pixels(self):
+        return self.width * self.height
+
+
+def _probe_jpeg(data):
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            # End of image or start of scan before any frame header.
+            return None
+        length = struct.unpack_from(">H", data, i + 2)[0]
+        if marker in JPEG_SOF_MARKERS:
+            if i + 10 > len(data):
+                break
+            height, width = struct.unpack_from(">HH", data, i + 5)
+            channels = data[i + 9]
+            if width == 0 or height == 0:
+                return None
+            return ImageInfo("jpeg", width, height, channels)
+        i += 2 + length
+    return ImageInfo("jpeg")
+
+
+def _probe_png(data):
+    if len(data) < 26:
+        return ImageInfo("png")
+    if bytes(data[12:16]) != b"IHDR":
+        return None
+    width, height = struct.unpack_from(">II", data, 16)
+    channels = PNG_CHANNELS.get(data[25])
+    if width == 0 or height == 0 or channels is None:
+        return None
+    return ImageInfo("png", width, height, channels)
+
+
+def _probe_bmp(data):
+    if len(data) < 18:
+        return ImageInfo("bmp")
+    header_size = struct.unpack_from("<I", data, 14)[0]
+    if header_size == 12:
+        if len(data) < 26:
+            return ImageInfo("bmp")
+        width, height, _, bits = struct.unpack_from("<HHHH", data, 18)
+    else:
+        if len(data) < 30:
+            return ImageInfo("bmp")
+        width, height, _, bits = struct.unpack_from("<iiHH", data, 18)
+    width, height = abs(width), abs(height)
+    if width == 0 or height == 0:
+        return None
+    return ImageInfo("bmp", width, height, 4 if bits == 32 else 3)
+
+
+def probe_image(data):
+    """
+    Reads the format and dimensions of an image from its header only.
+
+    Args:
+        data (bytes-like): The image, or as much of its beginning as is
+        available.
+
+    Returns:
+        ImageInfo: Format and dimensions. Dimensions are None when data
+        ends before the header does.
+        None: If the data is not a supported image.
+    """
+    if len(data) < 4:
+        return None
+    if data[0] == 0xFF and data[1] == 0xD8 and data[2] == 0xFF:
+        return _probe_jpeg(data)
+    if bytes(data[:8]) == b"\x89PNG\r\n\x1a\n":
+        return _probe_png(data)
+    if bytes(data[:2]) == b"BM":
+        return _probe_bmp(data)
+    return None
+
+
+def decode_reduction(info, max_pixels=None):
+    """
+    Picks how much an image has to be scaled down while decoding to stay
+    within the pixel budget.
+
+    Args:
+        info (ImageInfo): Probed image.
+        max_pixels (int): Pixel budget, MAX_IMAGE_PIXELS by default.
+
+    Returns:
+        int: 1 to decode at full size, 2, 4 or 8 for reduced JPEG decoding.
+        None: If the image is over budget and cannot be decoded reduced.
+    """
+    if max_pixels is None:
+        max_pixels = MAX_IMAGE_PIXELS
+    if info.pixels <= max_pixels:
+        return 1
+    if info.format == "jpeg":
+        for factor in JPEG_REDUCTIONS:
+            if -(-info.width // factor) * -(-info.height // factor) <= max_pixels:
+                return factor
+    return None
+
+
+def check_image(file):
+    """
+    Validates an image from its header before anything decodes it.
+
+    Args:
+        file (bytes-like): Image file.
+
+    Returns:
+        ImageInfo: Probed format and dimensions.
+        int: Decode reduction from decode_reduction.
+        None, None: If the image is unsupported, truncated or too large.
+    """
+    info = probe_image(file)
+    if info is None or not info.complete:
+        return None, None
+    reduction = decode_reduction(info)
+    if reduction is None:
+        return None, None
+    return info, reduction
 
 
 def is_supported_file_type(file):
@@ -138,21 +355,47 @@ def is_supported_file_type(file):
         boolean: Returns true if file type is supported and is an image, 
         otherwise false.
     """
-    SUPPORTED_FILE_TYPE = ['jpg','jpeg','png','bmp', 'jfif']
-    img_type = imghdr.what(file="",h=file)
-    if img_type is None:
-        return False
-    elif img_type not in SUPPORTED_FILE_TYPE:
-        return False
-    
-    return True
+    info, _ = check_image(file)
+    return info is not None
 
-def download_image_url(url):
+def fetch_url(url, headers=None):
     """
-    Download the image URL.
+    GET a URL, within the per-host timeout, the host's circuit breaker and
+    the fetch budget of the request.
 
     Args:
-        url (str): URL to download.
+        url (str): URL to fetch.
+        headers (dict): Extra request headers, e.g. conditional ones.
+
+    Returns:
+        requests.Response: The response.
+    """
+    return host_guard.request("GET", url, headers)
+
+def fetch_image_url(url, headers=None):
+    """
+    Fetches a URL after checking that it points to an image.
+
+    Args:
+        url (str): URL to fetch.
+        headers (dict): Extra request headers, e.g. conditional ones.
+
+    Returns:
+        requests.Response: The response.
+        None: If the URL is not an image URL.
+    """
+    with stage("validation"):
+        if not is_image_url(url):
+            return None
+    with stage("fetch"):
+        return fetch_url(url, headers)
+
+def read_image_response(response):
+    """
+    Reads the image out of a successful image URL response.
+
+    Args:
+        response (requests.Response): Response of the image URL.
 
     Returns:
         BytesIO: BytesIO of the response.content.
@@ -162,11 +405,10 @@ def download_image_url(url):
     SUPPORTED_FILE_TYPE = ['jpg','jpeg','png','bmp', 'jfif']
     type = ''
 
-    response = requests.get(url, stream=True)
     if response.status_code != 200:
         return None, None
     
-    content_type = response.headers['Content-Type'].split('/')
+    content_type = response.headers.get('Content-Type', '').split('/')
 
     if len(content_type) == 1:
         if content_type[0] not in SUPPORTED_FILE_TYPE:
@@ -177,6 +419,20 @@ def download_image_url(url):
 
     return BytesIO(response.content), type
 
+def download_image_url(url):
+    """
+    Download the image URL.
+
+    Args:
+        url (str): URL to download.
+
+    Returns:
+        BytesIO: BytesIO of the response.content.
+        str: The file type of the URL.
+        None: If response status code is not equal to 200 (Success)
+    """
+    return read_image_response(fetch_url(url))
+
 def decode_data_uri(uri):
     """
     Decode data URI.
@@ -187,9 +443,10 @@ def decode_data_uri(uri):
     Returns:
         BytesIO: BytesIO of the decoded data URI.
         str: The file type of the data URI.
+        None: If the data URI is not a valid base64 image.
     """
-    data = base64.b64decode(uri.split(",")[1])
-    media_type = uri.split(",")[0]
-    type = media_type.split("/")[1].split(";")[0]
+    data, type = parse_data_uri(uri)
+    if data is None:
+        return None, None
 
     return BytesIO(data), type
\ No newline at end of file